@@ -0,0 +1,208 @@
+"""Keyset (cursor) pagination for the list views.
+
+Instead of counting all the rows and skipping (OFFSET) those of the previous pages, each page
+is fetched by filtering the rows after (or before) the ordering values of the last (or first)
+row of the page already shown. Those values travel in an opaque token in the URL.
+"""
+
+import base64
+import binascii
+import datetime
+import decimal
+import functools
+import json
+import operator
+import uuid
+
+from django.db import connections
+from django.db.models import F, Q
+from django.http import Http404
+
+# the direction of the page to fetch, in the cursor
+CURSOR_NEXT = 'n'
+CURSOR_PREVIOUS = 'p'
+
+
+def encode_cursor(direction, values):
+    """Build the opaque token for the given direction and ordering values."""
+    serialized = []
+    for value in values:
+        if isinstance(value, (datetime.date, datetime.time)):
+            # not using DjangoJSONEncoder, that truncates the microseconds
+            value = value.isoformat()
+        elif isinstance(value, (decimal.Decimal, uuid.UUID)):
+            value = str(value)
+        serialized.append(value)
+    raw = json.dumps([direction, serialized], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Get the direction and ordering values from the token; raise ValueError if invalid."""
+    padding = '=' * (-len(token) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(token + padding).decode('utf8')
+        direction, values = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError("Invalid cursor: {!r}".format(token))
+    if direction not in (CURSOR_NEXT, CURSOR_PREVIOUS) or not isinstance(values, list):
+        raise ValueError("Invalid cursor: {!r}".format(token))
+    return direction, values
+
+
+def _parse_ordering(ordering):
+    """Get (field, descending) pairs from the queryset ordering, ensuring it's unique by pk."""
+    keys = []
+    for item in ordering:
+        if not isinstance(item, str) or item == '?':
+            raise ValueError("Can not paginate by cursor with ordering {!r}".format(item))
+        keys.append((item.lstrip('-'), item.startswith('-')))
+    if not any(field == 'pk' for field, _ in keys):
+        descending = keys[-1][1] if keys else False
+        keys.append(('pk', descending))
+    return keys
+
+
+def _get_value(obj, field):
+    """Get the value of the (maybe related, with '__') field from the object."""
+    for attr in field.split('__'):
+        obj = getattr(obj, attr)
+        if obj is None:
+            break
+    return obj
+
+
+def _keyset_filter(keys, values, after):
+    """Build the filter for the rows after (or before) the given values, nulls being last."""
+    alternatives = []
+    for idx, ((field, descending), value) in enumerate(zip(keys, values)):
+        if after:
+            if value is None:
+                # nothing is after the nulls in this key
+                continue
+            lookup = 'lt' if descending else 'gt'
+            condition = Q(**{field + '__' + lookup: value}) | Q(**{field + '__isnull': True})
+        else:
+            if value is None:
+                condition = Q(**{field + '__isnull': False})
+            else:
+                lookup = 'gt' if descending else 'lt'
+                condition = Q(**{field + '__' + lookup: value})
+
+        for previous_field, previous_value in zip(keys[:idx], values):
+            field_name = previous_field[0]
+            if previous_value is None:
+                condition &= Q(**{field_name + '__isnull': True})
+            else:
+                condition &= Q(**{field_name: previous_value})
+        alternatives.append(condition)
+
+    if not alternatives:
+        return Q(pk__in=[])
+    return functools.reduce(operator.or_, alternatives)
+
+
+def _get_approximate_count(queryset):
+    """Get the rows quantity estimated by the database planner (exact if not PostgreSQL)."""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        (result,) = cursor.fetchone()
+    if isinstance(result, str):
+        result = json.loads(result)
+    (plan,) = result
+    return int(plan['Plan']['Plan Rows'])
+
+
+class KeysetPage:
+    """A page of results, with the URLs of the neighbour pages (if any)."""
+
+    def __init__(self, object_list, next_url, previous_url, approximate_count=None):
+        self.object_list = object_list
+        self.next_url = next_url
+        self.previous_url = previous_url
+        self.approximate_count = approximate_count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_url is not None
+
+    def has_previous(self):
+        return self.previous_url is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginationMixin:
+    """Paginate a ListView by cursor, using the ordering of its queryset.
+
+    The view's ordering must be by stable keys, and is completed with the pk (if not there)
+    to have a unique ordering. Set `approximate_count` to have the estimated total of rows in
+    the page (`page_obj.approximate_count`), without counting all of them.
+    """
+
+    cursor_kwarg = 'cursor'
+    approximate_count = False
+
+    def _build_url(self, direction, obj, keys):
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        values = [_get_value(obj, field) for field, _ in keys]
+        query[self.cursor_kwarg] = encode_cursor(direction, values)
+        return '?' + query.urlencode()
+
+    def paginate_queryset(self, queryset, page_size):
+        keys = _parse_ordering(queryset.query.order_by or queryset.model._meta.ordering)
+        forward = [
+            F(field).desc(nulls_last=True) if descending else F(field).asc(nulls_last=True)
+            for field, descending in keys]
+        backward = [
+            F(field).asc(nulls_first=True) if descending else F(field).desc(nulls_first=True)
+            for field, descending in keys]
+
+        approximate_count = None
+        if self.approximate_count:
+            approximate_count = _get_approximate_count(queryset)
+
+        token = self.request.GET.get(self.cursor_kwarg)
+        if token:
+            try:
+                direction, values = decode_cursor(token)
+            except ValueError:
+                raise Http404("Página inválida")
+            if len(values) != len(keys):
+                raise Http404("Página inválida")
+        else:
+            direction, values = CURSOR_NEXT, None
+
+        if direction == CURSOR_NEXT:
+            if values is not None:
+                queryset = queryset.filter(_keyset_filter(keys, values, after=True))
+            rows = list(queryset.order_by(*forward)[:page_size + 1])
+            has_more = len(rows) > page_size
+            object_list = rows[:page_size]
+            has_next, has_previous = has_more, values is not None
+        else:
+            queryset = queryset.filter(_keyset_filter(keys, values, after=False))
+            rows = list(queryset.order_by(*backward)[:page_size + 1])
+            has_more = len(rows) > page_size
+            object_list = rows[:page_size][::-1]
+            has_next, has_previous = True, has_more
+
+        next_url = previous_url = None
+        if object_list:
+            if has_next:
+                next_url = self._build_url(CURSOR_NEXT, object_list[-1], keys)
+            if has_previous:
+                previous_url = self._build_url(CURSOR_PREVIOUS, object_list[0], keys)
+        page = KeysetPage(object_list, next_url, previous_url, approximate_count)
+        return None, page, object_list, page.has_other_pages()
@@ -0,0 +1,100 @@
+"""Indexed search for the list views, backed by PostgreSQL trigrams (pg_trgm).
+
+The `icontains` lookups render as `UPPER(column::text) LIKE UPPER(...)`, so the trigram
+indexes are built on that same expression, and PostgreSQL can use them for the '%x%' patterns
+instead of scanning the whole table. The indexes are maintained by the database itself on
+every insert and update. In other database backends (e.g. SQLite), or if the pg_trgm
+extension is not available in the server, all this is skipped and the search falls back to the
+plain (not ranked) lookups.
+"""
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.migrations.operations.base import Operation
+from django.db.models import FloatField
+from django.db.models.functions import Cast, Greatest
+
+
+def _has_trigrams(connection, catalog='pg_extension', column='extname'):
+    """Tell if the pg_trgm extension is in the given catalog of the database."""
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM {} WHERE {} = %s".format(catalog, column), [TrigramExtension().name])
+        return cursor.fetchone() is not None
+
+
+def is_search_indexed(connection):
+    """Tell if the search is backed by trigrams in the database of the given connection."""
+    # the extension is only created by the migrations, so it's checked once per connection
+    if not hasattr(connection, 'search_indexed'):
+        connection.search_indexed = _has_trigrams(connection)
+    return connection.search_indexed
+
+
+def get_search_rank(search_fields, search_value):
+    """Build the expression to rank the search results, the best match of all the fields.
+
+    Return None if there is nothing to rank (all the fields are searched by equality).
+    """
+    similarities = [
+        TrigramSimilarity(field, search_value)
+        for field, lookup in search_fields.items() if lookup != 'equal']
+    if not similarities:
+        return None
+    rank = similarities[0] if len(similarities) == 1 else Greatest(*similarities)
+    # as double precision, so the value can be compared exactly later (see the pagination)
+    return Cast(rank, FloatField())
+
+
+class AddSearchExtension(TrigramExtension):
+    """Install the pg_trgm extension, only if it's available in the server."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        available = _has_trigrams(
+            schema_editor.connection, catalog='pg_available_extensions', column='name')
+        if available:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+
+class AddSearchIndex(Operation):
+    """Create a trigram index for the `icontains` searches on a model's field."""
+
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, model_name, field_name):
+        self.model_name = model_name
+        self.field_name = field_name
+
+    def _get_table_column_name(self, app_label, schema_editor, state):
+        model = state.apps.get_model(app_label, self.model_name)
+        table = model._meta.db_table
+        column = model._meta.get_field(self.field_name).column
+        index_name = schema_editor._create_index_name(table, [column], suffix='_trgm')
+        return table, column, index_name
+
+    def state_forwards(self, app_label, state):
+        # the index is only in the database, the models are not affected
+        pass
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if not _has_trigrams(schema_editor.connection):
+            return
+        table, column, index_name = self._get_table_column_name(
+            app_label, schema_editor, to_state)
+        quote = schema_editor.quote_name
+        schema_editor.execute(
+            "CREATE INDEX IF NOT EXISTS {} ON {} USING gin ((UPPER({}::text)) gin_trgm_ops)"
+            .format(quote(index_name), quote(table), quote(column)))
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return
+        _, _, index_name = self._get_table_column_name(app_label, schema_editor, from_state)
+        schema_editor.execute(
+            "DROP INDEX IF EXISTS {}".format(schema_editor.quote_name(index_name)))
+
+    def describe(self):
+        return "Create search index on field {} of {}".format(self.field_name, self.model_name)
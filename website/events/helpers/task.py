@@ -178,6 +178,10 @@ def calculate_super_user_task():
     """
     tasks = []
 
+    # All the related objects used to describe the tasks are fetched in the same queries, so
+    # the quantity of queries doesn't depend on how many pending tasks are.
+    invoice_related = ('sponsoring__sponsor', 'sponsoring__sponsorcategory__event')
+
     # Sponsor not enabled.
     not_enabled_sponsors = Sponsor.objects.filter(enabled=False).all()
     for sponsor in not_enabled_sponsors:
@@ -185,7 +189,9 @@ def calculate_super_user_task():
 
     # Sponsoring without invoice attached.
     # TODO: move query into manager
-    unbilled_sponsorings = Sponsoring.objects.filter(invoice__isnull=True, close=False).all()
+    unbilled_sponsorings = Sponsoring.objects.filter(
+        invoice__isnull=True, close=False
+    ).select_related('sponsor', 'sponsorcategory__event')
     for sponsoring in unbilled_sponsorings:
         tasks.append(unblilled_sponsorings_task_builder(sponsoring))
 
@@ -196,9 +202,11 @@ def calculate_super_user_task():
         complete_payment=False
     ).annotate(
         unpay_amount=Max('amount') - Sum('invoice_affects__amount')
-    ).filter(unpay_amount__lt=0)
+    ).filter(unpay_amount__lt=0).select_related(*invoice_related)
 
+    to_complete_ids = set()
     for invoice in not_complete_with_affects_sum:
+        to_complete_ids.add(invoice.pk)
         tasks.append(invoices_to_complete_task_builder(invoice))
 
     # Invoice without set complete or partial payment
@@ -208,29 +216,31 @@ def calculate_super_user_task():
         partial_payment=False,
         complete_payment=False,
         sponsoring__close=False
-    ).distinct().all()
+    ).distinct().select_related(*invoice_related)
     for invoice in unpaid_invoices:
-        if invoice not in not_complete_with_affects_sum:
+        if invoice.pk not in to_complete_ids:
             tasks.append(unpayment_invoices_task_builder(invoice))
 
     unpaid_provider_expense = ProviderExpense.objects.filter(
         payment__isnull=True,
         cancelled_date__isnull=True,
-    ).all()
+    ).select_related('provider', 'event')
     for expense in unpaid_provider_expense:
         tasks.append(provider_payment_unfinish_task_builder(expense))
 
     # Unpaid organizer refunds
-    unpaid_organizer_refunds = OrganizerRefund.objects.filter(
+    unpaid_organizer_refunds = list(OrganizerRefund.objects.filter(
         payment__isnull=True,
         cancelled_date__isnull=True,
     ).values('organizer').annotate(
         Sum('amount'),
         Count('pk'),
         Max('created')
-    )
+    ))
+    organizers = Organizer.objects.select_related('user').in_bulk(
+        [data['organizer'] for data in unpaid_organizer_refunds])
     for data in unpaid_organizer_refunds:
-        organizer = Organizer.objects.get(pk=data['organizer'])
+        organizer = organizers[data['organizer']]
         time = data['created__max']
         count = data['pk__count']
         tasks.append(unpaid_organizer_refund_task_builder(organizer, count, time))
@@ -1,4 +1,6 @@
+from django.db import connections
 from django.db.models import Q
+from events.helpers.search import get_search_rank, is_search_indexed
 import functools
 import operator
 
@@ -12,4 +14,10 @@ def search_filtered_queryset(base_queryset, search_fields, search_value):
         filter_dict = {field_filter: search_value}
         filters.append(Q(**filter_dict))
     queryset = base_queryset.filter(functools.reduce(operator.or_, filters))
+
+    search_rank = get_search_rank(search_fields, search_value)
+    if search_rank is not None and is_search_indexed(connections[queryset.db]):
+        # best matches first, keeping the original order between those equally ranked
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+        queryset = queryset.annotate(search_rank=search_rank).order_by('-search_rank', *ordering)
     return queryset
@@ -1,10 +1,14 @@
 import datetime
 import decimal
+import json
 import os
+import threading
 
-from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
 
 from utils import gdrive, afip
+from utils.pipeline import StageTimings
 
 # https://drive.google.com/drive/u/0/folders/1EJjXYrwYxfUaBdOiswlP-xvUBlqrkAHl
 BASE_FOLDER = '1EJjXYrwYxfUaBdOiswlP-xvUBlqrkAHl'
@@ -13,6 +17,41 @@ BASE_FOLDER = '1EJjXYrwYxfUaBdOiswlP-xvUBlqrkAHl'
 SELLING_POINT = 9
 
 
+class _Journal:
+    """Keep track (in disk) of which invoices were already uploaded, to be able to resume."""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        self.found = os.path.exists(filepath)
+        if self.found:
+            with open(filepath, 'rt', encoding='utf8') as fh:
+                self.uploaded = set(json.load(fh)['uploaded'])
+        else:
+            self.uploaded = set()
+
+    def _save(self):
+        directory = os.path.dirname(self.filepath)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # enforce it, the directory may be there from before (and makedirs is affected by umask)
+        os.chmod(directory, 0o700)
+        temp_path = self.filepath + '.tmp'
+        with open(temp_path, 'wt', encoding='utf8') as fh:
+            json.dump({'uploaded': sorted(self.uploaded)}, fh)
+        os.replace(temp_path, self.filepath)
+
+    def start(self):
+        """Start it from scratch, so it's there even if nothing is uploaded."""
+        with self._lock:
+            self.uploaded = set()
+            self._save()
+
+    def mark_uploaded(self, invoice_number):
+        with self._lock:
+            self.uploaded.add(invoice_number)
+            self._save()
+
+
 class Command(BaseCommand):
     help = "Generate massive quantity of invoices"
 
@@ -22,6 +61,15 @@ class Command(BaseCommand):
         parser.add_argument('description', type=str)
         parser.add_argument('amount', type=decimal.Decimal)
         parser.add_argument('--force', action='store_true')
+        parser.add_argument(
+            '--resume', action='store_true',
+            help="Continue a previous run for the same invoices that was interrupted")
+        parser.add_argument(
+            '--batch-size', type=int, default=afip.BATCH_SIZE,
+            help="Max invoices to authorize in each request to AFIP")
+        parser.add_argument(
+            '--workers', type=int, default=afip.POST_PROCESS_WORKERS,
+            help="How many batches to post-process (PDF, gdrive) at the same time")
 
     def handle(self, *args, **options):
         quantity = options['quantity']
@@ -29,58 +77,93 @@ class Command(BaseCommand):
         description = options['description']
         amount = options['amount']
         force = options['force']
+        resume = options['resume']
+        ending_invoice_number = starting_invoice_number + quantity - 1
+
+        journal_name = "massive-invoices-{:04d}-{:08d}.json".format(
+            SELLING_POINT, starting_invoice_number)
+        journal = _Journal(os.path.join(settings.MASSIVE_INVOICES_JOURNAL_DIR, journal_name))
+        if resume and not journal.found:
+            raise CommandError(
+                "Can not resume, journal not found: {!r}".format(journal.filepath))
 
         # check AFIP
         last_verified = afip.verify_service(SELLING_POINT)
-        if starting_invoice_number != last_verified + 1:
-            print("Bad invoice number (given: {!r}, last authorized: {!r})".format(
-                starting_invoice_number, last_verified))
-            if force:
-                print("Even so going on, per --force")
-            else:
-                print("Quitting")
+        if resume:
+            if not starting_invoice_number - 1 <= last_verified <= ending_invoice_number:
+                print("Can not resume, last authorized {!r} is out of range ({} - {})".format(
+                    last_verified, starting_invoice_number, ending_invoice_number))
                 return
+            # those authorized before but not uploaded need to be recovered from AFIP
+            to_recover = [
+                invoice_number
+                for invoice_number in range(starting_invoice_number, last_verified + 1)
+                if invoice_number not in journal.uploaded]
+            first_to_authorize = last_verified + 1
+            print("Resuming: {} invoice(s) to recover, {} to authorize".format(
+                len(to_recover), ending_invoice_number - last_verified))
+        else:
+            if starting_invoice_number != last_verified + 1:
+                print("Bad invoice number (given: {!r}, last authorized: {!r})".format(
+                    starting_invoice_number, last_verified))
+                if force:
+                    print("Even so going on, per --force")
+                else:
+                    print("Quitting")
+                    return
+            to_recover = []
+            first_to_authorize = starting_invoice_number
+            journal.start()
 
-        records = []
         invoice_date = datetime.date.today()
-        for invoice_idx in range(quantity):
-            record = {
-                'invoice_number': starting_invoice_number + invoice_idx,
-                'amount': amount,
-                'quantity': 1,
-                'description': description,
-            }
-            records.append(record)
-
-        # convert the records to proper invoices, call AFIP, and upload
-        # PDF, all sequentially for better fail support
-        for rec in records:
-            invoice_number = rec['invoice_number']
-            print("Processing invoice {}".format(invoice_number))
 
+        def _build_invoice(invoice_number):
             invoice = afip.MassiveProductSellingInvoice(
                 selling_point=SELLING_POINT,
-                invoice_number=rec['invoice_number'],
+                invoice_number=invoice_number,
                 invoice_date=invoice_date)
-            invoice.add_item(
-                description=rec['description'], quantity=rec['quantity'], amount=rec['amount'])
+            invoice.add_item(description=description, quantity=1, amount=amount)
+            return invoice
 
-            try:
-                results = afip.process_invoices([invoice], SELLING_POINT)
-            except Exception:
-                print("PROBLEMS processing invoice", invoice)
-                raise
-
-            (result,) = results.values()  # only one invoice processed!
-            if not result['invoice_ok']:
-                print("    WARNING: invoice NOT authorized ok")
-                continue
+        timings = StageTimings()
 
+        def _post_process(invoice_number, pdf_path):
             # upload the invoice to google drive
-            gdrive.upload_invoice(result['pdf_path'], invoice_date, base_folder=BASE_FOLDER)
-            print("    uploaded to gdrive OK")
-
-            # invoice uploaded to gdrive and sent ok, don't need it here anymore
-            os.remove(result['pdf_path'])
+            with timings.measure('gdrive'):
+                gdrive.upload_invoice(pdf_path, invoice_date, base_folder=BASE_FOLDER)
+            journal.mark_uploaded(invoice_number)
+            print("    {}: uploaded to gdrive OK".format(invoice_number))
+
+            # invoice uploaded to gdrive, don't need it here anymore
+            os.remove(pdf_path)
+
+        results = {}
+        if to_recover:
+            print("Recovering {} invoice(s)".format(len(to_recover)))
+            invoices = [_build_invoice(invoice_number) for invoice_number in to_recover]
+            results.update(afip.process_invoices(
+                invoices, SELLING_POINT, post_process=_post_process, workers=options['workers'],
+                timings=timings, recovering=True))
+
+        # convert the records to proper invoices, call AFIP in batches, and upload the PDFs
+        invoices = [
+            _build_invoice(invoice_number)
+            for invoice_number in range(first_to_authorize, ending_invoice_number + 1)]
+        print("Processing {} invoice(s)".format(len(invoices)))
+        try:
+            results.update(afip.process_invoices_in_batches(
+                invoices, SELLING_POINT, batch_size=options['batch_size'],
+                post_process=_post_process, workers=options['workers'], timings=timings))
+        except Exception:
+            print("PROBLEMS processing invoices (use --resume to continue later)")
+            raise
+
+        for invoice_number, result in sorted(results.items()):
+            if not result['invoice_ok']:
+                print("WARNING: invoice {} NOT authorized ok".format(invoice_number))
 
+        print("Timings:")
+        for line in timings.report():
+            print("    " + line)
+        print("    " + afip.get_session().report())
         print("Done")
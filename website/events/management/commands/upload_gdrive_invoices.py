@@ -1,7 +1,9 @@
-import shutil
-import tempfile
+import concurrent.futures
+import hashlib
+import json
 import os
 import os.path
+import threading
 
 from django.core.management.base import BaseCommand
 from django.core.files.storage import default_storage
@@ -22,36 +24,55 @@ FOLDER_TYPE_NAMES = {
     Expense.INVOICE_TYPE_OTHER: 'Otros',
 }
 
-# to avoid messing with gdrive every time
-DIR_CACHE = {}
-FILES_CACHE = {}
+# what was already uploaded, to not mess with gdrive every time
+MANIFEST_FILE = "/tmp/gdrive_invoices_manifest.json"
 
+# how many files are transferred at the same time
+UPLOAD_WORKERS = 4
 
-def ensure_directory(explorer, parent_id, dirname):
-    """Ensure 'dirname' directory is present in 'parent'."""
-    cache_key = (parent_id, dirname)
-    if cache_key in DIR_CACHE:
-        return DIR_CACHE[cache_key]
 
-    for folder in explorer.list_folder(parent_id):
-        if folder['name'] == dirname:
-            folder_id = folder['id']
-            break
-    else:
-        print("Creating folder {!r} in parent {}".format(dirname, parent_id))
-        folder_id = explorer.create_folder(dirname, parent_id)
-    DIR_CACHE[cache_key] = folder_id
-    return folder_id
+class Manifest:
+    """Persistent record of the uploaded files, per folder.
 
+    Each file is recorded with its size and its modification time in the storage, a cheap
+    fingerprint (got without reading the file) that changes if the file is replaced.
+    """
 
-def get_files(explorer, folder_id):
-    """Get files info for a specific folder, cached."""
-    try:
-        files = FILES_CACHE[folder_id]
-    except KeyError:
-        files = {f['name']: f for f in explorer.list_folder(folder_id)}
-        FILES_CACHE[folder_id] = files
-    return files
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        try:
+            with open(filepath, 'rt', encoding='utf8') as fh:
+                self._data = json.load(fh)
+        except (OSError, ValueError):
+            self._data = {}
+
+    def _key(self, folder_id, filename):
+        return "{}/{}".format(folder_id, filename)
+
+    def get(self, folder_id, filename):
+        """Return the info of the uploaded file, None if not uploaded."""
+        with self._lock:
+            return self._data.get(self._key(folder_id, filename))
+
+    def add(self, folder_id, filename, size, modified):
+        """Record an uploaded file."""
+        with self._lock:
+            self._data[self._key(folder_id, filename)] = {
+                'name': filename, 'size': size, 'modified': modified}
+            temp_path = self.filepath + '.tmp'
+            with open(temp_path, 'wt', encoding='utf8') as fh:
+                json.dump(self._data, fh)
+            os.replace(temp_path, self.filepath)
+
+
+def _get_md5(storage_name):
+    """Get the hash of the stored file content (reading it all)."""
+    md5 = hashlib.md5()
+    with default_storage.open(storage_name) as fh:
+        for chunk in iter(lambda: fh.read(gdrive.UPLOAD_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 
 class Command(BaseCommand):
@@ -59,6 +80,8 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('yearmonth', type=str, nargs='?')
+        parser.add_argument('--workers', type=int, default=UPLOAD_WORKERS)
+        parser.add_argument('--manifest', type=str, default=MANIFEST_FILE)
 
     def handle(self, *args, **options):
         yearmonth = options['yearmonth']
@@ -80,15 +103,22 @@ class Command(BaseCommand):
         # we filter on the date the invoice was *uploaded* to the system, otherwise we'd miss
         # those ones that are created too late, which is not rare for refunds
         print("Filtering expenses for year={!r} month={!r}".format(year, month))
-        expenses = Expense.objects.filter(created__year=year, created__month=month).all()
+        expenses = (
+            Expense.objects.filter(created__year=year, created__month=month)
+            .select_related('event').all())
         print("Found {} expenses".format(len(expenses)))
 
-        explorer = gdrive.Explorer()
+        explorer = gdrive.get_explorer()
+        manifest = Manifest(options['manifest'])
+
+        # files in the folders (only listed for those not in the manifest)
+        folders_files = {}
 
+        to_upload = []
         for exp in expenses:
             # ensure needed parent directory is present in google drive
             yearmonth_foldername = "{}{:02d}".format(exp.invoice_date.year, exp.invoice_date.month)
-            base_folder_id = ensure_directory(explorer, BASE_FOLDER, yearmonth_foldername)
+            base_folder_id = explorer.get_folder_id(yearmonth_foldername, BASE_FOLDER)
 
             # build useful vars for later
             orig_name = os.path.basename(exp.invoice.name)
@@ -100,23 +130,41 @@ class Command(BaseCommand):
             print("Processing", repr(dest_filename))
 
             # ensure dir in google drive, see if file is already there
-            folder_id = ensure_directory(explorer, base_folder_id, dest_foldername_inv_type)
-            old_files = get_files(explorer, folder_id)
-            if dest_filename in old_files:
-                old_info = old_files[dest_filename]
-                if int(old_info['size']) == default_storage.size(exp.invoice.name):
-                    print("    ignoring, already updated")
-                    continue
-                print("    different size, uploading again")
-
-            # download the invoice content to a local temp file (flush at the end so all content is
-            # available externally, and only after using it close it, as it will then removed)
-            local_temp_fh = tempfile.NamedTemporaryFile(mode='wb')
-            remote_fh = default_storage.open(exp.invoice.name)
-            shutil.copyfileobj(remote_fh, local_temp_fh)
-            local_temp_fh.flush()
-
-            # upload
-            explorer.upload(local_temp_fh.name, folder_id, filename=dest_filename)
-            local_temp_fh.close()
-            print("    uploaded")
+            folder_id = explorer.get_folder_id(dest_foldername_inv_type, base_folder_id)
+            size = default_storage.size(exp.invoice.name)
+            modified = default_storage.get_modified_time(exp.invoice.name).isoformat()
+            uploaded = manifest.get(folder_id, dest_filename)
+            if uploaded is None:
+                if folder_id not in folders_files:
+                    folders_files[folder_id] = {
+                        f['name']: f for f in explorer.list_folder(folder_id)}
+                remote = folders_files[folder_id].get(dest_filename)
+                if remote is not None:
+                    # uploaded before having the manifest, only compare the content (reading
+                    # it) if the size matches, and record it for next time
+                    same_size = int(remote['size']) == size
+                    if same_size and remote.get('md5Checksum') == _get_md5(exp.invoice.name):
+                        manifest.add(folder_id, dest_filename, size, modified)
+                        print("    ignoring, already updated")
+                        continue
+                    print("    different content, uploading again")
+            elif (uploaded['size'], uploaded.get('modified')) == (size, modified):
+                print("    ignoring, already updated")
+                continue
+            else:
+                print("    file changed, uploading again")
+
+            to_upload.append((exp.invoice.name, size, modified, folder_id, dest_filename))
+
+        def _upload(storage_name, size, modified, folder_id, dest_filename):
+            # the content goes straight from the storage to gdrive (read only once)
+            with default_storage.open(storage_name) as remote_fh:
+                gdrive.get_explorer().upload_stream(remote_fh, folder_id, dest_filename)
+            manifest.add(folder_id, dest_filename, size, modified)
+            print("    uploaded {!r}".format(dest_filename))
+
+        print("Uploading {} files".format(len(to_upload)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            futures = [executor.submit(_upload, *info) for info in to_upload]
+        for future in futures:
+            future.result()
@@ -0,0 +1,24 @@
+from django.db import migrations
+
+from events.helpers.search import AddSearchIndex
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0013_invoice_real_final_amount'),
+        # the trigrams extension is created there
+        ('members', '0031_search_indexes'),
+    ]
+
+    operations = [
+        AddSearchIndex('event', 'name'),
+        AddSearchIndex('event', 'place'),
+        AddSearchIndex('sponsor', 'organization_name'),
+        AddSearchIndex('sponsor', 'document_number'),
+        AddSearchIndex('provider', 'organization_name'),
+        AddSearchIndex('provider', 'document_number'),
+        AddSearchIndex('expense', 'description'),
+        AddSearchIndex('organizer', 'first_name'),
+        AddSearchIndex('organizer', 'last_name'),
+    ]
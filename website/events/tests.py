@@ -1,11 +1,16 @@
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group, Permission
 from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
 from django.template.loader import render_to_string
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from events.constants import (
     CANT_CHANGE_CLOSE_EVENT_MESSAGE,
@@ -75,11 +80,33 @@ from events.models import (
     validate_cuit,
 )
 from io import StringIO
-from unittest.mock import patch
+from unittest.mock import ANY, patch
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import threading
+
+from tests.fakes import FakeDriveService
+from utils import gdrive
 
 User = get_user_model()
 test_task = Task('descripcion', 'url', timezone.now())
 
+# the files uploaded in the tests go to a temporary directory, not to the source tree
+_media_override = None
+
+
+def setUpModule():
+    global _media_override
+    _media_override = override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+    _media_override.enable()
+
+
+def tearDownModule():
+    _media_override.disable()
+    shutil.rmtree(_media_override.options['MEDIA_ROOT'], ignore_errors=True)
+
 
 class MockSuperUser:
     def has_perm(self, perm):
@@ -544,6 +571,54 @@ class SponsorViewsTest(TestCase, CustomAssertMethods):
         self.assertEqual(Sponsor.objects.all().count(), sponsors_count + 1)
         self.assertEqual(response.status_code, 302)
 
+    def _walk_sponsors_list(self, url):
+        """Get the names in all the pages of the list, forward and then backward."""
+        pages = []
+        while url is not None:
+            response = self.client.get(url)
+            page = response.context['page_obj']
+            pages.append([sponsor.organization_name for sponsor in page])
+            url = page.next_url and reverse('sponsor_list') + page.next_url
+        forward = pages
+
+        pages = []
+        url = page.previous_url and reverse('sponsor_list') + page.previous_url
+        while url is not None:
+            response = self.client.get(url)
+            page = response.context['page_obj']
+            pages.insert(0, [sponsor.organization_name for sponsor in page])
+            url = page.previous_url and reverse('sponsor_list') + page.previous_url
+        return forward, pages
+
+    def test_sponsors_list_paginated_by_cursor(self):
+        # some repeated names, to check that the pk is used to break the ties
+        names = ["sponsor {:02d}".format(idx // 2) for idx in range(40)]
+        for idx, name in enumerate(names):
+            Sponsor.objects.create(organization_name=name, document_number=str(idx))
+        self.client.login(username='organizer01', password='organizer01')
+
+        forward, backward = self._walk_sponsors_list(reverse('sponsor_list'))
+        self.assertEqual([len(page) for page in forward], [15, 15, 10])
+        self.assertEqual(sum(forward, []), names)
+        self.assertEqual(backward, forward[:-1])
+
+    def test_sponsors_list_paginated_keeps_search(self):
+        for idx in range(20):
+            Sponsor.objects.create(organization_name="sponsor {:02d}".format(idx),
+                                   document_number=str(idx))
+            Sponsor.objects.create(organization_name="other {:02d}".format(idx),
+                                   document_number=str(100 + idx))
+        self.client.login(username='organizer01', password='organizer01')
+
+        forward, _ = self._walk_sponsors_list(reverse('sponsor_list') + '?search=sponsor')
+        self.assertEqual(len(sum(forward, [])), 20)
+        self.assertTrue(all(name.startswith("sponsor") for name in sum(forward, [])))
+
+    def test_sponsors_list_invalid_cursor(self):
+        self.client.login(username='organizer01', password='organizer01')
+        response = self.client.get(reverse('sponsor_list'), {'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, 404)
+
 
 class SponsoringViewsTest(TestCase, CustomAssertMethods):
     def setUp(self):
@@ -895,6 +970,30 @@ class PendindTaskTest(TestCase, CustomAssertMethods):
         invoices_to_complete_builder_function.assert_called_once_with(self.invoice)
         self.assertFalse(unpayment_task_builder_function.called)
 
+    def test_super_user_tasks_constant_queries(self):
+        self.invoice.invoice_ok = True
+        self.invoice.save()
+        create_invoice_affect_set(self.invoice)
+        create_provider_expense()
+        create_organizer_refund()
+        with CaptureQueriesContext(connection) as queries_for_few:
+            tasks_few = calculate_super_user_task()
+
+        # more of everything
+        Sponsor.objects.create(
+            organization_name='OtherSponsor', document_number='20-11111111-2', enabled=False)
+        create_invoice_affect_set(self.invoice, total_amount=True)
+        create_provider_expense()
+        create_provider_expense()
+        OrganizerRefund.objects.create(
+            organizer=Organizer.objects.last(), amount='100', invoice_type='A',
+            invoice_date=timezone.now(), description='test', event=Event.objects.first())
+        with CaptureQueriesContext(connection) as queries_for_many:
+            tasks_many = calculate_super_user_task()
+
+        self.assertGreater(len(tasks_many), len(tasks_few))
+        self.assertEqual(len(queries_for_few), len(queries_for_many))
+
     @patch('events.helpers.task.provider_payment_unfinish_task_builder', return_value=test_task)
     def test_providerexpense_no_payment(self, provider_payment_unfinish_task_builder):
         expense = create_provider_expense()
@@ -1113,3 +1212,179 @@ class PendindSponsoringTest(TestCase, CustomAssertMethods):
         user = User.objects.get(username="organizer03")
         sponsoring = calculate_sponsoring_pending(user)
         self.assertEqual(len(sponsoring), 0)
+
+
+class GdriveTest(TestCase):
+    def setUp(self):
+        cache_file = tempfile.NamedTemporaryFile(suffix='.json')
+        self.addCleanup(cache_file.close)
+        self.cache_filepath = cache_file.name
+        self.service = FakeDriveService()
+        self.explorer = gdrive.Explorer(
+            service=self.service, folder_cache=gdrive.FolderCache(self.cache_filepath))
+
+    def test_folder_created_once(self):
+        folder_id = self.explorer.get_folder_id('202001', 'base')
+        self.assertEqual(self.service.requests, {'list': 1, 'create': 1})
+
+        # cached, no more requests
+        self.assertEqual(self.explorer.get_folder_id('202001', 'base'), folder_id)
+        self.assertEqual(self.service.requests, {'list': 1, 'create': 1})
+
+    def test_folder_created_once_concurrently(self):
+        # all the threads look for the folder at the same time (if they could)
+        barrier = threading.Barrier(4, timeout=1)
+        original_list = self.service.list
+
+        def _slow_list(**kwargs):
+            try:
+                barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+            return original_list(**kwargs)
+
+        def _get_folder_id():
+            explorer = gdrive.Explorer(service=self.service, folder_cache=folder_cache)
+            return explorer.get_folder_id('202001', 'base')
+
+        folder_cache = gdrive.FolderCache(self.cache_filepath)
+        with patch.object(self.service, 'list', side_effect=_slow_list):
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                futures = [executor.submit(_get_folder_id) for _ in range(4)]
+        self.assertEqual(len({future.result() for future in futures}), 1)
+        self.assertEqual(self.service.requests, {'list': 1, 'create': 1})
+
+    def test_folder_cache_persisted(self):
+        folder_id = self.explorer.get_folder_id('202001', 'base')
+
+        # other run, still no requests
+        explorer = gdrive.Explorer(
+            service=self.service, folder_cache=gdrive.FolderCache(self.cache_filepath))
+        self.assertEqual(explorer.get_folder_id('202001', 'base'), folder_id)
+        self.assertEqual(self.service.requests, {'list': 1, 'create': 1})
+
+    def test_folder_cache_expired(self):
+        folder_id = self.explorer.get_folder_id('202001', 'base')
+
+        # expired, the folder is found again (not created)
+        explorer = gdrive.Explorer(
+            service=self.service, folder_cache=gdrive.FolderCache(self.cache_filepath, ttl=-1))
+        self.assertEqual(explorer.get_folder_id('202001', 'base'), folder_id)
+        self.assertEqual(self.service.requests, {'list': 2, 'create': 1})
+
+    def test_upload_to_folder(self):
+        with tempfile.NamedTemporaryFile(suffix='.pdf') as fh:
+            fh.write(b'the invoice')
+            fh.flush()
+            gdrive.upload_to_folder(self.explorer, fh.name, '202001', 'base', filename='f.pdf')
+            gdrive.upload_to_folder(self.explorer, fh.name, '202001', 'base', filename='g.pdf')
+
+        folder_id = self.explorer.get_folder_id('202001', 'base')
+        uploaded = self.explorer.list_folder(folder_id)
+        self.assertEqual(sorted(item['name'] for item in uploaded), ['f.pdf', 'g.pdf'])
+        self.assertEqual(uploaded[0]['size'], str(len(b'the invoice')))
+        self.assertEqual(self.service.requests['create'], 3)  # the folder and the files
+
+
+class UploadGdriveInvoicesTest(TestCase):
+    def setUp(self):
+        create_user_set()
+        create_event_set(User.objects.first())
+
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        override = override_settings(MEDIA_ROOT=media_root.name)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.manifest_filepath = os.path.join(media_root.name, 'manifest.json')
+        self.service = FakeDriveService()
+        explorer = gdrive.Explorer(
+            service=self.service,
+            folder_cache=gdrive.FolderCache(os.path.join(media_root.name, 'folders.json')))
+        patcher = patch.object(gdrive, 'get_explorer', return_value=explorer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run(self):
+        call_command(
+            'upload_gdrive_invoices', timezone.now().strftime('%Y%m'),
+            '--manifest', self.manifest_filepath, stdout=StringIO())
+
+    def _uploaded(self):
+        return sorted(
+            (item['name'], item['content'])
+            for item in self.service.items.values() if 'content' in item)
+
+    def test_upload_and_skip_later(self):
+        for idx in range(3):
+            expense = create_provider_expense()
+            expense.invoice.save('invoice{}.pdf'.format(idx), ContentFile(b'content %d' % idx))
+
+        with patch('sys.stdout', new_callable=StringIO):
+            self._run()
+        uploaded = self._uploaded()
+        self.assertEqual(
+            sorted(content for _, content in uploaded),
+            [b'content 0', b'content 1', b'content 2'])
+
+        # nothing uploaded again, and folders not even listed
+        self.service.requests.clear()
+        with patch('sys.stdout', new_callable=StringIO):
+            self._run()
+        self.assertEqual(self._uploaded(), uploaded)
+        self.assertEqual(self.service.requests, {})
+
+    def test_upload_again_if_changed(self):
+        expense = create_provider_expense()
+        expense.invoice.save('invoice.pdf', ContentFile(b'content'))
+        with patch('sys.stdout', new_callable=StringIO):
+            self._run()
+
+        with default_storage.open(expense.invoice.name, 'wb') as fh:
+            fh.write(b'other longer content')
+        with patch('sys.stdout', new_callable=StringIO):
+            self._run()
+        self.assertEqual(
+            sorted(content for _, content in self._uploaded()),
+            [b'content', b'other longer content'])
+
+    def _replace_content(self, expense, content):
+        with default_storage.open(expense.invoice.name, 'wb') as fh:
+            fh.write(content)
+        # replaced later (the modification time may not change if done right away)
+        path = default_storage.path(expense.invoice.name)
+        later = os.path.getmtime(path) + 60
+        os.utime(path, (later, later))
+
+    def test_upload_again_if_replaced_same_size(self):
+        expense = create_provider_expense()
+        expense.invoice.save('invoice.pdf', ContentFile(b'content'))
+        with patch('sys.stdout', new_callable=StringIO):
+            self._run()
+
+        self._replace_content(expense, b'CONTENT')
+        with patch('sys.stdout', new_callable=StringIO):
+            self._run()
+        self.assertEqual(
+            sorted(content for _, content in self._uploaded()), [b'CONTENT', b'content'])
+
+    def test_uploaded_before_manifest(self):
+        expense = create_provider_expense()
+        expense.invoice.save('invoice.pdf', ContentFile(b'content'))
+        with patch('sys.stdout', new_callable=StringIO):
+            self._run()
+
+        # same content in gdrive, not uploaded again
+        os.remove(self.manifest_filepath)
+        with patch('sys.stdout', new_callable=StringIO):
+            self._run()
+        self.assertEqual(self._uploaded(), [(ANY, b'content')])
+
+        # same size, but other content
+        os.remove(self.manifest_filepath)
+        self._replace_content(expense, b'CONTENT')
+        with patch('sys.stdout', new_callable=StringIO):
+            self._run()
+        self.assertEqual(
+            sorted(content for _, content in self._uploaded()), [b'CONTENT', b'content'])
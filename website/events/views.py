@@ -54,6 +54,7 @@ from events.forms import (
 )
 from events.helpers.notifications import email_notifier
 from events.helpers.task import calculate_organizer_task, calculate_super_user_task
+from events.helpers.pagination import KeysetPaginationMixin
 from events.helpers.views import search_filtered_queryset
 from events.helpers.permissions import is_event_organizer, ORGANIZER_GROUP_NAME, is_organizer_user
 from events.models import (
@@ -132,11 +133,12 @@ def organizer_signup(request):
     return render(request, 'organizers/organizer_signup.html', {'form': form})
 
 
-class EventsListView(LoginRequiredMixin, generic.ListView):
+class EventsListView(LoginRequiredMixin, KeysetPaginationMixin, generic.ListView):
     model = Event
     context_object_name = 'event_list'
     template_name = 'events/event_list.html'
     paginate_by = DEFAULT_PAGINATION
+    ordering = ('-start_date', '-pk')
     search_fields = {
         'name': 'icontains',
         'place': 'icontains'
@@ -144,11 +146,10 @@ class EventsListView(LoginRequiredMixin, generic.ListView):
 
     def get_queryset(self):
         user = self.request.user
-        if user.is_superuser:
-            queryset = Event.objects.all()
-        else:
+        queryset = super(EventsListView, self).get_queryset()
+        if not user.is_superuser:
             organizers = Organizer.objects.filter(user=user)
-            queryset = Event.objects.filter(organizers__in=organizers)
+            queryset = queryset.filter(organizers__in=organizers)
 
         search_value = self.request.GET.get('search', None)
         if search_value and search_value != '':
@@ -347,11 +348,12 @@ class SponsorCategoryCreateView(PermissionRequiredMixin, generic.edit.CreateView
             return super(SponsorCategoryCreateView, self).handle_no_permission()
 
 
-class OrganizersListView(PermissionRequiredMixin, generic.ListView):
+class OrganizersListView(PermissionRequiredMixin, KeysetPaginationMixin, generic.ListView):
     model = Organizer
     context_object_name = 'organizer_list'
     template_name = 'organizers/organizers_list.html'
     paginate_by = DEFAULT_PAGINATION
+    ordering = ('-created', '-pk')
     permission_required = 'events.view_organizers'
     search_fields = {
         'first_name': 'icontains',
@@ -360,7 +362,7 @@ class OrganizersListView(PermissionRequiredMixin, generic.ListView):
     }
 
     def get_queryset(self):
-        queryset = Organizer.objects.all()
+        queryset = super(OrganizersListView, self).get_queryset()
         search_value = self.request.GET.get('search', None)
         if search_value and search_value != '':
             queryset = search_filtered_queryset(queryset, self.search_fields, search_value)
@@ -399,11 +401,12 @@ class OrganizerChangeView(PermissionRequiredMixin, generic.edit.UpdateView):
         return self.request.user == self.get_object().user
 
 
-class SponsorsListView(LoginRequiredMixin, generic.ListView):
+class SponsorsListView(LoginRequiredMixin, KeysetPaginationMixin, generic.ListView):
     model = Sponsor
     context_object_name = 'sponsor_list'
     template_name = 'sponsors/sponsors_list.html'
     paginate_by = DEFAULT_PAGINATION
+    ordering = ('organization_name', 'pk')
     search_fields = {
         'organization_name': 'icontains',
         'document_number': 'icontains'
@@ -585,15 +588,16 @@ class SponsoringCreateView(PermissionRequiredMixin, generic.edit.CreateView):
             return super(SponsoringCreateView, self).handle_no_permission()
 
 
-class SponsoringListView(PermissionRequiredMixin, generic.ListView):
+class SponsoringListView(PermissionRequiredMixin, KeysetPaginationMixin, generic.ListView):
     model = Sponsoring
     context_object_name = 'sponsoring_list'
     template_name = 'events/sponsorings/sponsoring_list.html'
     permission_required = 'events.change_event'
     paginate_by = DEFAULT_PAGINATION
+    ordering = ('sponsor__organization_name', 'pk')
 
     def get_queryset(self):
-        queryset = super(SponsoringListView, self).get_queryset()
+        queryset = super(SponsoringListView, self).get_queryset().select_related('sponsor')
         event = self._get_event()
         return queryset.filter(sponsorcategory__event=event)
 
@@ -808,11 +812,12 @@ class InvoiceAffectCreateView(PermissionRequiredMixin, generic.edit.CreateView):
             return super(InvoiceAffectCreateView, self).handle_no_permission()
 
 
-class ProvidersListView(LoginRequiredMixin, generic.ListView):
+class ProvidersListView(LoginRequiredMixin, KeysetPaginationMixin, generic.ListView):
     model = Provider
     context_object_name = 'provider_list'
     template_name = 'providers/providers_list.html'
     paginate_by = DEFAULT_PAGINATION
+    ordering = ('-created', '-pk')
     search_fields = {
         'organization_name': 'icontains',
         'document_number': 'icontains'
@@ -846,12 +851,13 @@ class ProviderDetailView(LoginRequiredMixin, generic.DetailView):
     template_name = 'providers/provider_detail.html'
 
 
-class ExpensesListView(PermissionRequiredMixin, generic.ListView):
+class ExpensesListView(PermissionRequiredMixin, KeysetPaginationMixin, generic.ListView):
     model = Expense
     context_object_name = 'expenses_list'
     template_name = 'events/expenses/expenses_list.html'
     permission_required = 'events.view_expenses'
     paginate_by = DEFAULT_PAGINATION
+    ordering = ('-created', '-pk')
     search_fields = {
         'description': 'icontains',
         'providerexpense__provider__organization_name': 'icontains',
@@ -1 +1,22 @@
 DEFAULT_PAGINATION = 15
+REPORT_DEFAULT_MONTHS = 24
+REPORT_MAX_MONTHS = 120
+
+# bulk mails: max to send per second, and how many times to retry on transient failures
+MAIL_MAX_PER_SECOND = 10
+MAIL_RETRIES = 3
+
+# outbound mails queue: how many are taken (and locked) at once by the worker
+MAIL_QUEUE_CHUNK = 20
+
+# seconds a worker has to send the mails it took, after that other worker can take them again
+MAIL_QUEUE_LEASE = 600
+
+# seconds to wait before retrying a mail that failed (it's retried up to MAIL_RETRIES times)
+MAIL_QUEUE_RETRY_DELAY = 300
+
+# seconds without any progress in a batch with pending mails to consider no worker is running
+MAIL_QUEUE_IDLE_ALERT = 120
+
+# up to which size (in bytes) the rendered letters are cached (where is in the settings)
+LETTER_CACHE_MAX_SIZE = 100 * 1024 * 1024
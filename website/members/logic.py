@@ -1,10 +1,28 @@
+import bisect
+import datetime
 import logging
+import tempfile
 from operator import itemgetter
 
-from members.models import Quota, Payment, PaymentStrategy, Member
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from members import utils
+from members.constants import (
+    MAIL_QUEUE_CHUNK, MAIL_QUEUE_IDLE_ALERT, MAIL_QUEUE_LEASE, MAIL_QUEUE_RETRY_DELAY,
+    MAIL_RETRIES)
+from members.models import (
+    Quota, QuotaLedger, Payment, PaymentStrategy, Member, OutboundMail)
 
 logger = logging.getLogger(__name__)
 
+# how much time the income for a closed month is kept in the cache (a payment can be
+# recorded later with an old timestamp, so don't trust it forever)
+INCOME_CACHE_TIMEOUT = 24 * 60 * 60
+
 
 def increment_year_month(year, month):
     """Add one month to the received year/month."""
@@ -37,105 +55,252 @@ def create_payment(
         comments='', custom_fee=None):
     """Create a payment from the given strategy to the specific member."""
     logger.info("Creating payment! member=%s amount=%r custom_fee=%r", member, amount, custom_fee)
-    # get the latest unpaid monthly fee
-    if first_unpaid is None:
-        try:
-            last_quota = Quota.objects.filter(member=member).latest()
-        except Quota.DoesNotExist:
-            first_unpaid = (member.first_payment_year, member.first_payment_month)
-        else:
-            first_unpaid = increment_year_month(last_quota.year, last_quota.month)
-    first_unpaid_year, first_unpaid_month = first_unpaid
+    payment_info = {
+        'member': member,
+        'timestamp': timestamp,
+        'amount': amount,
+        'strategy': payment_strategy,
+        'first_unpaid': first_unpaid,
+        'comments': comments,
+        'custom_fee': custom_fee,
+    }
+    (payment,) = create_payments_in_bulk([payment_info])
+    return payment
 
-    # calculate how many fees covers the amount, supporting not being exact but for a very
-    # small difference
-    fee = member.category.fee if custom_fee is None else custom_fee
+
+def _get_quotas_quantity(amount, fee):
+    """Calculate how many fees covers the amount.
+
+    It supports the amount not being exact, but only for a very small difference.
+    """
     paying_quant_real = amount / fee
     paying_quant_int = int(round(paying_quant_real))
     if abs(paying_quant_real - paying_quant_int) > paying_quant_int * 0.01:
         raise ValueError("Paying amount too inexact! amount={} fee={}".format(amount, fee))
+    return paying_quant_int
+
+
+def create_payments_in_bulk(payments_info):
+    """Create several payments (and their quotas), all together in the same transaction.
+
+    Each payment info is a dict with the member, timestamp, amount and strategy of the payment,
+    and optionally the first unpaid year/month (to override which quotas are paid), comments
+    and a custom fee (instead of the member's category fee).
+
+    The payments are created in the given order, the quotas paid by each one of them start
+    after the ones paid by the previous payments for the same member. Everything is inserted
+    with only a few queries, no matter how many payments are created.
+    """
+    payments_info = list(payments_info)
+    if not payments_info:
+        return []
+
+    with transaction.atomic():
+        # lock the members (always in the same order), so concurrent payments don't step on
+        # each other, not even when creating the ledger for a member that doesn't have one
+        members_ids = {info['member'].id for info in payments_info}
+        list(Member.objects.select_for_update().filter(
+            id__in=members_ids).order_by('id').values_list('id', flat=True))
+        ledgers = {
+            ledger.member_id: ledger
+            for ledger in QuotaLedger.objects.select_for_update().filter(member_id__in=members_ids)
+        }
+
+        # build the ledgers for those members that don't have one yet
+        new_ledgers = {member_id: set() for member_id in members_ids if member_id not in ledgers}
+        if new_ledgers:
+            quotas = Quota.objects.filter(
+                member_id__in=new_ledgers).values_list('member_id', 'year', 'month')
+            for member_id, year, month in quotas:
+                new_ledgers[member_id].add((year, month))
+            for member_id, yearmonths in new_ledgers.items():
+                ledger = QuotaLedger(member_id=member_id)
+                ledger.set_paid(yearmonths)
+                ledgers[member_id] = ledger
 
-    # create the payment itself
-    payment = Payment.objects.create(
-        timestamp=timestamp, amount=amount, strategy=payment_strategy, comments=comments)
+        payments = []
+        yearmonths_per_payment = []
+        for info in payments_info:
+            member = info['member']
+            custom_fee = info.get('custom_fee')
+            fee = member.category.fee if custom_fee is None else custom_fee
+            paying_quant = _get_quotas_quantity(info['amount'], fee)
 
-    # create the monthly fee(s)
-    yearmonths = get_year_month_range(first_unpaid_year, first_unpaid_month, paying_quant_int)
-    for year, month in yearmonths:
-        Quota.objects.create(payment=payment, month=month, year=year, member=member)
+            # get the latest unpaid monthly fee
+            ledger = ledgers[member.id]
+            first_unpaid = info.get('first_unpaid')
+            if first_unpaid is None:
+                if ledger.last_paid_year is None:
+                    first_unpaid = (member.first_payment_year, member.first_payment_month)
+                else:
+                    first_unpaid = increment_year_month(
+                        ledger.last_paid_year, ledger.last_paid_month)
+            first_unpaid_year, first_unpaid_month = first_unpaid
 
+            yearmonths = list(
+                get_year_month_range(first_unpaid_year, first_unpaid_month, paying_quant))
+            ledger.add_paid(yearmonths)
+            yearmonths_per_payment.append(yearmonths)
 
-def create_recurring_payments(recurring_records, custom_fee=None):
-    """Create payments and quotas from external recurring payments."""
-    # group payments per payer and order them, avoiding duplicated payments
+            payments.append(Payment(
+                timestamp=info['timestamp'], amount=info['amount'], strategy=info['strategy'],
+                comments=info.get('comments', '')))
+
+        # create the payments themselves, and the monthly fee(s)
+        Payment.objects.bulk_create(payments)
+        quotas = []
+        for info, payment, yearmonths in zip(payments_info, payments, yearmonths_per_payment):
+            for year, month in yearmonths:
+                quotas.append(
+                    Quota(payment=payment, month=month, year=year, member=info['member']))
+        Quota.objects.bulk_create(quotas)
+
+        # store the updated ledgers
+        QuotaLedger.objects.bulk_create(
+            [ledger for ledger in ledgers.values() if ledger.pk is None])
+        modified = timezone.now()
+        old_ledgers = [
+            ledger for member_id, ledger in ledgers.items() if member_id not in new_ledgers]
+        for ledger in old_ledgers:
+            ledger.modified = modified
+        QuotaLedger.objects.bulk_update(
+            old_ledgers, ['first_paid_year', 'first_paid_month', 'last_paid_year',
+                          'last_paid_month', 'paid_quantity', 'paid_bitmap', 'modified'])
+
+    _forget_income([payment.timestamp for payment in payments])
+    return payments
+
+
+def rebuild_ledger(member):
+    """Build the member's ledger from scratch, from the stored quotas."""
+    return QuotaLedger.rebuild(member.id)
+
+
+def _group_recurring_records(recurring_records):
+    """Group the records per payer, sorted by timestamp, avoiding duplicated payments."""
     grouped = {}
     for record in recurring_records:
-        payer_records = grouped.setdefault(record['payer_id'], [])
-        # inefficient to walk on all the items everytime, but these are really short lists
-        this_payment_id = record['id_helper']['payment_id']
-        if any(this_payment_id == r['id_helper']['payment_id'] for r in payer_records):
-            # duplicated! ignoring
-            continue
-        payer_records.append(record)
-    for records in grouped.values():
-        records.sort(key=itemgetter('timestamp'))
+        payer_records = grouped.setdefault(record['payer_id'], {})
+        # keep the first one if duplicated
+        payer_records.setdefault(record['id_helper']['payment_id'], record)
+    return {
+        payer: sorted(payer_records.values(), key=itemgetter('timestamp'))
+        for payer, payer_records in grouped.items()
+    }
+
+
+def _get_remaining_payments(retrieved_payments, last_payment_recorded, since=None):
+    """Return which of the (sorted) retrieved payments are not recorded yet.
+
+    None is returned if all of them are older than the last payment recorded. The `since`
+    is from when the payments were retrieved (None if from the beginning of the records).
+    """
+    if last_payment_recorded is None:
+        # no payments found, need to record all the retrieved payments
+        return retrieved_payments
+
+    # detect which is last one recorded
+    timestamps = [payment['timestamp'] for payment in retrieved_payments]
+    pos = bisect.bisect_left(timestamps, last_payment_recorded.timestamp)
+    if pos == len(timestamps):
+        # no payment match found! all informed are old (it's just Mercadopago
+        # failing) otherwise it would have been logged with warning below
+        logger.debug(
+            "Payment not found to match %s: %s", last_payment_recorded, retrieved_payments)
+        return
+
+    if timestamps[pos] == last_payment_recorded.timestamp:
+        # found! need to record the remaining ones
+        remaining_payments = retrieved_payments[pos + 1:]
+        logger.debug("Found payment limit (remaining: %d)", len(remaining_payments))
+    elif since is not None and last_payment_recorded.timestamp < since:
+        # the last one recorded is before the retrieved period, so all are new
+        remaining_payments = retrieved_payments
+        logger.debug(
+            "Last payment recorded is before %s (remaining: %d)", since, len(remaining_payments))
+    else:
+        # found a newer one without finding first the exact one! this is Mercadago
+        # returning bullshit
+        remaining_payments = retrieved_payments[pos:]
+        logger.warning(
+            "Found exceeding payment limit! last recorded: %s (remaining: %d)",
+            last_payment_recorded, len(remaining_payments))
+    return remaining_payments
+
+
+def create_recurring_payments(recurring_records, custom_fee=None, since=None):
+    """Create payments and quotas from external recurring payments.
+
+    The `since` is from when the records were retrieved (None if from the beginning). Return
+    the records that could not be processed but may be in a later run (the payer, or its
+    member, is still not in our DB); those with problems that need a manual fix (e.g. the
+    payer has more than one member) are not returned, just logged.
+    """
+    grouped = _group_recurring_records(recurring_records)
+
+    # get all the needed strategies, latest payment for each of them, and related members,
+    # all at once for all the payers
+    strategies = {}
+    payers_strategies = PaymentStrategy.objects.filter(
+        platform=PaymentStrategy.MERCADO_PAGO, id_in_platform__in=grouped).select_related('patron')
+    for strategy in payers_strategies:
+        strategies.setdefault(strategy.id_in_platform, []).append(strategy)
+
+    last_payments_ids = Payment.objects.filter(
+        strategy__in=payers_strategies).values('strategy').annotate(last_id=Max('pk'))
+    last_payments = {
+        payment.strategy_id: payment
+        for payment in Payment.objects.filter(pk__in=last_payments_ids.values('last_id'))
+    }
+
+    members = {}
+    payers_members = Member.objects.filter(
+        patron__in=[s.patron_id for s in payers_strategies]
+    ).select_related('category', 'patron', 'person', 'organization')
+    for member in payers_members:
+        members.setdefault(member.patron_id, []).append(member)
 
     count_without_new_payments = 0
+    to_create = []
+    skipped = []
     for payer, retrieved_payments in grouped.items():
         logger.debug("Processing payments for payer %r: %d", payer, len(retrieved_payments))
 
         # get strategy for the payer
-        try:
-            strategy = PaymentStrategy.objects.get(
-                platform=PaymentStrategy.MERCADO_PAGO, id_in_platform=payer)
-        except PaymentStrategy.DoesNotExist:
+        payer_strategies = strategies.get(payer, [])
+        if not payer_strategies:
             payment = retrieved_payments[0]
             logger.error(
                 "PaymentStrategy not found for payer %r: %s (%d payments)",
                 payer, payment, len(retrieved_payments))
+            skipped.extend(retrieved_payments)
             continue
+        if len(payer_strategies) > 1:
+            logger.error("Found more than one PaymentStrategy for payer %r", payer)
+            continue
+        (strategy,) = payer_strategies
 
         # get latest payment done with this strategy
-        last_payment_recorded = Payment.objects.filter(strategy=strategy).last()
+        last_payment_recorded = last_payments.get(strategy.id)
         logger.debug("Last payment recorded: %s", last_payment_recorded)
 
-        if last_payment_recorded is None:
-            # no payments found, need to record all the retrieved payments
-            remaining_payments = retrieved_payments
-        else:
-            # detect which is last one recorded
-            for pos, retrieved_payment in enumerate(retrieved_payments):
-                logger.debug("Comparing retrieved: %d: %s", pos, retrieved_payment)
-                if retrieved_payment['timestamp'] == last_payment_recorded.timestamp:
-                    # found! need to record the remaining ones
-                    remaining_payments = retrieved_payments[pos + 1:]
-                    logger.debug(
-                        "Found payment limit (remaining: %d)", len(remaining_payments))
-                    break
-                if retrieved_payment['timestamp'] > last_payment_recorded.timestamp:
-                    # found a newer one without finding first the exact one! this is Mercadago
-                    # returning bullshit
-                    remaining_payments = retrieved_payments[pos:]
-                    logger.warning(
-                        "Found exceeding payment limit! last recorded: %s (remaining: %d)",
-                        last_payment_recorded, len(remaining_payments))
-                    break
-            else:
-                # no payment match found! all informed are old (it's just Mercadopago
-                # failing) otherwise it would have been logged with warning above
-                logger.debug(
-                    "Payment not found to match %s: %s",
-                    last_payment_recorded, retrieved_payments)
-                continue
+        remaining_payments = _get_remaining_payments(
+            retrieved_payments, last_payment_recorded, since=since)
+        if remaining_payments is None:
+            continue
 
         # get the member from the patron
-        try:
-            member = Member.objects.get(patron=strategy.patron)
-        except Member.MultipleObjectsReturned:
+        patron_members = members.get(strategy.patron_id, [])
+        if not patron_members:
+            logger.error("Member not found for Patron: %s", strategy.patron)
+            skipped.extend(remaining_payments)
+            continue
+        if len(patron_members) > 1:
             # for recurring payments we still do not support having
             # more than one member for the given patron
             logger.error("Found more than one member for Patron: %s", strategy.patron)
             continue
+        (member,) = patron_members
 
         if remaining_payments:
             logger.info(
@@ -153,31 +318,28 @@ def create_recurring_payments(recurring_records, custom_fee=None):
                 if this_custom_fee != member.category.fee:
                     logger.warning(
                         "Payment with strange amount for member %s: %s", member, payment_info)
-            create_payment(
-                member, payment_info['timestamp'], payment_info['amount'],
-                strategy, custom_fee=this_custom_fee)
+            to_create.append({
+                'member': member,
+                'timestamp': payment_info['timestamp'],
+                'amount': payment_info['amount'],
+                'strategy': strategy,
+                'custom_fee': this_custom_fee,
+            })
 
-    logger.info("Processed %d payers without new payments", count_without_new_payments)
+    create_payments_in_bulk(to_create)
+    logger.info(
+        "Processed %d payers without new payments, created %d payments",
+        count_without_new_payments, len(to_create))
+    return skipped
 
 
-def get_debt_state(member, limit_year, limit_month):
-    """Return if the member is in debt, and the missing quotas.
-
-    If the member has a first payment, the quotas verified are from that first payment up
-    to the given year/month limit (including).
-
-    If the member never paid, the registration date is used, and that month is also included.
-    """
+def _calculate_debt(member, yearmonths_paid, limit_year, limit_month):
+    """Return the missing quotas for the member, given the year/months already paid."""
     if member.first_payment_year is None:
         # never paid! using registration date to start with
-        yearmonths_paid = set()
         year_to_check = member.registration_date.year
         month_to_check = member.registration_date.month
     else:
-        # build a set for the year/month of paid quotas
-        quotas = Quota.objects.filter(member=member).all()
-        yearmonths_paid = {(q.year, q.month) for q in quotas}
-
         year_to_check = member.first_payment_year
         month_to_check = member.first_payment_month
 
@@ -200,3 +362,254 @@ def get_debt_state(member, limit_year, limit_month):
             break
 
     return sorted(should_have_paid - yearmonths_paid)
+
+
+def get_debt_state(member, limit_year, limit_month, yearmonths_paid=None):
+    """Return if the member is in debt, and the missing quotas.
+
+    If the member has a first payment, the quotas verified are from that first payment up
+    to the given year/month limit (including).
+
+    If the member never paid, the registration date is used, and that month is also included.
+
+    The year/months already paid can be given (e.g. if the quotas were already retrieved),
+    otherwise they are taken from the database.
+    """
+    if member.first_payment_year is None:
+        yearmonths_paid = set()
+    elif yearmonths_paid is None:
+        # build a set for the year/month of paid quotas
+        try:
+            yearmonths_paid = QuotaLedger.objects.get(member=member).get_paid()
+        except QuotaLedger.DoesNotExist:
+            quotas = Quota.objects.filter(member=member).all()
+            yearmonths_paid = {(q.year, q.month) for q in quotas}
+
+    return _calculate_debt(member, yearmonths_paid, limit_year, limit_month)
+
+
+def get_debt_states(members, limit_year, limit_month):
+    """Return the missing quotas for all the given members, in a single query.
+
+    It's the same as calling `get_debt_state` for each member, but getting all the paid
+    quotas at once from the ledgers (only going to the quotas themselves for those members
+    without a ledger); the result is a dict with the debt for each member id.
+    """
+    members = list(members)
+    paying_ids = [m.id for m in members if m.first_payment_year is not None]
+
+    yearmonths_paid = {
+        ledger.member_id: ledger.get_paid()
+        for ledger in QuotaLedger.objects.filter(member_id__in=paying_ids)
+    }
+    without_ledger = [member_id for member_id in paying_ids if member_id not in yearmonths_paid]
+    if without_ledger:
+        quotas = (
+            Quota.objects.filter(member_id__in=without_ledger)
+            .values_list('member_id', 'year', 'month'))
+        for member_id, year, month in quotas:
+            yearmonths_paid.setdefault(member_id, set()).add((year, month))
+
+    return {
+        member.id: _calculate_debt(
+            member, yearmonths_paid.get(member.id, set()), limit_year, limit_month)
+        for member in members
+    }
+
+
+def _income_cache_key(year, month):
+    return "members-income-{}-{:02d}".format(year, month)
+
+
+def _forget_income(timestamps):
+    """Remove from the cache the income for the months of the given timestamps."""
+    keys = set()
+    for timestamp in timestamps:
+        if timezone.is_aware(timestamp):
+            timestamp = timezone.localtime(timestamp)
+        keys.add(_income_cache_key(timestamp.year, timestamp.month))
+    if keys:
+        cache.delete_many(keys)
+
+
+def get_income_per_month(yearmonths):
+    """Return the money income (sum of all the payments) for each of the given year/months.
+
+    All the months are retrieved from the DB in a single query; the income for those months
+    already closed is cached, so only the current month needs to be calculated every time.
+    """
+    currently = timezone.localtime(timezone.now())
+    current_yearmonth = (currently.year, currently.month)
+
+    # get from the cache the months already closed
+    closed_keys = {
+        _income_cache_key(year, month): (year, month)
+        for year, month in yearmonths if (year, month) < current_yearmonth}
+    income = {closed_keys[key]: value for key, value in cache.get_many(closed_keys).items()}
+
+    missing = [yearmonth for yearmonth in yearmonths if yearmonth not in income]
+    if missing:
+        first_year, first_month = min(missing)
+        last_year, last_month = increment_year_month(*max(missing))
+        since = timezone.make_aware(datetime.datetime(first_year, first_month, 1))
+        until = timezone.make_aware(datetime.datetime(last_year, last_month, 1))
+        payments = (
+            Payment.objects.filter(timestamp__gte=since, timestamp__lt=until)
+            .annotate(month=TruncMonth('timestamp'))
+            .values('month')
+            .annotate(total=Sum('amount'))
+            .order_by())
+        totals = {(p['month'].year, p['month'].month): p['total'] for p in payments}
+
+        to_cache = {}
+        for yearmonth in missing:
+            income[yearmonth] = totals.get(yearmonth, 0)
+            if yearmonth < current_yearmonth:
+                to_cache[_income_cache_key(*yearmonth)] = income[yearmonth]
+        cache.set_many(to_cache, INCOME_CACHE_TIMEOUT)
+
+    return income
+
+
+def build_queued_mail(batch, member, subject, text, cc=None, attach_letter=False):
+    """Build (not saved) a mail to a member to be sent later by the queue worker."""
+    return OutboundMail(
+        batch=batch, member=member, subject=subject, text=text,
+        cc=",".join(cc or []), attach_letter=attach_letter)
+
+
+def build_queued_missing_info_mail(batch, member):
+    """Build (not saved) the mail to a member with all the missing information.
+
+    The signed letter, if missing, is generated when the mail is sent. If the mail can not be
+    built, it's recorded in the batch with the error.
+    """
+    subject = utils.MISSING_INFO_MAIL_SUBJECT
+    try:
+        text, missing_letter = utils.render_missing_info_mail(member)
+    except Exception as err:
+        logger.exception(
+            "Problems building missing info email [%s] to member %s: %r", batch, member, err)
+        return OutboundMail(
+            batch=batch, member=member, subject=subject, status=OutboundMail.ERROR,
+            error=repr(err))
+    return build_queued_mail(batch, member, subject, text, attach_letter=missing_letter)
+
+
+def _generate_letters(queued_mails, letters_dir):
+    """Generate all the letters needed by the queued mails at once; return them by mail id.
+
+    If something fails nothing is returned, and each mail will try to produce its letter.
+    """
+    needing = [queued for queued in queued_mails if queued.attach_letter]
+    try:
+        filepaths = utils.generate_member_letters(
+            [queued.member for queued in needing], letters_dir)
+    except Exception as err:
+        logger.warning("Problems generating the letters for %d mails: %r", len(needing), err)
+        return {}
+    return {queued.id: filepath for queued, filepath in zip(needing, filepaths)}
+
+
+def _send_queued_mail(queued, dispatcher, letters_dir, letter_filepath=None):
+    """Send a queued mail, recording the result in it.
+
+    If it fails it's left pending to be retried later, up to MAIL_RETRIES attempts.
+    """
+    queued.attempts += 1
+    try:
+        if queued.attach_letter and letter_filepath is None:
+            letter_filepath = utils.generate_member_letter(queued.member, letters_dir)
+        cc = queued.cc.split(",") if queued.cc else None
+        mail = utils.build_email(
+            queued.member, queued.subject, queued.text, attachment=letter_filepath, cc=cc)
+        dispatcher.send(mail)
+    except Exception as err:
+        logger.exception(
+            "Problems sending email [%s] to member %s (attempt %d): %r",
+            queued.batch, queued.member, queued.attempts, err)
+        queued.error = repr(err)
+        if queued.attempts < MAIL_RETRIES:
+            queued.status = OutboundMail.PENDING
+            queued.retry_at = timezone.now() + datetime.timedelta(seconds=MAIL_QUEUE_RETRY_DELAY)
+        else:
+            queued.status = OutboundMail.ERROR
+            queued.retry_at = None
+    else:
+        queued.status = OutboundMail.SENT
+        queued.sent_at = timezone.now()
+        queued.retry_at = None
+    queued.save(update_fields=['attempts', 'status', 'error', 'sent_at', 'retry_at', 'modified'])
+
+
+def _claim_queued_mails(chunk_size):
+    """Take a chunk of the mails ready to be sent, marking them as being sent by this worker.
+
+    Those mails being sent by a worker that didn't finish in its lease time (e.g. it was
+    killed) are taken again.
+    """
+    current = timezone.now()
+    ready = (
+        Q(status=OutboundMail.PENDING, retry_at__isnull=True)
+        | Q(status=OutboundMail.PENDING, retry_at__lte=current)
+        | Q(status=OutboundMail.SENDING, retry_at__lte=current))
+    with transaction.atomic():
+        ids = list(
+            OutboundMail.objects
+            .select_for_update(skip_locked=True)
+            .filter(ready)
+            .order_by('id')
+            .values_list('id', flat=True)[:chunk_size])
+        OutboundMail.objects.filter(id__in=ids).update(
+            status=OutboundMail.SENDING, modified=current,
+            retry_at=current + datetime.timedelta(seconds=MAIL_QUEUE_LEASE))
+    return list(
+        OutboundMail.objects.filter(id__in=ids)
+        .select_related('member__category', 'member__person', 'member__organization')
+        .order_by('id'))
+
+
+def send_queued_mails(dispatcher, chunk_size=MAIL_QUEUE_CHUNK):
+    """Send all the mails ready in the queue, through the given dispatcher.
+
+    The mails are claimed by chunks in a short transaction, so several workers can run at the
+    same time without sending twice the same mail; then they are sent (outside that
+    transaction) saving each result on its own, so nothing already sent is lost if the worker
+    dies in the middle. The letters needed by each chunk are generated all together.
+    Return how many mails were processed.
+    """
+    processed = 0
+    while True:
+        claimed = _claim_queued_mails(chunk_size)
+        if not claimed:
+            return processed
+        with tempfile.TemporaryDirectory() as letters_dir:
+            letters = _generate_letters(claimed, letters_dir)
+            for queued in claimed:
+                _send_queued_mail(queued, dispatcher, letters_dir, letters.get(queued.id))
+        processed += len(claimed)
+
+
+def get_mail_batch_status(batch):
+    """Return how many mails are in each status for the batch, those with errors, and if idle.
+
+    The batch is idle when it has pending mails but none of its mails was touched (by a worker)
+    for a while, which normally means that no worker is running.
+    """
+    counts = {status: 0 for status, _ in OutboundMail.STATUS_CHOICES}
+    last_activity = None
+    for item in (OutboundMail.objects.filter(batch=batch)
+                 .values('status').annotate(Count('id'), Max('modified'), Max('retry_at'))):
+        counts[item['status']] = item['id__count']
+        # a retry or a lease in the future is activity to be expected
+        for moment in (item['modified__max'], item['retry_at__max']):
+            if moment is not None and (last_activity is None or moment > last_activity):
+                last_activity = moment
+    idle_limit = timezone.now() - datetime.timedelta(seconds=MAIL_QUEUE_IDLE_ALERT)
+    waiting = counts[OutboundMail.PENDING] + counts[OutboundMail.SENDING]
+    idle = waiting > 0 and last_activity < idle_limit
+
+    errors = (
+        OutboundMail.objects.filter(batch=batch, status=OutboundMail.ERROR)
+        .select_related('member__person', 'member__organization').order_by('id'))
+    return counts, list(errors), idle
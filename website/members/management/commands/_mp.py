@@ -1,44 +1,193 @@
+import concurrent.futures
+import datetime
+import json
 import logging
 import os
 
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from mercadopago import SDK
 
 LIMIT = 500
 
+# name of the checkpoint for the recurring payments import
+CHECKPOINT_NAME = 'mercadopago-payments'
+
+# how many pages are retrieved at the same time
+FETCH_WORKERS = 4
+
+# from where to start when there is no checkpoint to continue from, which is also the
+# furthest we go back even if the checkpoint is older
+DEFAULT_BEGIN_DATE = 'NOW-3MONTHS'
+MAX_LOOKBACK = datetime.timedelta(days=90)
+
+# how much we go back from the checkpoint when retrieving, so records that Mercadopago
+# exposes a little late (or with a slightly different approval time) are not lost; they
+# are re-processed, but payments already recorded are skipped later
+CHECKPOINT_OVERLAP = datetime.timedelta(days=7)
+
 logger = logging.getLogger('mercadopago')
 
 
-def get_raw_mercadopago_info():
-    """Get records from Mercadopago API.
+class RecordedSDK:
+    """Stand-in for the Mercadopago SDK that serves previously recorded records.
 
-    As different hits bring different "total" values indicated, we record what is the
-    max of those, and only stop hitting when we get no results from one of those endpoints.
+    It's used for tests and to work offline (setting MERCADOPAGO_RECORDED_RESPONSES to
+    a JSON file with the list of payment records as returned by the API).
     """
+
+    def __init__(self, records):
+        self.records = records
+        self.searches = []
+
+    @classmethod
+    def from_file(cls, filepath):
+        with open(filepath, 'rt', encoding='utf8') as fh:
+            return cls(json.load(fh))
+
+    def payment(self):
+        return self
+
+    def search(self, filters):
+        self.searches.append(dict(filters))
+
+        records = self.records
+        begin_date = filters.get('begin_date', DEFAULT_BEGIN_DATE)
+        if not begin_date.startswith('NOW'):
+            begin_date = parse_datetime(begin_date)
+            records = [r for r in records if parse_datetime(r['date_approved']) >= begin_date]
+
+        offset = filters['offset']
+        limit = filters['limit']
+        paging = {'total': len(records), 'offset': offset, 'limit': limit}
+        return {
+            'status': 200,
+            'response': {'results': records[offset:offset + limit], 'paging': paging},
+        }
+
+
+def _get_sdk():
+    """Get the real SDK, or the recorded stand-in if configured so."""
+    recorded_filepath = os.getenv('MERCADOPAGO_RECORDED_RESPONSES')
+    if recorded_filepath:
+        logger.debug('Using recorded responses from %r', recorded_filepath)
+        return RecordedSDK.from_file(recorded_filepath)
+
     logger.debug('Connecting with mercadopago')
     auth_token = os.getenv('MERCADOPAGO_AUTH_TOKEN')
-    mp = SDK(auth_token)
+    return SDK(auth_token)
+
+
+def _get_oldest_begin():
+    return timezone.now() - MAX_LOOKBACK
+
+
+def get_begin_timestamp(checkpoint):
+    """Return from when records are retrieved according to the checkpoint.
+
+    It's never before the default (the last months), even if the checkpoint is older.
+    """
+    oldest = _get_oldest_begin()
+    if checkpoint is None or checkpoint.last_timestamp is None:
+        return oldest
+    return max(checkpoint.last_timestamp - CHECKPOINT_OVERLAP, oldest)
+
+
+def get_begin_date(checkpoint):
+    """Return from where to start retrieving records, according to the given checkpoint."""
+    if checkpoint is None or checkpoint.last_timestamp is None:
+        return DEFAULT_BEGIN_DATE
+    begin = checkpoint.last_timestamp - CHECKPOINT_OVERLAP
+    if begin <= _get_oldest_begin():
+        return DEFAULT_BEGIN_DATE
+    return begin.isoformat(timespec='milliseconds')
+
+
+def get_raw_mercadopago_info(checkpoint=None, sdk=None, workers=FETCH_WORKERS):
+    """Get records from Mercadopago API, yielding them as the pages arrive.
+
+    If a checkpoint is given only the records approved after it (with some overlap) are
+    retrieved, otherwise the last months are.
+
+    Once a page tells the total, the rest of the pages are requested concurrently (up to
+    `workers` at the same time), yielding them in order anyway. As records may move between
+    pages while we're hitting the API, repeated ones are discarded.
+
+    As different hits bring different "total" values indicated, we record what is the
+    max of those, and only stop hitting when we get no results from one of those endpoints.
+    """
+    if sdk is None:
+        sdk = _get_sdk()
+
+    filters = {
+        'status': 'approved',
+        'limit': LIMIT,
+        'range': 'date_approved',
+        'begin_date': get_begin_date(checkpoint),
+        'sort': 'date_approved',
+        'criteria': 'asc',
+    }
+
+    def _fetch(offset):
+        response = sdk.payment().search(dict(filters, offset=offset))
+        assert response['status'] == 200
+        return offset, response['response']['results'], response['response']['paging']
 
-    filters = {'status': 'approved', 'limit': LIMIT, 'begin_date': 'NOW-3MONTHS'}
     offset = 0
-    results = []
     max_total_exposed = 0
-    while True:
-        filters["offset"] = offset
-        response = mp.payment().search(filters)
-        assert response['status'] == 200
+    seen_ids = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if workers > 1 and offset < max_total_exposed:
+                pages = executor.map(_fetch, range(offset, max_total_exposed, LIMIT))
+            else:
+                pages = [_fetch(offset)]
+
+            finished = False
+            for page_offset, results, paging in pages:
+                max_total_exposed = max(max_total_exposed, paging["total"])
+                logger.debug(
+                    'Getting response from mercadopago, len=%d paging=%s', len(results), paging)
 
-        quant_results = len(response['response']['results'])
-        paging = response['response']['paging']
-        max_total_exposed = max(max_total_exposed, paging["total"])
-        logger.debug(
-            'Getting response from mercadopago, len=%d paging=%s', quant_results, paging)
+                for record in results:
+                    if record['id'] in seen_ids:
+                        logger.debug("Discarding repeated record: %s", record['id'])
+                        continue
+                    seen_ids.add(record['id'])
+                    yield record
 
-        results.extend(response['response']['results'])
-        if not response['response']['results']:
-            if paging["total"] == max_total_exposed:
-                # didn't get any result and reported "total" is the biggest seen so far
+                if page_offset != offset:
+                    # some previous page came short, continue from there in the next round
+                    continue
+                if not results:
+                    if paging["total"] == max_total_exposed:
+                        # didn't get any result and reported "total" is the biggest seen so far
+                        finished = True
+                offset += len(results)
+
+            if finished:
                 break
-        offset += quant_results
 
-    logger.info('Got response from mercadopago, %d items', len(results))
-    return results
+    logger.info('Got response from mercadopago, %d items', len(seen_ids))
+
+
+def update_checkpoint(checkpoint, records, skipped=()):
+    """Move the checkpoint forward to the most recent of the given processed records.
+
+    If some records were skipped to be processed in a later run (the payer is still not in
+    our DB) the checkpoint is not moved past the oldest of them; anyway, as records are never
+    retrieved from before the last months, those skipped forever stop holding it back later.
+    """
+    if skipped:
+        oldest_skipped = min(record['timestamp'] for record in skipped)
+        records = [record for record in records if record['timestamp'] < oldest_skipped]
+    if not records:
+        return
+    last = max(records, key=lambda record: record['timestamp'])
+    if checkpoint.last_timestamp is not None and last['timestamp'] <= checkpoint.last_timestamp:
+        return
+    checkpoint.last_timestamp = last['timestamp']
+    checkpoint.last_id = str(last['id_helper']['payment_id'])
+    checkpoint.save()
+    logger.info(
+        'Checkpoint moved to %s (payment %s)', checkpoint.last_timestamp, checkpoint.last_id)
@@ -0,0 +1,64 @@
+"""Measure how many invoice PDFs per second are rendered, for a synthetic batch."""
+
+import datetime
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+
+from utils import afip
+
+SELLING_POINT = 99
+
+
+def _build_invoices(quantity):
+    """Build already "authorized" member invoices, with fake data."""
+    invoices = []
+    today = datetime.date.today()
+    for idx in range(quantity):
+        invoice = afip.MemberInvoice(
+            document_number=str(20000000 + idx), fullname="Socie Número {}".format(idx),
+            address="Calle Falsa {}".format(idx), city="Springfield", zip_code="1234",
+            province="Buenos Aires", invoice_number=idx + 1, invoice_date=today,
+            service_date_from=today.strftime("%Y%m01"), service_date_to=today.strftime("%Y%m%d"),
+            selling_point=SELLING_POINT)
+        invoice.add_item(
+            description="3 cuotas sociales\nPago via Benchmark", quantity=1, amount=Decimal(300))
+        invoice.header.update(resultado="A", cae="{:014d}".format(idx), fch_venc_cae="20991231")
+        invoices.append(invoice)
+    return invoices
+
+
+class Command(BaseCommand):
+    help = "Benchmark the invoices PDF rendering with a synthetic batch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--quantity', type=int, default=100)
+        parser.add_argument(
+            '--processes', type=int, default=afip.PDF_PROCESSES,
+            help="How many processes to render the PDFs (1 means in this same process)")
+
+    def handle(self, *args, **options):
+        quantity = options['quantity']
+        afip.PDF_PROCESSES = options['processes']
+        invoices = _build_invoices(quantity)
+
+        orig_pdf_path = afip.PDF_PATH
+        afip.PDF_PATH = tempfile.mkdtemp()
+        try:
+            # the template is loaded before measuring (in this process and in the pool)
+            t0 = time.perf_counter()
+            afip.render_pdfs(invoices[:min(quantity, afip.PDF_PROCESSES)], SELLING_POINT)
+            print("Warm up (loading the template) took {:.2f}s".format(time.perf_counter() - t0))
+
+            t0 = time.perf_counter()
+            afip.render_pdfs(invoices, SELLING_POINT)
+            delta = time.perf_counter() - t0
+        finally:
+            shutil.rmtree(afip.PDF_PATH)
+            afip.PDF_PATH = orig_pdf_path
+
+        print("Rendered {} PDFs with {} process(es) in {:.2f}s: {:.1f} PDFs/second".format(
+            quantity, options['processes'], delta, quantity / delta))
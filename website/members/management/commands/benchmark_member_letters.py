@@ -0,0 +1,65 @@
+"""Measure the letters generation, one by one against all at once, for a synthetic batch."""
+
+import datetime
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from members import utils
+from members.models import Category, Member, Person
+
+
+def _build_members(quantity):
+    """Build (not saved) members with fake data."""
+    category = Category(name=Category.ACTIVE, description="", fee=0)
+    members = []
+    for idx in range(quantity):
+        member = Member(category=category)
+        Person(
+            membership=member, first_name="Socie", last_name="Número {}".format(idx),
+            document_number=str(20000000 + idx), email="socie{}@example.com".format(idx),
+            nationality="Argentina", marital_status="soltere", occupation="Programadore",
+            birth_date=datetime.date(1990, 1, 1), street_address="Calle Falsa {}".format(idx),
+            city="Springfield", zip_code="1234", province="Buenos Aires", country="Argentina")
+        members.append(member)
+    return members
+
+
+class Command(BaseCommand):
+    help = "Benchmark the generation of the letters to be signed, with a synthetic batch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--quantity', type=int, default=20)
+
+    def handle(self, *args, **options):
+        quantity = options['quantity']
+        members = _build_members(quantity)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # a separate (empty) cache for each case, so all the letters are really rendered
+            single_cache = utils.LetterCache(os.path.join(temp_dir, "single"))
+            batch_cache = utils.LetterCache(os.path.join(temp_dir, "batch"))
+
+            with tempfile.TemporaryDirectory() as dest_dir:
+                t0 = time.perf_counter()
+                for member in members:
+                    utils.generate_member_letter(member, dest_dir, cache=single_cache)
+                delta_single = time.perf_counter() - t0
+
+            with tempfile.TemporaryDirectory() as dest_dir:
+                t0 = time.perf_counter()
+                utils.generate_member_letters(members, dest_dir, cache=batch_cache)
+                delta_batch = time.perf_counter() - t0
+
+            with tempfile.TemporaryDirectory() as dest_dir:
+                t0 = time.perf_counter()
+                utils.generate_member_letters(members, dest_dir, cache=batch_cache)
+                delta_cached = time.perf_counter() - t0
+
+        for case, delta in [
+                ("one by one", delta_single), ("all at once", delta_batch),
+                ("from the cache", delta_cached)]:
+            print("Generated {} letters {} in {:.2f}s: {:.1f} letters/second".format(
+                quantity, case, delta, quantity / delta))
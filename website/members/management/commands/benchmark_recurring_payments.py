@@ -0,0 +1,101 @@
+"""Measure the in-memory processing of recurring payments with a synthetic feed.
+
+Only the grouping/dedupe and the detection of which payments are new are measured (no
+database is involved), comparing them with the previous naive approach.
+"""
+
+import datetime
+import random
+import time
+from decimal import Decimal
+from operator import itemgetter
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from members import logic
+
+
+def _build_feed(quantity, payers, duplicated_ratio):
+    """Build a shuffled synthetic feed, with some repeated records, and the last recorded."""
+    base = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    records = []
+    for i in range(quantity):
+        records.append({
+            'timestamp': base + datetime.timedelta(minutes=i),
+            'amount': Decimal(100),
+            'payer_id': "payer-{}".format(i % payers),
+            'id_helper': {'payment_id': i},
+        })
+    records.extend(random.sample(records, int(quantity * duplicated_ratio)))
+    random.shuffle(records)
+
+    # consider half of the payments of each payer already recorded
+    per_payer = {}
+    for record in records:
+        per_payer.setdefault(record['payer_id'], []).append(record['timestamp'])
+    last_recorded = {}
+    for payer, timestamps in per_payer.items():
+        timestamps.sort()
+        last_recorded[payer] = SimpleNamespace(timestamp=timestamps[len(timestamps) // 2])
+    return records, last_recorded
+
+
+def _naive(records, last_recorded):
+    """The previous way: walk the payer's list to dedupe, and then to find the cut-over."""
+    grouped = {}
+    for record in records:
+        payer_records = grouped.setdefault(record['payer_id'], [])
+        this_payment_id = record['id_helper']['payment_id']
+        if any(this_payment_id == r['id_helper']['payment_id'] for r in payer_records):
+            continue
+        payer_records.append(record)
+
+    result = {}
+    for payer, payer_records in grouped.items():
+        payer_records.sort(key=itemgetter('timestamp'))
+        last_timestamp = last_recorded[payer].timestamp
+        for pos, record in enumerate(payer_records):
+            if record['timestamp'] == last_timestamp:
+                result[payer] = payer_records[pos + 1:]
+                break
+            if record['timestamp'] > last_timestamp:
+                result[payer] = payer_records[pos:]
+                break
+    return result
+
+
+def _current(records, last_recorded):
+    """What is really used when creating the recurring payments."""
+    grouped = logic._group_recurring_records(records)
+    return {
+        payer: logic._get_remaining_payments(payer_records, last_recorded[payer])
+        for payer, payer_records in grouped.items()
+    }
+
+
+class Command(BaseCommand):
+    help = "Benchmark the recurring payments processing with a synthetic feed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--records', type=int, default=100000)
+        parser.add_argument('--payers', type=int, default=100)
+        parser.add_argument('--duplicated-ratio', type=float, default=0.05)
+        parser.add_argument('--skip-naive', action='store_true')
+
+    def handle(self, *args, **options):
+        records, last_recorded = _build_feed(
+            options['records'], options['payers'], options['duplicated_ratio'])
+        print("Feed: {} records from {} payers".format(len(records), len(last_recorded)))
+
+        functions = [_current] if options['skip_naive'] else [_naive, _current]
+        results = []
+        for func in functions:
+            t0 = time.perf_counter()
+            result = func(records, last_recorded)
+            delta = time.perf_counter() - t0
+            results.append(result)
+            print("    {:10s} {:8.3f} s".format(func.__name__.strip('_'), delta))
+
+        if len(results) == 2 and results[0] != results[1]:
+            print("ERROR: the results are different!")
@@ -10,6 +10,7 @@ from members import logic
 from members.models import Quota, Person, Payment, Member, PaymentStrategy
 
 from utils import gdrive, afip
+from utils.pipeline import StageTimings
 
 INVOICES_FROM = '2018-08-01 00:00+03'
 GMTminus3 = datetime.timezone(datetime.timedelta(hours=-3))
@@ -51,6 +52,9 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--limit', type=int, nargs='?', default=1)
+        parser.add_argument(
+            '--workers', type=int, nargs='?', default=afip.POST_PROCESS_WORKERS,
+            help="How many invoices to post-process (PDF, gdrive, mail) at the same time")
         parser.add_argument(
             '--invoice-date', type=str, nargs='?', help="Invoice date (%Y-%m-%d), forces limit=1")
 
@@ -179,56 +183,63 @@ class Command(BaseCommand):
                 description=description, quantity=rec['quantity'], amount=rec['amount'])
             invoices.append(invoice)
         print("Invoices generated, calling AFIP...")
-        try:
-            results = afip.process_invoices(invoices, settings.AFIP['selling_point'])
-        except Exception:
-            print("    PROBLEMS processing invoices", invoices)
-            raise
-        print("AFIP interaction ended correctly")
-
-        # save the results for the generated ok invoices
-        storing_info = []
-        for invoice_number, result in sorted(results.items()):
-            print("Checking invoice {} results {}".format(invoice_number, result))
-            if not result['invoice_ok']:
-                print("    WARNING: invoice NOT authorized ok")
-                continue
+        timings = StageTimings()
 
+        def _authorized(invoice_number):
+            # at this point the AFIP cycle is closed for this invoice, flag it as ok in our DB
             payment = payments_per_invoice[invoice_number]
             payment.invoice_ok = True
             payment.save()
 
-            storing_info.append((result['pdf_path'], invoice_number, payment))
-            print("    ok")
-
-        # at this point the AFIP cycle is closed: if AFIP approved the invoice it's flagged as
-        # ok in our DB, the worst thing that can happen now is failing to storing the PDF in
-        # gdrive or sending it by mail
-        for pdf_path, invoice_number, payment in storing_info:
+        def _post_process(invoice_number, pdf_path):
+            # the worst thing that can happen now is failing to storing the PDF in
+            # gdrive or sending it by mail
             print("Post-processing invoice {} at {}".format(invoice_number, pdf_path))
             storing_ok = True
 
             # upload the invoice to google drive
             try:
-                gdrive.upload_invoice(pdf_path, invoice_date)
+                with timings.measure('gdrive'):
+                    gdrive.upload_invoice(pdf_path, invoice_date)
             except Exception as err:
                 storing_ok = False
-                print("    failed uploading to gdrive:", repr(err))
+                print("    {}: failed uploading to gdrive: {!r}".format(invoice_number, err))
             else:
-                print("    uploaded to gdrive OK")
+                print("    {}: uploaded to gdrive OK".format(invoice_number))
 
             # send the invoice by mail
             try:
+                payment = payments_per_invoice[invoice_number]
                 person = persons_per_invoice[invoice_number]
-                _send_mail(payment.timestamp, person.email, pdf_path)
+                with timings.measure('mail'):
+                    _send_mail(payment.timestamp, person.email, pdf_path)
             except Exception as err:
                 storing_ok = False
-                print("    failed sending by mail:", repr(err))
+                print("    {}: failed sending by mail: {!r}".format(invoice_number, err))
             else:
-                print("    sent by mail OK")
+                print("    {}: sent by mail OK".format(invoice_number))
 
             if storing_ok:
                 # invoice uploaded to gdrive and sent ok, don't need it here anymore
                 os.remove(pdf_path)
             else:
-                print("    ERROR! Keeping invoice PDF")
+                print("    {}: ERROR! Keeping invoice PDF".format(invoice_number))
+            return storing_ok
+
+        try:
+            results = afip.process_invoices(
+                invoices, settings.AFIP['selling_point'], on_authorized=_authorized,
+                post_process=_post_process, workers=options['workers'], timings=timings)
+        except Exception:
+            print("    PROBLEMS processing invoices", invoices)
+            raise
+        print("AFIP interaction and post-processing ended")
+
+        for invoice_number, result in sorted(results.items()):
+            if not result['invoice_ok']:
+                print("WARNING: invoice {} NOT authorized ok".format(invoice_number))
+
+        print("Timings:")
+        for line in timings.report():
+            print("    " + line)
+        print("    " + afip.get_session().report())
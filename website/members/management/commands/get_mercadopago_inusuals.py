@@ -21,15 +21,15 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('year', type=str)
         parser.add_argument('month', type=str)
+        parser.add_argument(
+            '--workers', type=int, default=_mp.FETCH_WORKERS,
+            help="How many pages to retrieve from Mercadopago at the same time")
 
     def handle(self, *args, **options):
         year = int(options['year'])
         month = int(options['month'])
 
-        raw_info = _mp.get_raw_mercadopago_info()
-        if raw_info is None:
-            return
-
+        raw_info = _mp.get_raw_mercadopago_info(workers=options['workers'])
         records = self.process_mercadopago(raw_info, year, month)
 
         filepath = "report-inusual-{}{}.csv".format(year, month)
@@ -5,6 +5,7 @@ from django.core.management.base import BaseCommand
 from django.utils.dateparse import parse_datetime
 
 from members import logic
+from members.models import SyncCheckpoint
 
 from . import _mp
 
@@ -18,6 +19,12 @@ class Command(BaseCommand):
         parser.add_argument('--payment-id', type=int, nargs='?')
         parser.add_argument('--payer-id', type=str, nargs='?')
         parser.add_argument('--custom-fee', type=int, nargs='?')
+        parser.add_argument(
+            '--workers', type=int, default=_mp.FETCH_WORKERS,
+            help="How many pages to retrieve from Mercadopago at the same time")
+        parser.add_argument(
+            '--from-scratch', action='store_true',
+            help="Ignore the checkpoint and get all the records from the last months")
 
     def handle(self, *args, **options):
         payment_id = options.get('payment_id')
@@ -29,12 +36,22 @@ class Command(BaseCommand):
         if custom_fee is not None:
             custom_fee = Decimal(custom_fee)
 
-        raw_info = _mp.get_raw_mercadopago_info()
-        if raw_info is None:
-            return
+        # only continue from (and move) the checkpoint when processing everything
+        filtering = payment_id is not None or payer_id is not None
+        if filtering or options['from_scratch']:
+            checkpoint = None
+        else:
+            checkpoint, _ = SyncCheckpoint.objects.get_or_create(name=_mp.CHECKPOINT_NAME)
 
+        raw_info = _mp.get_raw_mercadopago_info(checkpoint, workers=options['workers'])
         records = self.process_mercadopago(raw_info, payment_id, payer_id)
-        logic.create_recurring_payments(records, custom_fee=custom_fee)
+        skipped = logic.create_recurring_payments(
+            records, custom_fee=custom_fee, since=_mp.get_begin_timestamp(checkpoint))
+
+        if not filtering:
+            if checkpoint is None:
+                checkpoint, _ = SyncCheckpoint.objects.get_or_create(name=_mp.CHECKPOINT_NAME)
+            _mp.update_checkpoint(checkpoint, records, skipped=skipped)
 
     def process_mercadopago(self, results, filter_payment_id, filter_payer_id):
         """Process Mercadopago info, building a per-payer sorted structure."""
@@ -0,0 +1,59 @@
+"""Rebuild (or just verify) the quota ledger of all the members."""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from members import logic
+from members.models import Member, Quota, QuotaLedger
+
+
+class Command(BaseCommand):
+    help = "Rebuild the quota ledgers from the stored quotas, or only verify them"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true',
+            help="Only check that the ledgers are correct, don't change anything")
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            self.verify()
+        else:
+            self.rebuild()
+
+    def rebuild(self):
+        members = Member.objects.order_by('pk').all()
+        print("Rebuilding ledgers for {} members".format(len(members)))
+        for member in members:
+            logic.rebuild_ledger(member)
+        print("Done")
+
+    def verify(self):
+        # get all the paid quotas, grouped per member
+        yearmonths_paid = {}
+        quotas = (
+            Quota.objects.filter(member__isnull=False).values_list('member_id', 'year', 'month'))
+        for member_id, year, month in quotas:
+            yearmonths_paid.setdefault(member_id, set()).add((year, month))
+
+        ledgers = {ledger.member_id: ledger for ledger in QuotaLedger.objects.all()}
+        print("Verifying {} ledgers".format(len(ledgers)))
+
+        problems = 0
+        for member_id in sorted(set(yearmonths_paid) | set(ledgers)):
+            should_be = yearmonths_paid.get(member_id, set())
+            ledger = ledgers.get(member_id)
+            if ledger is None:
+                problems += 1
+                print("    member {}: missing ledger ({} quotas)".format(
+                    member_id, len(should_be)))
+                continue
+
+            really_is = ledger.get_paid()
+            if really_is != should_be or ledger.paid_quantity != len(should_be):
+                problems += 1
+                print("    member {}: ledger is wrong (missing: {}, exceeding: {})".format(
+                    member_id, sorted(should_be - really_is), sorted(really_is - should_be)))
+
+        if problems:
+            raise CommandError("Found {} ledgers with problems".format(problems))
+        print("All ok")
@@ -21,15 +21,17 @@ class Command(BaseCommand):
         members = (
             Member.objects
             .filter(legal_id__isnull=False, category__fee__gt=0, shutdown_date__isnull=True)
+            .select_related('category', 'person', 'organization')
             .order_by('legal_id')
             .all()
         )
+        debts = logic.get_debt_states(members, limit_year, limit_month)
         mail_data = []
         for member in members:
             if not isinstance(member.entity, Person):
                 continue
 
-            debt = logic.get_debt_state(member, limit_year, limit_month)
+            debt = debts[member.id]
             if not debt:
                 continue
 
@@ -47,14 +49,16 @@ class Command(BaseCommand):
 
         print("Found {} members in debt".format(len(mail_data)))
 
-        for member, text in mail_data:
-            print(f"Sending mail to {member.entity.full_name} <{member.entity.email}>")
+        with utils.MailDispatcher() as dispatcher:
+            for member, text in mail_data:
+                print(f"Sending mail to {member.entity.full_name} <{member.entity.email}>")
 
-            try:
-                utils.send_email(member, MAIL_SUBJECT, text)
-            except Exception as err:
-                print("    problem:", repr(err))
-            else:
-                print("    ok")
+                try:
+                    utils.send_email(member, MAIL_SUBJECT, text, dispatcher=dispatcher)
+                except Exception as err:
+                    print("    problem:", repr(err))
+                else:
+                    print("    ok")
 
+        print(dispatcher.report())
         print("Done")
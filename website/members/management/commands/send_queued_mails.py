@@ -0,0 +1,29 @@
+"""Command to send the mails queued by the reports (the outbound mail queue worker)."""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from members import logic, utils
+from members.constants import MAIL_QUEUE_CHUNK
+
+
+class Command(BaseCommand):
+    help = "Send all the pending mails in the outbound queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--loop', type=int, default=0, metavar='SECONDS',
+            help="Keep running, checking the queue every these seconds (default: only once)")
+        parser.add_argument('--chunk-size', type=int, default=MAIL_QUEUE_CHUNK)
+
+    def handle(self, *args, **options):
+        while True:
+            # a new dispatcher each round, so the connection is not kept open while idle
+            with utils.MailDispatcher() as dispatcher:
+                processed = logic.send_queued_mails(dispatcher, chunk_size=options['chunk_size'])
+            if processed:
+                print("Processed {} queued mails: {}".format(processed, dispatcher.report()))
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -36,8 +36,8 @@ from django.conf import settings
 from django.core.mail import EmailMessage
 from django.core.management.base import BaseCommand
 
-from members import logic
-from members.models import Member, Quota, Category
+from members import logic, utils
+from members.models import Member, QuotaLedger, Category
 
 # These are the NEXT amounts, NOT what is currently stored in the DB (see the above
 # indications: the DB will be updated later)
@@ -147,6 +147,7 @@ class Command(BaseCommand):
                 legal_id__isnull=False,
                 shutdown_date__isnull=True,
             )
+            .select_related('category', 'person', 'ledger')
             .order_by('legal_id')
             .all())
         count = collections.Counter(m.category.name for m in members)
@@ -157,17 +158,20 @@ class Command(BaseCommand):
         currently = datetime.datetime.now()
         limit_year, limit_month = logic.decrement_year_month(currently.year, currently.month)
 
+        debts = logic.get_debt_states(members, limit_year, limit_month)
         mail_data = []
         for member in members:
             print("Processing member {}".format(member))
 
-            debt = logic.get_debt_state(member, limit_year, limit_month)
-            if debt:
-                quotas = list(Quota.objects.filter(member=member).order_by('year', 'month').all())
-                if quotas:
-                    latest_quota = quotas[-1]
-                    month_name = MONTHS[latest_quota.month]
-                    debt_status = DEBT_YES.format(year=latest_quota.year, month_name=month_name)
+            if debts[member.id]:
+                try:
+                    ledger = member.ledger
+                except QuotaLedger.DoesNotExist:
+                    ledger = None
+                if ledger is not None and ledger.last_paid_year is not None:
+                    month_name = MONTHS[ledger.last_paid_month]
+                    debt_status = DEBT_YES.format(
+                        year=ledger.last_paid_year, month_name=month_name)
                 else:
                     debt_status = DEBT_ALL
             else:
@@ -186,9 +190,12 @@ class Command(BaseCommand):
                 debt_status=debt_status, person_name=member.person.first_name)
 
         print("Sending mails...")
-        for info in mail_data:
-            recipient = info['recipient']
-            print("    ", recipient)
-            mail = EmailMessage(info['subject'], info['text'], settings.EMAIL_FROM, [recipient])
-            mail.send()
+        with utils.MailDispatcher() as dispatcher:
+            for info in mail_data:
+                recipient = info['recipient']
+                print("    ", recipient)
+                mail = EmailMessage(
+                    info['subject'], info['text'], settings.EMAIL_FROM, [recipient])
+                dispatcher.send(mail)
+        print(dispatcher.report())
         print("Done")
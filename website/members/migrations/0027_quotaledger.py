@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0026_auto_20210509_2043'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuotaLedger',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('first_paid_year', models.PositiveSmallIntegerField(null=True, verbose_name='primer año pago')),
+                ('first_paid_month', models.PositiveSmallIntegerField(null=True, verbose_name='primer mes pago')),
+                ('last_paid_year', models.PositiveSmallIntegerField(null=True, verbose_name='último año pago')),
+                ('last_paid_month', models.PositiveSmallIntegerField(null=True, verbose_name='último mes pago')),
+                ('paid_quantity', models.PositiveIntegerField(default=0, verbose_name='cantidad de cuotas pagas')),
+                ('paid_bitmap', models.BinaryField(default=b'', verbose_name='mapa de cuotas pagas')),
+                ('member', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='ledger', to='members.member', verbose_name='miembro')),
+            ],
+            options={
+                'get_latest_by': 'modified',
+                'abstract': False,
+            },
+        ),
+    ]
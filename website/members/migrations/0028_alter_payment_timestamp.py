@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0027_quotaledger'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='payment',
+            name='timestamp',
+            field=models.DateTimeField(db_index=True, verbose_name='fecha y hora'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:31
+
+from django.db import migrations, models
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0028_alter_payment_timestamp'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('name', models.CharField(max_length=317, unique=True, verbose_name='nombre')),
+                ('last_timestamp', models.DateTimeField(null=True, verbose_name='último registro (fecha y hora)')),
+                ('last_id', models.CharField(blank=True, max_length=317, verbose_name='último registro (id)')),
+            ],
+            options={
+                'get_latest_by': 'modified',
+                'abstract': False,
+            },
+        ),
+    ]
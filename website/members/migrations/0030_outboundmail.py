@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:51
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django_extensions.db.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0029_synccheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', django_extensions.db.fields.CreationDateTimeField(auto_now_add=True, verbose_name='created')),
+                ('modified', django_extensions.db.fields.ModificationDateTimeField(auto_now=True, verbose_name='modified')),
+                ('batch', models.CharField(db_index=True, max_length=36, verbose_name='lote')),
+                ('subject', models.CharField(max_length=317, verbose_name='asunto')),
+                ('text', models.TextField(blank=True, verbose_name='texto')),
+                ('cc', models.CharField(blank=True, max_length=317, verbose_name='con copia a')),
+                ('attach_letter', models.BooleanField(default=False, verbose_name='adjuntar carta')),
+                ('status', models.CharField(choices=[('pending', 'Pendiente'), ('sent', 'Enviado'), ('error', 'Con error')], db_index=True, default='pending', max_length=10, verbose_name='estado')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='intentos')),
+                ('error', models.TextField(blank=True, verbose_name='error')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='fecha y hora de envío')),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='members.member', verbose_name='miembro')),
+            ],
+            options={
+                'get_latest_by': 'modified',
+                'abstract': False,
+            },
+        ),
+    ]
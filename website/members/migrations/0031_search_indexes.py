@@ -0,0 +1,20 @@
+from django.db import migrations
+
+from events.helpers.search import AddSearchExtension, AddSearchIndex
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0030_outboundmail'),
+    ]
+
+    operations = [
+        AddSearchExtension(),
+        AddSearchIndex('person', 'first_name'),
+        AddSearchIndex('person', 'last_name'),
+        AddSearchIndex('person', 'email'),
+        AddSearchIndex('person', 'document_number'),
+        AddSearchIndex('organization', 'name'),
+        AddSearchIndex('organization', 'document_number'),
+    ]
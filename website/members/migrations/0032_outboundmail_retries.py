@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 07:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('members', '0031_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboundmail',
+            name='retry_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='reintentar desde'),
+        ),
+        migrations.AlterField(
+            model_name='outboundmail',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pendiente'), ('sending', 'Enviando'), ('sent', 'Enviado'), ('error', 'Con error')], db_index=True, default='pending', max_length=10, verbose_name='estado'),
+        ),
+    ]
@@ -1,5 +1,12 @@
+import threading
+
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.core.cache import caches
+from django.db import models, transaction
+from django.db.models import Q
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 from django_extensions.db.models import TimeStampedModel
@@ -10,6 +17,11 @@ from django.templatetags.static import static
 DEFAULT_MAX_LEN = 317  # Almost random
 LONG_MAX_LEN = 2048  # Random but bigger
 
+# the categories are cached in each process (and forgotten when changed, but only in that
+# process); the others see the change after the timeout
+CATEGORIES_CACHE_KEY = "members-categories"
+CATEGORIES_CACHE_TIMEOUT = 5 * 60
+
 
 class Quota(TimeStampedModel):
     """Like cuota in Spanish... exactly that. A monthly fee some member pays."""
@@ -40,6 +52,156 @@ class Quota(TimeStampedModel):
         return when.strftime('%y%m')
 
 
+class QuotaLedger(TimeStampedModel):
+    """Denormalized summary of the quotas paid by a member, to avoid walking all of them.
+
+    The paid months are stored in a bitmap, starting in the first paid year/month: the
+    bit N (least significant first, inside each byte) is on if the Nth month after that
+    first one is paid.
+    """
+
+    member = models.OneToOneField(
+        'Member', verbose_name=_('miembro'), on_delete=models.CASCADE, related_name='ledger')
+    first_paid_year = models.PositiveSmallIntegerField(_('primer año pago'), null=True)
+    first_paid_month = models.PositiveSmallIntegerField(_('primer mes pago'), null=True)
+    last_paid_year = models.PositiveSmallIntegerField(_('último año pago'), null=True)
+    last_paid_month = models.PositiveSmallIntegerField(_('último mes pago'), null=True)
+    paid_quantity = models.PositiveIntegerField(_('cantidad de cuotas pagas'), default=0)
+    paid_bitmap = models.BinaryField(_('mapa de cuotas pagas'), default=b'')
+
+    def __str__(self):
+        return "<QuotaLedger member={} last={}-{} quant={}>".format(
+            self.member_id, self.last_paid_year, self.last_paid_month, self.paid_quantity)
+
+    @staticmethod
+    def _yearmonth_to_index(year, month):
+        return year * 12 + month - 1
+
+    @staticmethod
+    def _index_to_yearmonth(index):
+        year, month = divmod(index, 12)
+        return year, month + 1
+
+    def get_paid(self):
+        """Return the set of paid year/months."""
+        if self.first_paid_year is None:
+            return set()
+
+        base = self._yearmonth_to_index(self.first_paid_year, self.first_paid_month)
+        paid = set()
+        for byte_pos, byte in enumerate(bytes(self.paid_bitmap)):
+            for bit_pos in range(8):
+                if byte & (1 << bit_pos):
+                    paid.add(self._index_to_yearmonth(base + byte_pos * 8 + bit_pos))
+        return paid
+
+    def set_paid(self, yearmonths):
+        """Set all the ledger info from the given paid year/months."""
+        indexes = {self._yearmonth_to_index(year, month) for year, month in yearmonths}
+        self.paid_quantity = len(indexes)
+        if not indexes:
+            self.first_paid_year = self.first_paid_month = None
+            self.last_paid_year = self.last_paid_month = None
+            self.paid_bitmap = b''
+            return
+
+        base = min(indexes)
+        top = max(indexes)
+        self.first_paid_year, self.first_paid_month = self._index_to_yearmonth(base)
+        self.last_paid_year, self.last_paid_month = self._index_to_yearmonth(top)
+        bitmap = bytearray((top - base) // 8 + 1)
+        for index in indexes:
+            offset = index - base
+            bitmap[offset // 8] |= 1 << (offset % 8)
+        self.paid_bitmap = bytes(bitmap)
+
+    def add_paid(self, yearmonths):
+        """Add the given year/months to the already paid ones."""
+        self.set_paid(self.get_paid() | set(yearmonths))
+
+    @classmethod
+    def rebuild(cls, member_id):
+        """Build the member's ledger from scratch, from the stored quotas."""
+        with transaction.atomic():
+            # lock the member, as the payments logic does when creating the ledger
+            list(Member.objects.select_for_update().filter(pk=member_id).values_list('pk'))
+            yearmonths = Quota.objects.filter(member_id=member_id).values_list('year', 'month')
+            ledger, _ = cls.objects.select_for_update().get_or_create(member_id=member_id)
+            ledger.set_paid(yearmonths)
+            ledger.save()
+        return ledger
+
+
+# the payments being deleted in this thread, their ledgers are rebuilt once after all their
+# quotas are gone (instead of once per quota)
+_deleting_payments = threading.local()
+
+
+def _rebuild_existing_ledgers(members_ids):
+    """Rebuild the ledgers of those members that still exist."""
+    for member_id in Member.objects.filter(pk__in=members_ids).values_list('pk', flat=True):
+        QuotaLedger.rebuild(member_id)
+
+
+@receiver(pre_save, sender=Quota)
+def _remember_quota_member(sender, instance, raw=False, **kwargs):
+    # the quota may be moved to other member, whose ledger also needs to be rebuilt
+    instance._previous_member_id = None
+    if not raw and not instance._state.adding:
+        instance._previous_member_id = (
+            Quota.objects.filter(pk=instance.pk).values_list('member_id', flat=True).first())
+
+
+@receiver([post_save, post_delete], sender=Quota)
+def _rebuild_quota_ledgers(sender, instance, raw=False, **kwargs):
+    # quotas created by the payments logic (in bulk, without signals) already update the
+    # ledgers; this is for any other change (e.g. in the admin, or deleting a payment)
+    if raw or instance.payment_id in getattr(_deleting_payments, 'ids', ()):
+        return
+    members_ids = {instance.member_id, getattr(instance, '_previous_member_id', None)}
+    members_ids.discard(None)
+    _rebuild_existing_ledgers(members_ids)
+
+
+# what a member may miss to get approved (see Member.get_missing_info)
+MISSING_INFO_FLAGS = (
+    'missing_signed_letter',
+    'missing_student_certif',
+    'missing_payment',
+    'missing_nickname',
+    'missing_picture',
+    'missing_collab_accept',
+)
+
+
+def _flag(condition):
+    # the condition is NULL (not false) if it involves a missing relation (e.g. no category)
+    return Coalesce(
+        models.ExpressionWrapper(condition, output_field=models.BooleanField()),
+        models.Value(False))
+
+
+class MemberQuerySet(models.QuerySet):
+
+    def with_missing_info(self):
+        """Annotate what is missing for each member, all computed in the same query.
+
+        With these annotations `Member.get_missing_info` doesn't need to hit the database.
+        """
+        has_person = Q(person__isnull=False)
+        return self.annotate(
+            missing_signed_letter=_flag(Q(has_subscription_letter=False)),
+            missing_student_certif=_flag(
+                Q(category__name=Category.STUDENT, has_student_certificate=False)),
+            missing_payment=_flag(Q(first_payment_month__isnull=True, category__fee__gt=0)),
+            missing_nickname=_flag(has_person & Q(person__nickname="")),
+            missing_picture=_flag(
+                has_person & (Q(person__picture__isnull=True) | Q(person__picture=""))),
+            missing_collab_accept=_flag(
+                Q(category__name=Category.COLLABORATOR, has_collaborator_acceptance=False)),
+        )
+
+
 class Member(TimeStampedModel):
     """Base Model for the Membership to the ONG. People and Organizations can be members."""
 
@@ -75,6 +237,16 @@ class Member(TimeStampedModel):
     has_collaborator_acceptance = models.BooleanField(
         _('ha aceptado ser colaborador?'), default=False)
 
+    objects = MemberQuerySet.as_manager()
+
+    @property
+    def cached_category(self):
+        """The category of the member, from the categories cache (None if not set)."""
+        if self.category_id is None:
+            # it may be a category not saved yet (e.g. members built just to render letters)
+            return self.category if Member.category.is_cached(self) else None
+        return Category.objects.get_cached(pk=self.category_id)
+
     @property
     def entity(self):
         """Return the Person or Organization for the member, if any."""
@@ -99,14 +271,28 @@ class Member(TimeStampedModel):
         If `for_approval` is indicated, some data will not be reported as missing (as they
         are not really needed for legal approval).
         """
-        cat_student = Category.objects.get(name=Category.STUDENT)
-        cat_collab = Category.objects.get(name=Category.COLLABORATOR)
+        if all(hasattr(self, flag) for flag in MISSING_INFO_FLAGS):
+            # already computed in the query (see MemberQuerySet.with_missing_info)
+            missing_info = {flag: getattr(self, flag) for flag in MISSING_INFO_FLAGS}
+        else:
+            missing_info = self._calculate_missing_info()
+
+        # some fields are not really needed to for a member to be legally approved
+        if for_approval:
+            missing_info['missing_nickname'] = False
+            missing_info['missing_picture'] = False
+            missing_info['missing_payment'] = False
+
+        return missing_info
+
+    def _calculate_missing_info(self):
+        category = self.cached_category
 
         # simple flags with "Not Applicable" situation
         missing_student_certif = (
-            self.category == cat_student and not self.has_student_certificate)
+            category == Category.STUDENT and not self.has_student_certificate)
         missing_collab_accept = (
-            self.category == cat_collab and not self.has_collaborator_acceptance)
+            category == Category.COLLABORATOR and not self.has_collaborator_acceptance)
 
         # info from Person
         missing_nickname = self.person.nickname == ""
@@ -115,15 +301,10 @@ class Member(TimeStampedModel):
         missing_picture = not self.person.picture and self.person.picture is not False
 
         # info from Member itself
-        missing_payment = self.first_payment_month is None and self.category.fee > 0
+        missing_payment = (
+            self.first_payment_month is None and category is not None and category.fee > 0)
         missing_signed_letter = not self.has_subscription_letter
 
-        # some fields are not really needed to for a member to be legally approved
-        if for_approval:
-            missing_nickname = False
-            missing_picture = False
-            missing_payment = False
-
         return {
             'missing_signed_letter': missing_signed_letter,
             'missing_student_certif': missing_student_certif,
@@ -228,6 +409,41 @@ class Organization(TimeStampedModel):
         return self.name
 
 
+class CategoryManager(models.Manager):
+    """Give access to the categories through the cache, as they almost never change."""
+
+    def _load(self):
+        categories = list(self.order_by('pk'))
+        caches['local'].set(CATEGORIES_CACHE_KEY, categories, CATEGORIES_CACHE_TIMEOUT)
+        return categories
+
+    def get_all_cached(self):
+        """Return all the categories (ordered by pk)."""
+        categories = caches['local'].get(CATEGORIES_CACHE_KEY)
+        if categories is None:
+            categories = self._load()
+        return categories
+
+    def _find(self, categories, pk, name):
+        for category in categories:
+            if (category.pk == pk) if pk is not None else (category.name == name):
+                return category
+
+    def get_cached(self, pk=None, name=None):
+        """Return a category by its pk or name."""
+        category = self._find(self.get_all_cached(), pk, name)
+        if category is None:
+            # maybe the cache is outdated
+            category = self._find(self._load(), pk, name)
+        if category is None:
+            raise self.model.DoesNotExist(f"Category not found (pk={pk!r}, name={name!r})")
+        return category
+
+    def forget_cached(self):
+        """Remove the categories from the cache, they will be loaded again when needed."""
+        caches['local'].delete(CATEGORIES_CACHE_KEY)
+
+
 class Category(TimeStampedModel):
     """Membership category."""
     ACTIVE = "Activo"
@@ -250,6 +466,8 @@ class Category(TimeStampedModel):
     )
     HUMAN_CATEGORIES = {ACTIVE, SUPPORTER, STUDENT, COLLABORATOR, TEENAGER}
 
+    objects = CategoryManager()
+
     class Meta:
         verbose_name_plural = "categories"
 
@@ -272,6 +490,17 @@ class Category(TimeStampedModel):
 
         return self.name == other_name
 
+    def __hash__(self):
+        # consistent with the equality (needed, e.g., when deleting)
+        return hash(self.name)
+
+
+@receiver([post_save, post_delete], sender=Category)
+def _forget_cached_categories(sender, **kwargs):
+    Category.objects.forget_cached()
+    # again after the transaction, in case somebody loaded the old values meanwhile
+    transaction.on_commit(Category.objects.forget_cached)
+
 
 class Patron(TimeStampedModel):
     """Somebody that pays a Membership fee.
@@ -320,7 +549,7 @@ class PaymentStrategy(TimeStampedModel):
 class Payment(TimeStampedModel):
     """Record a pay event."""
 
-    timestamp = models.DateTimeField(_('fecha y hora'))
+    timestamp = models.DateTimeField(_('fecha y hora'), db_index=True)
     amount = models.DecimalField(_('monto'), max_digits=18, decimal_places=2)
     strategy = models.ForeignKey(
         'PaymentStrategy', verbose_name=_('estrategia de pago'),
@@ -338,3 +567,64 @@ class Payment(TimeStampedModel):
 
     def __str__(self):
         return f"<Payment {self.amount} [{self.timestamp}] from {self.strategy}>"
+
+
+@receiver(pre_delete, sender=Payment)
+def _remember_payment_members(sender, instance, **kwargs):
+    # the quotas are deleted in cascade, the ledgers are rebuilt when the payment is gone
+    instance._quota_members_ids = set(
+        Quota.objects.filter(payment=instance, member__isnull=False).values_list(
+            'member_id', flat=True))
+    if not hasattr(_deleting_payments, 'ids'):
+        _deleting_payments.ids = set()
+    _deleting_payments.ids.add(instance.pk)
+
+
+@receiver(post_delete, sender=Payment)
+def _rebuild_payment_ledgers(sender, instance, **kwargs):
+    _deleting_payments.ids.discard(instance.pk)
+    _rebuild_existing_ledgers(instance._quota_members_ids)
+
+
+class SyncCheckpoint(TimeStampedModel):
+    """High-water mark of the info already retrieved from an external service."""
+
+    name = models.CharField(_('nombre'), max_length=DEFAULT_MAX_LEN, unique=True)
+    last_timestamp = models.DateTimeField(_('último registro (fecha y hora)'), null=True)
+    last_id = models.CharField(_('último registro (id)'), max_length=DEFAULT_MAX_LEN, blank=True)
+
+    def __str__(self):
+        return f"<SyncCheckpoint {self.name} [{self.last_timestamp}] {self.last_id}>"
+
+
+class OutboundMail(TimeStampedModel):
+    """A mail to a member, queued to be sent in background; grouped in batches."""
+
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    ERROR = 'error'
+    STATUS_CHOICES = (
+        (PENDING, 'Pendiente'),
+        (SENDING, 'Enviando'),
+        (SENT, 'Enviado'),
+        (ERROR, 'Con error'),
+    )
+
+    batch = models.CharField(_('lote'), max_length=36, db_index=True)
+    member = models.ForeignKey(Member, verbose_name=_('miembro'), on_delete=models.CASCADE)
+    subject = models.CharField(_('asunto'), max_length=DEFAULT_MAX_LEN)
+    text = models.TextField(_('texto'), blank=True)
+    cc = models.CharField(_('con copia a'), max_length=DEFAULT_MAX_LEN, blank=True)
+    attach_letter = models.BooleanField(_('adjuntar carta'), default=False)
+    status = models.CharField(
+        _('estado'), max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(_('intentos'), default=0)
+    error = models.TextField(_('error'), blank=True)
+    sent_at = models.DateTimeField(_('fecha y hora de envío'), null=True, blank=True)
+    # when the mail can be taken by a worker: end of the lease while SENDING, or the moment
+    # to retry it after a failure while PENDING
+    retry_at = models.DateTimeField(_('reintentar desde'), null=True, blank=True)
+
+    def __str__(self):
+        return f"<OutboundMail [{self.batch}] {self.status} to {self.member}>"
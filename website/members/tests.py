@@ -1,4 +1,9 @@
 import datetime
+import io
+import json
+import os
+import shutil
+import smtplib
 import tempfile
 import logassert
 import uuid
@@ -9,21 +14,34 @@ from unittest.mock import patch
 from PIL import Image
 
 from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache, caches
+from django.core.management import call_command
+from django.core.mail import EmailMessage
+from django.core.management.base import CommandError
+from django.db import connection
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now, make_aware
 from django.urls import reverse
 from django.db.models.fields.files import ImageFieldFile
 
+from events.helpers.search import is_search_indexed
 from members import logic, views, utils
+from members.constants import MAIL_RETRIES
+from members.management.commands import _mp
 from members.models import (
     Category,
     Member,
     Organization,
+    OutboundMail,
     Patron,
     Payment,
     PaymentStrategy,
     Person,
     Quota,
+    QuotaLedger,
+    SyncCheckpoint,
 )
 from .factories import (
     PatronFactory,
@@ -607,6 +625,32 @@ class CreateRecurringPaymentTestCase(TestCase):
         self.assertLoggedWarning(
             "Found exceeding payment limit", str(tstamp2), f'remaining: {len(records)}')
 
+    def test_last_payment_before_retrieved_period(self):
+        # needed objects
+        payer_id = 'test@example.com'
+        ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id=payer_id)
+        create_member(patron=ps.patron, first_payment_year=2017, first_payment_month=5)
+        tstamp1 = make_aware(datetime.datetime(year=2017, month=2, day=1))
+        logic.create_recurring_payments([create_payment_record(payer_id, timestamp=tstamp1)])
+
+        # the next monthly payment, retrieved from a checkpoint later than the previous one
+        tstamp2 = make_aware(datetime.datetime(year=2017, month=3, day=1))
+        since = make_aware(datetime.datetime(year=2017, month=2, day=20))
+        records = [create_payment_record(payer_id, timestamp=tstamp2)]
+        logic.create_recurring_payments(records, since=since)
+
+        self.assertEqual(len(Quota.objects.all()), 2)
+        self.assertNotLoggedWarning("Found exceeding payment limit")
+
+    def test_skipped_returned(self):
+        ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id='p1')
+        create_member(patron=ps.patron, first_payment_year=2017, first_payment_month=5)
+        records = [create_payment_record('p1'), create_payment_record('unknown')]
+        skipped = logic.create_recurring_payments(records)
+
+        self.assertEqual(len(Quota.objects.all()), 1)
+        self.assertEqual(skipped, records[1:])
+
     def test_simple_custom_fee(self):
         # needed objects
         payer_id = 'test@example.com'
@@ -666,6 +710,30 @@ class CreateRecurringPaymentTestCase(TestCase):
         (payed_fee,) = Quota.objects.all()
         self.assertEqual(payed_fee.payment.amount, weird_amount)
 
+    def test_member_not_found(self):
+        payer_id = 'test@example.com'
+        ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id=payer_id)
+        logic.create_recurring_payments([create_payment_record(payer_id)])
+
+        self.assertEqual(len(Quota.objects.all()), 0)
+        self.assertLoggedError("Member not found for Patron", ps.patron.name)
+
+    def test_queries_not_depending_on_payers(self):
+        records = []
+        for idx in range(20):
+            payer_id = 'test{}@example.com'.format(idx)
+            ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id=payer_id)
+            create_member(patron=ps.patron, first_payment_year=2017, first_payment_month=5)
+            tstamp1 = make_aware(datetime.datetime(year=2017, month=2, day=5))
+            tstamp2 = make_aware(datetime.datetime(year=2017, month=3, day=5))
+            records.append(create_payment_record(payer_id, timestamp=tstamp1))
+            records.append(create_payment_record(payer_id, timestamp=tstamp2))
+
+        # strategies, last payments, members, the bulk creation, and forgetting the income
+        with self.assertNumQueries(12):
+            logic.create_recurring_payments(records)
+        self.assertEqual(len(Quota.objects.all()), 40)
+
     def test_multiple_different_amounts(self):
         # needed objects
         payer_id1 = 'test@example.com'
@@ -695,6 +763,333 @@ class CreateRecurringPaymentTestCase(TestCase):
         self.assertEqual(payed_fee_2.payment.timestamp, tstampA)
 
 
+class CreatePaymentsInBulkTestCase(TestCase):
+    """Tests for the creation of several payments at once."""
+
+    def _payment_info(self, member, strategy, amount=DEFAULT_FEE, **kwargs):
+        info = {'member': member, 'timestamp': now(), 'amount': amount, 'strategy': strategy}
+        info.update(kwargs)
+        return info
+
+    def test_several_members(self):
+        ps = create_payment_strategy()
+        member1 = create_member(first_payment_year=2017, first_payment_month=11)
+        member2 = create_member(first_payment_year=2018, first_payment_month=3)
+        logic.create_payment(member2, now(), DEFAULT_FEE, ps)
+
+        payments = logic.create_payments_in_bulk([
+            self._payment_info(member1, ps, DEFAULT_FEE * 2),
+            self._payment_info(member2, ps, comments="foo"),
+            self._payment_info(member1, ps),
+        ])
+
+        self.assertEqual(len(payments), 3)
+        self.assertEqual(payments[1].comments, "foo")
+        quotas = Quota.objects.filter(payment__in=payments).order_by('pk')
+        self.assertEqual([(q.member, q.payment, q.year, q.month) for q in quotas], [
+            (member1, payments[0], 2017, 11),
+            (member1, payments[0], 2017, 12),
+            (member2, payments[1], 2018, 4),
+            (member1, payments[2], 2018, 1),
+        ])
+        ledger = QuotaLedger.objects.get(member=member1)
+        self.assertEqual((ledger.last_paid_year, ledger.last_paid_month), (2018, 1))
+        ledger = QuotaLedger.objects.get(member=member2)
+        self.assertEqual(ledger.paid_quantity, 2)
+
+    def test_all_or_nothing(self):
+        ps = create_payment_strategy()
+        member = create_member(first_payment_year=2017, first_payment_month=11)
+        with self.assertRaises(ValueError):
+            logic.create_payments_in_bulk([
+                self._payment_info(member, ps),
+                self._payment_info(member, ps, DEFAULT_FEE * 1.1),
+            ])
+        self.assertEqual(len(Payment.objects.all()), 0)
+        self.assertEqual(len(Quota.objects.all()), 0)
+
+    def test_queries_not_depending_on_quantity(self):
+        ps = create_payment_strategy()
+        members = [
+            create_member(first_payment_year=2017, first_payment_month=11) for _ in range(10)]
+        for member in members[:5]:
+            logic.create_payment(member, now(), DEFAULT_FEE, ps)
+
+        # lock members and ledgers, quotas for new ledgers, insert payments, quotas and ledgers,
+        # update ledgers (all inside a savepoint), and forget the income for the month
+        with self.assertNumQueries(10):
+            logic.create_payments_in_bulk(
+                [self._payment_info(member, ps, DEFAULT_FEE * 12) for member in members])
+        self.assertEqual(len(Quota.objects.all()), 5 + 10 * 12)
+
+    def test_members_locked(self):
+        ps = create_payment_strategy()
+        member = create_member(first_payment_year=2017, first_payment_month=11)
+
+        # even without ledger, the member is locked before creating it
+        with CaptureQueriesContext(connection) as captured:
+            logic.create_payments_in_bulk([self._payment_info(member, ps)])
+        locking = [query['sql'] for query in captured.captured_queries
+                   if query['sql'].endswith('FOR UPDATE')]
+        self.assertIn('"members_member"', locking[0])
+        self.assertTrue(QuotaLedger.objects.filter(member=member).exists())
+
+
+def _days_ago(days):
+    """Build the approval date of a record from some days ago."""
+    return (now() - datetime.timedelta(days=days)).isoformat(timespec='milliseconds')
+
+
+def create_raw_mp_record(payment_id, payer_id, date_approved, amount=DEFAULT_FEE):
+    """Build a record as returned by the Mercadopago API."""
+    return {
+        'id': payment_id,
+        'payer': {'id': payer_id},
+        'description': 'Socies Actives cuota 2019',
+        'date_approved': date_approved,
+        'transaction_amount': amount,
+    }
+
+
+class MercadopagoFetchTestCase(TestCase):
+    """Tests for the incremental retrieval of Mercadopago records."""
+
+    def setUp(self):
+        super().setUp()
+        logassert.setup(self, "")
+
+    def test_streams_all_pages(self):
+        records = [
+            create_raw_mp_record(1, 'p1', '2019-03-01T10:00:00.000-03:00'),
+            create_raw_mp_record(2, 'p1', '2019-04-01T10:00:00.000-03:00'),
+            create_raw_mp_record(3, 'p2', '2019-04-02T10:00:00.000-03:00'),
+        ]
+        sdk = _mp.RecordedSDK(records)
+        with patch.object(_mp, 'LIMIT', 2):
+            raw_info = _mp.get_raw_mercadopago_info(sdk=sdk)
+            self.assertEqual(sdk.searches, [])  # nothing hit until consumed
+            self.assertEqual(list(raw_info), records)
+
+        self.assertEqual(sorted(search['offset'] for search in sdk.searches), [0, 2, 3])
+        self.assertEqual(sdk.searches[0]['begin_date'], _mp.DEFAULT_BEGIN_DATE)
+        self.assertLoggedInfo("Got response from mercadopago, 3 items")
+
+    def test_concurrent_pages_in_order(self):
+        records = [
+            create_raw_mp_record(i, 'p1', '2019-03-{:02d}T10:00:00.000-03:00'.format(i + 1))
+            for i in range(7)
+        ]
+        sdk = _mp.RecordedSDK(records)
+        with patch.object(_mp, 'LIMIT', 2):
+            retrieved = list(_mp.get_raw_mercadopago_info(sdk=sdk, workers=3))
+
+        self.assertEqual(retrieved, records)
+        self.assertEqual(sorted(search['offset'] for search in sdk.searches), [0, 2, 4, 6, 7])
+
+    def test_sequential_same_result(self):
+        records = [
+            create_raw_mp_record(i, 'p1', '2019-03-{:02d}T10:00:00.000-03:00'.format(i + 1))
+            for i in range(5)
+        ]
+        sdk = _mp.RecordedSDK(records)
+        with patch.object(_mp, 'LIMIT', 2):
+            retrieved = list(_mp.get_raw_mercadopago_info(sdk=sdk, workers=1))
+
+        self.assertEqual(retrieved, records)
+        self.assertEqual([search['offset'] for search in sdk.searches], [0, 2, 4, 5])
+
+    def test_repeated_records_discarded(self):
+        # a record moved to the next page while paging
+        records = [
+            create_raw_mp_record(1, 'p1', '2019-03-01T10:00:00.000-03:00'),
+            create_raw_mp_record(2, 'p1', '2019-03-02T10:00:00.000-03:00'),
+            create_raw_mp_record(2, 'p1', '2019-03-02T10:00:00.000-03:00'),
+            create_raw_mp_record(3, 'p1', '2019-03-03T10:00:00.000-03:00'),
+        ]
+        sdk = _mp.RecordedSDK(records)
+        with patch.object(_mp, 'LIMIT', 2):
+            retrieved = list(_mp.get_raw_mercadopago_info(sdk=sdk))
+
+        self.assertEqual([record['id'] for record in retrieved], [1, 2, 3])
+        self.assertLoggedInfo("Got response from mercadopago, 3 items")
+
+    def test_total_growing_while_paging(self):
+        records = [
+            create_raw_mp_record(i, 'p1', '2019-03-{:02d}T10:00:00.000-03:00'.format(i + 1))
+            for i in range(5)
+        ]
+
+        class GrowingSDK(_mp.RecordedSDK):
+            def search(self, filters):
+                response = super().search(filters)
+                if filters['offset'] == 0:
+                    # the first hit reports less than what will be later
+                    response['response']['paging']['total'] = 3
+                return response
+
+        sdk = GrowingSDK(records)
+        with patch.object(_mp, 'LIMIT', 2):
+            retrieved = list(_mp.get_raw_mercadopago_info(sdk=sdk))
+
+        self.assertEqual(retrieved, records)
+
+    def test_continues_from_checkpoint(self):
+        records = [
+            create_raw_mp_record(1, 'p1', _days_ago(40)),
+            create_raw_mp_record(2, 'p1', _days_ago(10)),
+            create_raw_mp_record(3, 'p2', _days_ago(9)),
+        ]
+        last_timestamp = now() - datetime.timedelta(days=6)
+        checkpoint = SyncCheckpoint(name='test', last_timestamp=last_timestamp)
+        sdk = _mp.RecordedSDK(records)
+        retrieved = list(_mp.get_raw_mercadopago_info(checkpoint, sdk=sdk))
+
+        # everything after the checkpoint, including the overlap
+        self.assertEqual([record['id'] for record in retrieved], [2, 3])
+        self.assertEqual(
+            sdk.searches[0]['begin_date'],
+            (last_timestamp - _mp.CHECKPOINT_OVERLAP).isoformat(timespec='milliseconds'))
+
+    def test_never_before_the_last_months(self):
+        checkpoint = SyncCheckpoint(
+            name='test', last_timestamp=make_aware(datetime.datetime(2019, 4, 5)))
+        self.assertEqual(_mp.get_begin_date(checkpoint), _mp.DEFAULT_BEGIN_DATE)
+        self.assertGreater(
+            _mp.get_begin_timestamp(checkpoint), now() - _mp.MAX_LOOKBACK - datetime.timedelta(1))
+
+    def test_update_checkpoint(self):
+        checkpoint = SyncCheckpoint.objects.create(name='test')
+        tstamp1 = make_aware(datetime.datetime(2019, 4, 1))
+        tstamp2 = make_aware(datetime.datetime(2019, 4, 2))
+        records = [
+            create_payment_record('p1', timestamp=tstamp2),
+            create_payment_record('p2', timestamp=tstamp1),
+        ]
+        records[0]['id_helper']['payment_id'] = 8
+        _mp.update_checkpoint(checkpoint, records)
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.last_timestamp, tstamp2)
+        self.assertEqual(checkpoint.last_id, '8')
+
+        # never goes back
+        _mp.update_checkpoint(checkpoint, records[1:])
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.last_timestamp, tstamp2)
+
+    def test_update_checkpoint_skipped(self):
+        checkpoint = SyncCheckpoint.objects.create(name='test')
+        tstamps = [make_aware(datetime.datetime(2019, 4, day)) for day in (1, 2, 3)]
+        records = [create_payment_record('p1', timestamp=tstamp) for tstamp in tstamps]
+
+        # not moved past the skipped one
+        _mp.update_checkpoint(checkpoint, records, skipped=records[1:2])
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.last_timestamp, tstamps[0])
+
+        # not moved at all
+        _mp.update_checkpoint(checkpoint, records[1:], skipped=records[1:2])
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.last_timestamp, tstamps[0])
+
+    def _run_command(self, records, *args):
+        with tempfile.NamedTemporaryFile('wt', suffix='.json') as fh:
+            json.dump(records, fh)
+            fh.flush()
+            with patch.dict('os.environ', {'MERCADOPAGO_RECORDED_RESPONSES': fh.name}):
+                call_command('get_mercadopago_payments', *args)
+
+    def test_command_incremental(self):
+        ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id='p1')
+        member = create_member(patron=ps.patron, first_payment_year=2019, first_payment_month=1)
+        records = [
+            create_raw_mp_record(1, 'p1', '2019-03-01T10:00:00.000-03:00'),
+            create_raw_mp_record(2, 'p1', '2019-04-01T10:00:00.000-03:00'),
+        ]
+        self._run_command(records)
+        self.assertEqual(Payment.objects.count(), 2)
+        checkpoint = SyncCheckpoint.objects.get(name=_mp.CHECKPOINT_NAME)
+        self.assertEqual(checkpoint.last_id, '2')
+
+        # a new record appears, only that one is recorded
+        records.append(create_raw_mp_record(3, 'p1', '2019-05-01T10:00:00.000-03:00'))
+        self._run_command(records)
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertEqual(
+            sorted(Quota.objects.filter(member=member).values_list('month', flat=True)),
+            [1, 2, 3])
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.last_id, '3')
+
+    def test_command_payer_not_there_yet(self):
+        ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id='p1')
+        create_member(patron=ps.patron, first_payment_year=2019, first_payment_month=1)
+        records = [
+            create_raw_mp_record(1, 'p1', '2019-03-01T10:00:00.000-03:00'),
+            create_raw_mp_record(2, 'p2', '2019-03-02T10:00:00.000-03:00'),
+            create_raw_mp_record(3, 'p1', '2019-04-01T10:00:00.000-03:00'),
+        ]
+        self._run_command(records)
+        self.assertEqual(Payment.objects.count(), 2)
+        checkpoint = SyncCheckpoint.objects.get(name=_mp.CHECKPOINT_NAME)
+        self.assertEqual(checkpoint.last_id, '1')
+
+        # the payer is loaded later, its payment is recorded in the next run
+        ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id='p2')
+        create_member(patron=ps.patron, first_payment_year=2019, first_payment_month=1)
+        self._run_command(records)
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertEqual(Payment.objects.filter(strategy=ps).count(), 1)
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.last_id, '3')
+        self.assertNotLoggedWarning("Found exceeding payment limit")
+
+    def test_command_payer_always_failing(self):
+        ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id='p1')
+        create_member(patron=ps.patron, first_payment_year=2019, first_payment_month=1)
+
+        # a payer with problems to fix by hand, and other never registered
+        ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id='p2')
+        for _ in range(2):
+            create_member(patron=ps.patron)
+        records = [
+            create_raw_mp_record(1, 'p1', _days_ago(120)),
+            create_raw_mp_record(2, 'p3', _days_ago(100)),
+            create_raw_mp_record(3, 'p2', _days_ago(20)),
+            create_raw_mp_record(4, 'p1', _days_ago(10)),
+        ]
+        sdk = _mp.RecordedSDK(records)
+        with patch.object(_mp, '_get_sdk', return_value=sdk):
+            call_command('get_mercadopago_payments')
+            checkpoint = SyncCheckpoint.objects.get(name=_mp.CHECKPOINT_NAME)
+            self.assertEqual(checkpoint.last_id, '1')
+
+            # the never registered payer holds the checkpoint back, but the records are not
+            # retrieved from further than the last months
+            call_command('get_mercadopago_payments')
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.last_id, '1')
+        self.assertEqual(
+            [search['begin_date'] for search in sdk.searches if search['offset'] == 0],
+            [_mp.DEFAULT_BEGIN_DATE] * 2)
+
+        # without the never registered payer (too old to be retrieved) it moves on, even
+        # with the other one still failing
+        del sdk.records[1]
+        with patch.object(_mp, '_get_sdk', return_value=sdk):
+            call_command('get_mercadopago_payments')
+        checkpoint.refresh_from_db()
+        self.assertEqual(checkpoint.last_id, '4')
+        self.assertEqual(Payment.objects.count(), 2)
+
+    def test_command_filtering_does_not_move_checkpoint(self):
+        ps = create_payment_strategy(platform=PaymentStrategy.MERCADO_PAGO, payer_id='p1')
+        create_member(patron=ps.patron, first_payment_year=2019, first_payment_month=1)
+        records = [create_raw_mp_record(1, 'p1', '2019-03-01T10:00:00.000-03:00')]
+        self._run_command(records, '--payer-id', 'p1')
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertFalse(SyncCheckpoint.objects.exists())
+
+
 class GetDebtStateTestCase(TestCase):
     """Tests for the debt state."""
 
@@ -771,6 +1166,347 @@ class GetDebtStateTestCase(TestCase):
         self.assertEqual(debt, [(2017, 5), (2017, 6), (2017, 7), (2017, 8)])
 
 
+class GetDebtStatesTestCase(TestCase):
+    """Tests for the debt state of several members at once."""
+
+    def test_same_as_individual(self):
+        ps = create_payment_strategy()
+        member1 = create_member(first_payment_year=2017, first_payment_month=8)
+        logic.create_payment(member1, now(), DEFAULT_FEE * 2, ps)
+        member2 = create_member(first_payment_year=2017, first_payment_month=11)
+        logic.create_payment(member2, now(), DEFAULT_FEE, ps)
+        member3 = create_member(registration_date=datetime.date(2017, 12, 13))
+
+        debts = logic.get_debt_states([member1, member2, member3], 2018, 2)
+        self.assertEqual(debts, {
+            member1.id: [(2017, 10), (2017, 11), (2017, 12), (2018, 1), (2018, 2)],
+            member2.id: [(2017, 12), (2018, 1), (2018, 2)],
+            member3.id: [(2017, 12), (2018, 1), (2018, 2)],
+        })
+        for member in (member1, member2, member3):
+            self.assertEqual(
+                debts[member.id], logic.get_debt_state(member, 2018, 2))
+
+    def test_no_members(self):
+        debts = logic.get_debt_states([], 2018, 2)
+        self.assertEqual(debts, {})
+
+    def test_single_query(self):
+        ps = create_payment_strategy()
+        members = []
+        for _ in range(5):
+            member = create_member(first_payment_year=2017, first_payment_month=8)
+            logic.create_payment(member, now(), DEFAULT_FEE, ps)
+            members.append(member)
+
+        with self.assertNumQueries(1):
+            debts = logic.get_debt_states(members, 2018, 2)
+        self.assertEqual(len(debts), 5)
+
+
+class QuotaLedgerTestCase(TestCase):
+    """Tests for the quotas ledger."""
+
+    def test_bitmap_roundtrip(self):
+        ledger = QuotaLedger()
+        paid = {(2017, 11), (2017, 12), (2018, 3), (2019, 1)}
+        ledger.set_paid(paid)
+        self.assertEqual(ledger.get_paid(), paid)
+        self.assertEqual((ledger.first_paid_year, ledger.first_paid_month), (2017, 11))
+        self.assertEqual((ledger.last_paid_year, ledger.last_paid_month), (2019, 1))
+        self.assertEqual(ledger.paid_quantity, 4)
+
+    def test_bitmap_empty(self):
+        ledger = QuotaLedger()
+        ledger.set_paid([])
+        self.assertEqual(ledger.get_paid(), set())
+        self.assertIsNone(ledger.last_paid_year)
+        self.assertEqual(ledger.paid_quantity, 0)
+
+    def test_add_paid_before_first(self):
+        ledger = QuotaLedger()
+        ledger.set_paid([(2018, 5)])
+        ledger.add_paid([(2017, 2), (2018, 6)])
+        self.assertEqual(ledger.get_paid(), {(2017, 2), (2018, 5), (2018, 6)})
+        self.assertEqual((ledger.first_paid_year, ledger.first_paid_month), (2017, 2))
+
+    def test_updated_when_paying(self):
+        member = create_member(first_payment_year=2017, first_payment_month=11)
+        ps = create_payment_strategy()
+        logic.create_payment(member, now(), DEFAULT_FEE * 3, ps)
+        logic.create_payment(member, now(), DEFAULT_FEE, ps, first_unpaid=(2018, 6))
+
+        ledger = QuotaLedger.objects.get(member=member)
+        self.assertEqual(ledger.get_paid(), {(2017, 11), (2017, 12), (2018, 1), (2018, 6)})
+        self.assertEqual((ledger.last_paid_year, ledger.last_paid_month), (2018, 6))
+        self.assertEqual(ledger.paid_quantity, 4)
+
+    def test_rebuild(self):
+        member = create_member(first_payment_year=2017, first_payment_month=11)
+        ps = create_payment_strategy()
+        logic.create_payment(member, now(), DEFAULT_FEE * 2, ps)
+
+        # break the ledger behind the quotas' back
+        ledger = QuotaLedger.objects.get(member=member)
+        ledger.set_paid([(2017, 11)])
+        ledger.save()
+        ledger = logic.rebuild_ledger(member)
+        self.assertEqual(ledger.get_paid(), {(2017, 11), (2017, 12)})
+        self.assertEqual(QuotaLedger.objects.get(member=member).paid_quantity, 2)
+
+    def test_debt_without_ledger(self):
+        # quotas created without going through the payment logic
+        member = create_member(first_payment_year=2017, first_payment_month=11)
+        payment = PaymentFactory.create(strategy=create_payment_strategy(), amount=DEFAULT_FEE)
+        Quota.objects.create(payment=payment, year=2017, month=11, member=member)
+        QuotaLedger.objects.filter(member=member).delete()
+
+        self.assertEqual(logic.get_debt_state(member, 2018, 1), [(2017, 12), (2018, 1)])
+        self.assertEqual(
+            logic.get_debt_states([member], 2018, 1), {member.id: [(2017, 12), (2018, 1)]})
+
+    def test_verify_command(self):
+        member = create_member(first_payment_year=2017, first_payment_month=11)
+        ps = create_payment_strategy()
+        logic.create_payment(member, now(), DEFAULT_FEE * 2, ps)
+        with patch('sys.stdout'):
+            call_command('rebuild_quota_ledger', '--verify')
+
+            # break it, and fix it
+            QuotaLedger.objects.filter(member=member).update(paid_quantity=1)
+            with self.assertRaises(CommandError):
+                call_command('rebuild_quota_ledger', '--verify')
+            call_command('rebuild_quota_ledger')
+            call_command('rebuild_quota_ledger', '--verify')
+
+    def test_payment_deleted(self):
+        member = create_member(first_payment_year=2017, first_payment_month=11)
+        ps = create_payment_strategy()
+        logic.create_payment(member, now(), DEFAULT_FEE * 2, ps)
+        payment = logic.create_payment(member, now(), DEFAULT_FEE * 3, ps)
+        self.assertEqual(logic.get_debt_state(member, 2018, 1), [])
+
+        # the quotas are deleted in cascade, the ledger rebuilt only once
+        with patch.object(QuotaLedger, 'rebuild', wraps=QuotaLedger.rebuild) as rebuild_mock:
+            payment.delete()
+        rebuild_mock.assert_called_once_with(member.id)
+        ledger = QuotaLedger.objects.get(member=member)
+        self.assertEqual(ledger.get_paid(), {(2017, 11), (2017, 12)})
+        self.assertEqual(logic.get_debt_state(member, 2018, 1), [(2018, 1)])
+        self.assertEqual(logic.get_debt_states([member], 2018, 1), {member.id: [(2018, 1)]})
+
+    def test_quota_changed(self):
+        member1 = create_member(first_payment_year=2017, first_payment_month=11)
+        member2 = create_member(first_payment_year=2017, first_payment_month=11)
+        ps = create_payment_strategy()
+        logic.create_payment(member1, now(), DEFAULT_FEE * 2, ps)
+
+        # moved to other member
+        quota = Quota.objects.get(member=member1, month=12)
+        quota.member = member2
+        quota.save()
+        self.assertEqual(QuotaLedger.objects.get(member=member1).get_paid(), {(2017, 11)})
+        self.assertEqual(QuotaLedger.objects.get(member=member2).get_paid(), {(2017, 12)})
+
+        # the member is deleted, its quotas are left without member
+        member2.delete()
+        self.assertFalse(QuotaLedger.objects.filter(member_id=member2.id).exists())
+        self.assertEqual(QuotaLedger.objects.get(member=member1).get_paid(), {(2017, 11)})
+
+
+class MailDispatcherTestCase(TestCase):
+    """Tests for the bulk mail dispatcher."""
+
+    def setUp(self):
+        super().setUp()
+        logassert.setup(self, "")
+
+    def _build_message(self, idx):
+        recipient = "to{}@example.com".format(idx)
+        return EmailMessage("subject", "text", "from@example.com", [recipient])
+
+    def test_one_connection(self):
+        connection = mail.get_connection()
+        with patch('members.utils.get_connection', return_value=connection) as get_conn_mock:
+            with utils.MailDispatcher(max_per_second=None) as dispatcher:
+                for idx in range(3):
+                    dispatcher.send(self._build_message(idx))
+        get_conn_mock.assert_called_once_with()
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(dispatcher.sent, 3)
+        self.assertIn("Sent 3 mails", dispatcher.report())
+
+    def test_rate_limited(self):
+        with patch('time.sleep') as sleep_mock:
+            with utils.MailDispatcher(max_per_second=2) as dispatcher:
+                for idx in range(3):
+                    dispatcher.send(self._build_message(idx))
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(sleep_mock.call_count, 2)
+        for call in sleep_mock.call_args_list:
+            (wait,) = call[0]
+            self.assertLessEqual(wait, 0.5)
+
+    def test_transient_failure_retried(self):
+        error = smtplib.SMTPServerDisconnected("gone")
+        with utils.MailDispatcher(max_per_second=None, retry_delay=0) as dispatcher:
+            with patch.object(
+                    dispatcher.connection, 'send_messages', side_effect=[error, 1]) as send_mock:
+                dispatcher.send(self._build_message(1))
+        self.assertEqual(send_mock.call_count, 2)
+        self.assertEqual((dispatcher.sent, dispatcher.failed, dispatcher.retried), (1, 0, 1))
+        self.assertLoggedWarning("Transient problem sending mail", "to1@example.com")
+
+    def test_permanent_failure(self):
+        error = smtplib.SMTPRecipientsRefused({'to1@example.com': (550, b'no such user')})
+        with utils.MailDispatcher(max_per_second=None, retry_delay=0) as dispatcher:
+            with patch.object(dispatcher.connection, 'send_messages', side_effect=error):
+                with self.assertRaises(smtplib.SMTPRecipientsRefused):
+                    dispatcher.send(self._build_message(1))
+        self.assertEqual((dispatcher.sent, dispatcher.failed, dispatcher.retried), (0, 1, 0))
+
+    def test_transient_failure_exhausted(self):
+        error = smtplib.SMTPResponseException(451, b'try later')
+        with utils.MailDispatcher(max_per_second=None, retries=2, retry_delay=0) as dispatcher:
+            with patch.object(dispatcher.connection, 'send_messages', side_effect=error):
+                with self.assertRaises(smtplib.SMTPResponseException):
+                    dispatcher.send(self._build_message(1))
+        self.assertEqual((dispatcher.sent, dispatcher.failed, dispatcher.retried), (0, 1, 2))
+
+
+class MemberLettersTestCase(TestCase):
+    """Tests for the generation of the letters to be signed."""
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.cache_dir = os.path.join(temp_dir.name, "cache")
+        self.dest_dir = os.path.join(temp_dir.name, "dest")
+        os.mkdir(self.dest_dir)
+        self.cache = utils.LetterCache(self.cache_dir)
+
+    def _create_member(self, idx):
+        member = create_member()
+        Person.objects.create(
+            membership=member, first_name="Name{}".format(idx), last_name="Last",
+            document_number=str(idx), email="test{}@example.com".format(idx),
+            birth_date=datetime.date(2000, 1, idx))
+        return Member.objects.get(pk=member.pk)
+
+    def _fake_process(self, template, prefix, distinct, infos, images):
+        filepaths = []
+        for info in infos:
+            filepath = "{}-{}.pdf".format(prefix, info[distinct])
+            with open(filepath, 'wt', encoding='utf8') as fh:
+                fh.write("letter for " + info['nombre'])
+            filepaths.append(filepath)
+        return filepaths
+
+    def _generate(self, members):
+        with patch('certg.process', side_effect=self._fake_process) as process_mock:
+            result = utils.generate_member_letters(members, self.dest_dir, cache=self.cache)
+        return result, process_mock
+
+    def test_all_at_once(self):
+        members = [self._create_member(1), self._create_member(2)]
+        result, process_mock = self._generate(members)
+
+        self.assertEqual(result, [
+            os.path.join(self.dest_dir, 'letter-1.pdf'),
+            os.path.join(self.dest_dir, 'letter-2.pdf')])
+        (call,) = process_mock.call_args_list
+        template, prefix, distinct, infos = call[0]
+        self.assertEqual(template, utils.LETTER_TEMPLATE)
+        self.assertEqual(prefix, os.path.join(self.dest_dir, "letter"))
+        self.assertEqual(distinct, "dni")
+        self.assertEqual([info['dni'] for info in infos], ['1', '2'])
+        self.assertEqual(infos[1]['fechanacimiento'], "2000-01-02")
+
+    def test_nothing_to_generate(self):
+        result, process_mock = self._generate([])
+        self.assertEqual(result, [])
+        process_mock.assert_not_called()
+
+    def test_cached(self):
+        member1 = self._create_member(1)
+        self._generate([member1])
+        os.remove(os.path.join(self.dest_dir, 'letter-1.pdf'))
+
+        # only the new one is rendered, the other is copied from the cache with the same name
+        member2 = self._create_member(2)
+        result, process_mock = self._generate([member1, member2])
+        (call,) = process_mock.call_args_list
+        self.assertEqual([info['dni'] for info in call[0][3]], ['2'])
+        self.assertEqual(result, [
+            os.path.join(self.dest_dir, 'letter-1.pdf'),
+            os.path.join(self.dest_dir, 'letter-2.pdf')])
+        with open(result[0], 'rt', encoding='utf8') as fh:
+            self.assertEqual(fh.read(), "letter for Name1")
+
+    def test_cache_private(self):
+        os.mkdir(self.cache_dir, mode=0o755)
+        self._generate([self._create_member(1)])
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0o777, 0o700)
+        (cached,) = os.scandir(self.cache_dir)
+        self.assertEqual(cached.stat().st_mode & 0o777, 0o600)
+
+    def test_cache_default_directory(self):
+        with override_settings(LETTER_CACHE_DIR=self.cache_dir):
+            cache = utils.LetterCache()
+        self.assertEqual(cache.directory, self.cache_dir)
+
+    def test_cache_data_changed(self):
+        member = self._create_member(1)
+        self._generate([member])
+
+        member.person.first_name = "Changed"
+        member.person.save()
+        result, process_mock = self._generate([member])
+        process_mock.assert_called_once()
+        with open(result[0], 'rt', encoding='utf8') as fh:
+            self.assertEqual(fh.read(), "letter for Changed")
+
+    def test_benchmark_command(self):
+        with patch('certg.process', side_effect=self._fake_process):
+            with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                call_command('benchmark_member_letters', quantity=2)
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        for line in lines:
+            self.assertTrue(line.startswith("Generated 2 letters "))
+
+    def test_cache_template_changed(self):
+        template = os.path.join(self.dest_dir, "carta.svg")
+        shutil.copyfile(utils.LETTER_TEMPLATE, template)
+        self.cache.template = template
+        member = self._create_member(1)
+        self._generate([member])
+
+        stat = os.stat(template)
+        os.utime(template, (stat.st_atime + 10, stat.st_mtime + 10))
+        _, process_mock = self._generate([member])
+        process_mock.assert_called_once()
+
+    def test_cache_eviction(self):
+        # room for only two letters
+        self.cache.max_size = 2 * len("letter for NameX")
+        members = [self._create_member(idx) for idx in range(1, 4)]
+        for member in members:
+            self._generate([member])
+            # ensure different "last used" times
+            for entry in os.scandir(self.cache_dir):
+                stat = entry.stat()
+                os.utime(entry.path, (stat.st_atime - 10, stat.st_mtime - 10))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        # the oldest one was removed
+        _, process_mock = self._generate(members[1:])
+        process_mock.assert_not_called()
+        _, process_mock = self._generate(members[:1])
+        process_mock.assert_called_once()
+
+
 class BuildDebtStringTestCase(TestCase):
     """Tests for the string debt building utility."""
 
@@ -827,12 +1563,119 @@ class MembersReportTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'members/members_list.html')
 
+    def test_members_list_constant_queries(self):
+        for _ in range(2):
+            PersonFactory.create(membership=create_member())
+        with CaptureQueriesContext(connection) as queries_for_few:
+            response = self.client.get(reverse('members_list'))
+        self.assertEqual(len(response.context['members_list']), 2)
+
+        for _ in range(3):
+            PersonFactory.create(membership=create_member())
+            OrganizationFactory.create(membership=create_member())
+        with CaptureQueriesContext(connection) as queries_for_many:
+            response = self.client.get(reverse('members_list'))
+        self.assertEqual(len(response.context['members_list']), 8)
+        self.assertEqual(len(queries_for_few), len(queries_for_many))
+
+    def test_members_list_paginated_nulls_last(self):
+        # members without legal id yet go after all the others
+        members = []
+        for idx in range(20):
+            member = create_member()
+            if idx % 2:
+                member.legal_id = 100 - idx
+                member.save()
+            members.append(member)
+        expected = (
+            sorted((m for m in members if m.legal_id), key=lambda m: m.legal_id)
+            + sorted((m for m in members if m.legal_id is None), key=lambda m: m.pk))
+
+        response = self.client.get(reverse('members_list'))
+        page = response.context['page_obj']
+        self.assertIsInstance(page.approximate_count, int)  # from the planner's stats
+        self.assertFalse(page.has_previous())
+        first_page = list(page)
+        response = self.client.get(reverse('members_list') + page.next_url)
+        page = response.context['page_obj']
+        self.assertFalse(page.has_next())
+        self.assertEqual(first_page + list(page), expected)
+
+        response = self.client.get(reverse('members_list') + page.previous_url)
+        self.assertEqual(list(response.context['page_obj']), first_page)
+
+    def test_members_list_search_ranked(self):
+        if not is_search_indexed(connection):
+            self.skipTest("Trigrams not available in the database")
+        for first_name, last_name in [
+                ("Juana", "Martinezzz"), ("Juan", "Martin"), ("Pedro", "Gomez")]:
+            member = create_member()
+            PersonFactory.create(
+                membership=member, first_name=first_name, last_name=last_name,
+                email="{}@example.com".format(first_name))
+        response = self.client.get(reverse('members_list'), {'search': "martin"})
+        self.assertEqual(response.status_code, 200)
+        names = [member.person.first_name for member in response.context['members_list']]
+        self.assertEqual(names, ["Juan", "Juana"])
+
+    def test_members_list_search_single_redirects(self):
+        member = create_member()
+        PersonFactory.create(
+            membership=member, first_name="Facundo", last_name="Batista",
+            email="facundo@example.com")
+        response = self.client.get(reverse('members_list'), {'search': "batis"})
+        self.assertRedirects(
+            response, reverse('member_detail', kwargs={"pk": member.pk}),
+            fetch_redirect_response=False)
+
+    def test_search_indexes_created(self):
+        if not is_search_indexed(connection):
+            self.skipTest("Trigrams not available in the database")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT indexname FROM pg_indexes "
+                "WHERE tablename = 'members_person' AND indexname LIKE '%%_trgm'")
+            indexes = cursor.fetchall()
+        self.assertEqual(len(indexes), 4)
+
     def test_get_member_detail_page(self):
         member = create_member(first_payment_year=2017, first_payment_month=5)
         response = self.client.get(reverse('member_detail', kwargs={"pk": member.pk}))
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'members/member_detail.html')
 
+    def test_member_detail_constant_queries(self):
+        member = create_member(first_payment_year=2017, first_payment_month=5)
+        PersonFactory.create(membership=member)
+        ps = create_payment_strategy()
+        logic.create_payment(member, datetime.datetime(2018, 3, 22), 100, ps)
+        url = reverse('member_detail', kwargs={"pk": member.pk})
+        with CaptureQueriesContext(connection) as queries_for_one:
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['last_payments_info']), 1)
+
+        for day in range(1, 4):
+            other_ps = create_payment_strategy(payer_id="payer{}".format(day))
+            logic.create_payment(member, datetime.datetime(2019, 3, day), 300, other_ps)
+        with CaptureQueriesContext(connection) as queries_for_many:
+            response = self.client.get(url)
+        self.assertEqual(len(response.context['last_payments_info']), 4)
+        self.assertEqual(len(queries_for_one), len(queries_for_many))
+
+    def test_member_detail_debt(self):
+        member = create_member(first_payment_year=2017, first_payment_month=5)
+        ps = create_payment_strategy()
+        logic.create_payment(member, datetime.datetime(2018, 3, 22), 100, ps)
+        response = self.client.get(reverse('member_detail', kwargs={"pk": member.pk}))
+        self.assertTrue(response.context['debtor'])
+
+        # pay everything up to the current month
+        today = datetime.date.today()
+        quantity = (today.year - 2017) * 12 + today.month - 5
+        logic.create_payment(member, datetime.datetime(2018, 3, 23), 100 * quantity, ps)
+        response = self.client.get(reverse('member_detail', kwargs={"pk": member.pk}))
+        self.assertNotIn('debtor', response.context)
+
     def test_last_payments_none(self):
         member = create_member()
         info = views.MemberDetailView()._get_last_payments(member)
@@ -937,6 +1780,7 @@ class MemberTests(TestCase):
         # create the related person
         params = {
             'membership': member,
+            'document_number': str(member.pk),
             'nickname': 'test-nick',
             'picture': 'fake-pic',
         }
@@ -1050,6 +1894,149 @@ class MemberTests(TestCase):
         missing = {k for k, v in member.get_missing_info(for_approval=True).items() if v}
         self.assertFalse(missing)
 
+    def test_missing_info_annotated_same_as_calculated(self):
+        members = [
+            self._create_member(),
+            self._create_member(has_subscription_letter=False),
+            self._create_member(first_payment_year=None, first_payment_month=None),
+            self._create_member(
+                category_name=Category.TEENAGER, first_payment_year=None,
+                first_payment_month=None),
+            self._create_member(category_name=Category.STUDENT),
+            self._create_member(category_name=Category.STUDENT, has_student_certificate=True),
+            self._create_member(category_name=Category.COLLABORATOR),
+            self._create_member(
+                category_name=Category.COLLABORATOR, has_collaborator_acceptance=True),
+            self._create_member(nickname=''),
+            self._create_member(picture=''),
+            self._create_member(picture=False),
+        ]
+        annotated = {
+            member.pk: member for member in Member.objects.with_missing_info()}
+        for member in members:
+            for for_approval in (False, True):
+                self.assertEqual(
+                    annotated[member.pk].get_missing_info(for_approval=for_approval),
+                    member.get_missing_info(for_approval=for_approval))
+
+    def test_missing_info_annotated_without_category(self):
+        members = [
+            self._create_member(),
+            self._create_member(first_payment_year=None, first_payment_month=None),
+        ]
+        Member.objects.filter(pk__in=[member.pk for member in members]).update(category=None)
+        annotated = {
+            member.pk: member for member in Member.objects.with_missing_info()}
+        for member in members:
+            member = Member.objects.get(pk=member.pk)
+            missing_info = annotated[member.pk].get_missing_info()
+            self.assertEqual(missing_info, member.get_missing_info())
+            self.assertFalse(any(value is None for value in missing_info.values()))
+            self.assertFalse(missing_info['missing_payment'])
+            self.assertFalse(missing_info['missing_student_certif'])
+            self.assertFalse(missing_info['missing_collab_accept'])
+
+    def test_missing_info_annotated_no_queries(self):
+        self._create_member(category_name=Category.STUDENT, nickname='')
+        (member,) = Member.objects.with_missing_info()
+        with self.assertNumQueries(0):
+            missing = {k for k, v in member.get_missing_info().items() if v}
+        self.assertEqual(missing, {'missing_student_certif', 'missing_nickname'})
+
+
+class CategoryCacheTestCase(TestCase):
+    """Tests for the categories cache."""
+
+    def setUp(self):
+        super().setUp()
+        caches['local'].clear()
+        self.addCleanup(caches['local'].clear)
+
+    def test_no_queries_once_loaded(self):
+        with self.assertNumQueries(1):
+            categories = Category.objects.get_all_cached()
+        self.assertEqual(categories, list(Category.objects.order_by('pk')))
+
+        student = Category.objects.get(name=Category.STUDENT)
+        with self.assertNumQueries(0):
+            self.assertEqual(Category.objects.get_cached(name=Category.STUDENT).pk, student.pk)
+            self.assertEqual(Category.objects.get_cached(pk=student.pk).name, Category.STUDENT)
+
+    def test_forgotten_when_saved(self):
+        category = create_category(fee=100)
+        self.assertEqual(Category.objects.get_cached(pk=category.pk).fee, 100)
+
+        category.fee = 200
+        category.save()
+        self.assertEqual(Category.objects.get_cached(pk=category.pk).fee, 200)
+
+    def test_forgotten_when_deleted(self):
+        category = create_category()
+        Category.objects.get_cached(pk=category.pk)
+
+        pk = category.pk
+        category.delete()
+        with self.assertRaises(Category.DoesNotExist):
+            Category.objects.get_cached(pk=pk)
+
+    def test_reloaded_if_not_found(self):
+        Category.objects.get_all_cached()
+
+        # bulk creation doesn't trigger the signals
+        (category,) = Category.objects.bulk_create(
+            [Category(name='newcategory', description="", fee=10)])
+        self.assertEqual(Category.objects.get_cached(name='newcategory').pk, category.pk)
+
+    def test_member_category(self):
+        member = create_member()
+        member = Member.objects.get(pk=member.pk)
+        Category.objects.get_all_cached()
+        with self.assertNumQueries(0):
+            self.assertEqual(member.cached_category.name, 'testcategory')
+
+        member.category = None
+        self.assertIsNone(member.cached_category)
+
+
+class ReportMissingTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_superuser(
+            username='testuser', password='12345', email='1@1.com')
+        self.client.force_login(user)
+        self.addCleanup(self.client.logout)
+
+    def _create_not_yet_members(self, quantity):
+        category = Category.objects.get(name=Category.STUDENT)
+        for _ in range(quantity):
+            member = Member.objects.create(category=category, has_subscription_letter=True)
+            Person.objects.create(
+                membership=member, first_name="Name{}".format(member.pk),
+                document_number=str(member.pk), nickname='', picture='fake-pic')
+
+    def _count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('report_missing'))
+        return response, len(queries)
+
+    def test_missing_flags(self):
+        self._create_not_yet_members(1)
+        response, _ = self._count_queries()
+        (item,) = response.context['incompletes']
+        self.assertEqual(item['missing_student_certif'], "FALTA")
+        self.assertEqual(item['missing_nickname'], "FALTA")
+        self.assertEqual(item['missing_signed_letter'], "")
+        self.assertEqual(item['missing_picture'], "")
+        self.assertContains(response, "Name{}".format(Member.objects.get().pk))
+
+    def test_constant_queries(self):
+        self._create_not_yet_members(1)
+        _, queries_for_one = self._count_queries()
+        self._create_not_yet_members(5)
+        response, queries_for_many = self._count_queries()
+        self.assertEqual(len(response.context['incompletes']), 6)
+        self.assertEqual(queries_for_one, queries_for_many)
+
 
 class ReportCompleteTests(TestCase):
 
@@ -1069,13 +2056,11 @@ class ReportCompleteTests(TestCase):
         m2 = Member.objects.create(legal_id=None, registration_date=None, category=category)
 
         # hit the service
-        with patch('members.utils.send_email') as mail_mock:
-            request_data = {
-                'approve': [m1.id, m2.id],
-                'registration_date': '2020-09-11',
-            }
-            response = self.client.post(reverse('report_complete'), data=request_data)
-            self.assertEqual(response.status_code, 200)
+        request_data = {
+            'approve': [m1.id, m2.id],
+            'registration_date': '2020-09-11',
+        }
+        response = self.client.post(reverse('report_complete'), data=request_data)
 
         # check the members were approved correctly
         m3 = Member.objects.get(pk=m1.id)
@@ -1085,18 +2070,456 @@ class ReportCompleteTests(TestCase):
         self.assertEqual(m4.legal_id, 4)
         self.assertEqual(m4.registration_date, datetime.date(2020, 9, 11))
 
-        # verify mail was called ok
-        call1, call2 = mail_mock.mock_calls
+        # verify the mails were queued ok, and we're sent to see the batch progress
+        queued1, queued2 = OutboundMail.objects.order_by('id')
+        self.assertRedirects(
+            response, reverse('mail_batch_status', kwargs={'batch': queued1.batch}),
+            fetch_redirect_response=False)
 
-        _, args, kwargs = call1
-        self.assertEqual(args[0], m3)
+        self.assertEqual(queued1.member, m3)
         self.assertEqual(
-            args[1],
+            queued1.subject,
             'Continuación del trámite de inscripción a la Asociación Civil Python Argentina')
         self.assertIn(
             'en la última reunión de Comisión Directiva se aprobó y confirmó tu asociación.',
-            args[2])
-        self.assertEqual(kwargs, {'cc': ['presidencia@ac.python.org.ar']})
+            queued1.text)
+        self.assertEqual(queued1.cc, 'presidencia@ac.python.org.ar')
+        self.assertEqual(queued1.status, OutboundMail.PENDING)
+
+        self.assertEqual(queued2.member, m4)
+        self.assertEqual(queued2.batch, queued1.batch)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def _create_not_yet_members(self, quantity, **kwargs):
+        category = Category.objects.get(name=Category.ACTIVE)
+        for _ in range(quantity):
+            member = Member.objects.create(category=category, **kwargs)
+            Person.objects.create(
+                membership=member, first_name="Name{}".format(member.pk),
+                document_number=str(member.pk))
+
+    def test_list_constant_queries(self):
+        self._create_not_yet_members(1, has_subscription_letter=True)
+        with CaptureQueriesContext(connection) as queries_for_one:
+            self.client.get(reverse('report_complete'))
+
+        # more complete ones, and some that are not
+        self._create_not_yet_members(4, has_subscription_letter=True)
+        self._create_not_yet_members(3, has_subscription_letter=False)
+        with CaptureQueriesContext(connection) as queries_for_many:
+            response = self.client.get(reverse('report_complete'))
+
+        self.assertEqual(len(response.context['completes']), 5)
+        self.assertEqual(len(queries_for_one), len(queries_for_many))
+
+
+class OutboundMailQueueTestCase(TestCase):
+    """Tests for the outbound mail queue and its worker."""
+
+    def setUp(self):
+        super().setUp()
+        logassert.setup(self, "members.logic")
+        self.batch = str(uuid.uuid4())
 
-        _, args, kwargs = call2
-        self.assertEqual(args[0], m4)
+    def _create_member(self, idx):
+        member = create_member(first_payment_year=2020, first_payment_month=1)
+        Person.objects.create(
+            membership=member, first_name="Name{}".format(idx), last_name="Last",
+            document_number=str(idx), email="test{}@example.com".format(idx))
+        return Member.objects.get(pk=member.pk)
+
+    def _queue(self, member, **kwargs):
+        queued = logic.build_queued_mail(self.batch, member, "subject", "text", **kwargs)
+        queued.save()
+        return queued
+
+    def _send(self):
+        with utils.MailDispatcher(max_per_second=None) as dispatcher:
+            return logic.send_queued_mails(dispatcher, chunk_size=2)
+
+    def test_send_pending(self):
+        q1 = self._queue(self._create_member(1), cc=['boss@example.com'])
+        q2 = self._queue(self._create_member(2))
+        q3 = self._queue(self._create_member(3))
+
+        processed = self._send()
+
+        self.assertEqual(processed, 3)
+        self.assertEqual(
+            [m.to for m in mail.outbox],
+            [['Name1 Last <test1@example.com>'], ['Name2 Last <test2@example.com>'],
+             ['Name3 Last <test3@example.com>']])
+        self.assertEqual(mail.outbox[0].cc, ['boss@example.com'])
+        self.assertEqual(mail.outbox[1].cc, [])
+        for queued in (q1, q2, q3):
+            queued.refresh_from_db()
+            self.assertEqual(queued.status, OutboundMail.SENT)
+            self.assertEqual(queued.attempts, 1)
+            self.assertIsNotNone(queued.sent_at)
+
+    def test_sent_only_once(self):
+        self._queue(self._create_member(1))
+        self.assertEqual(self._send(), 1)
+        self.assertEqual(self._send(), 0)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_error_recorded(self):
+        q1 = self._queue(self._create_member(1))
+        q2 = self._queue(self._create_member(2))
+
+        error = smtplib.SMTPRecipientsRefused({})
+        with patch.object(utils.MailDispatcher, 'send', side_effect=[error, None]):
+            self._send()
+
+        # the failed one is left to be retried later
+        q1.refresh_from_db()
+        self.assertEqual(q1.status, OutboundMail.PENDING)
+        self.assertEqual(q1.error, repr(error))
+        self.assertEqual(q1.attempts, 1)
+        self.assertGreater(q1.retry_at, now())
+        self.assertIsNone(q1.sent_at)
+        q2.refresh_from_db()
+        self.assertEqual(q2.status, OutboundMail.SENT)
+        self.assertLoggedError("Problems sending email", self.batch)
+
+        # not retried before its time
+        self.assertEqual(self._send(), 0)
+
+    def test_error_retried_until_limit(self):
+        q1 = self._queue(self._create_member(1))
+        error = smtplib.SMTPServerDisconnected()
+        with patch.object(utils.MailDispatcher, 'send', side_effect=error):
+            for _ in range(MAIL_RETRIES):
+                OutboundMail.objects.update(retry_at=now())
+                self.assertEqual(self._send(), 1)
+
+        q1.refresh_from_db()
+        self.assertEqual(q1.status, OutboundMail.ERROR)
+        self.assertEqual(q1.attempts, MAIL_RETRIES)
+        self.assertIsNone(q1.retry_at)
+        OutboundMail.objects.update(retry_at=now())
+        self.assertEqual(self._send(), 0)
+
+    def test_retried_ok(self):
+        q1 = self._queue(self._create_member(1))
+        error = smtplib.SMTPServerDisconnected()
+        with patch.object(utils.MailDispatcher, 'send', side_effect=error):
+            self._send()
+        OutboundMail.objects.update(retry_at=now())
+        self.assertEqual(self._send(), 1)
+        q1.refresh_from_db()
+        self.assertEqual(q1.status, OutboundMail.SENT)
+        self.assertEqual(q1.attempts, 2)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_worker_dies_in_the_middle(self):
+        q1 = self._queue(self._create_member(1))
+        q2 = self._queue(self._create_member(2))
+
+        sent = []
+
+        def _send(mail):
+            if sent:
+                raise KeyboardInterrupt()
+            sent.append(mail)
+
+        with patch.object(utils.MailDispatcher, 'send', side_effect=_send):
+            with self.assertRaises(KeyboardInterrupt):
+                self._send()
+
+        # the one sent is recorded, the other is kept by the dead worker during its lease
+        q1.refresh_from_db()
+        self.assertEqual(q1.status, OutboundMail.SENT)
+        q2.refresh_from_db()
+        self.assertEqual(q2.status, OutboundMail.SENDING)
+        self.assertEqual(self._send(), 0)
+
+        # after the lease it's taken by other worker
+        OutboundMail.objects.filter(pk=q2.pk).update(retry_at=now())
+        self.assertEqual(self._send(), 1)
+        q2.refresh_from_db()
+        self.assertEqual(q2.status, OutboundMail.SENT)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def _queue_missing_info(self, idx):
+        member = self._create_member(idx)
+        member.has_subscription_letter = False
+        member.save()
+        queued = logic.build_queued_missing_info_mail(self.batch, member)
+        queued.save()
+        return queued
+
+    def _fake_letters(self, members, dest_dir):
+        filepaths = []
+        for member in members:
+            filepath = os.path.join(
+                dest_dir, "letter-{}.pdf".format(member.person.document_number))
+            with open(filepath, 'wb') as fh:
+                fh.write(b"letter")
+            filepaths.append(filepath)
+        self.letters_dirs.append(dest_dir)
+        return filepaths
+
+    def test_missing_info_letters_generated_when_sent(self):
+        q1 = self._queue_missing_info(1)
+        q2 = self._queue_missing_info(2)
+        self.assertTrue(q1.attach_letter)
+
+        self.letters_dirs = []
+        with patch.object(
+                utils, 'generate_member_letters', side_effect=self._fake_letters) as gen_mock:
+            self._send()
+
+        # all the letters in one pass
+        gen_mock.assert_called_once()
+        self.assertEqual(gen_mock.call_args[0][0], [q1.member, q2.member])
+
+        sent1, sent2 = mail.outbox
+        self.assertEqual(sent1.subject, utils.MISSING_INFO_MAIL_SUBJECT)
+        self.assertEqual(sent1.attachments, [('letter-1.pdf', b'letter', 'application/pdf')])
+        self.assertEqual(sent2.attachments, [('letter-2.pdf', b'letter', 'application/pdf')])
+
+        # the letters are not left around
+        (letters_dir,) = self.letters_dirs
+        self.assertFalse(os.path.exists(letters_dir))
+
+    def test_missing_info_letters_one_by_one_if_batch_fails(self):
+        q1 = self._queue_missing_info(1)
+        q2 = self._queue_missing_info(2)
+
+        # the batch fails, but then only one of the letters is really broken
+        self.letters_dirs = []
+        results = [ValueError("bad batch"), ValueError("bad person"), self._fake_letters]
+
+        def _generate(members, dest_dir, cache=None):
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result(members, dest_dir)
+
+        with patch.object(utils, 'generate_member_letters', side_effect=_generate):
+            self._send()
+
+        q1.refresh_from_db()
+        self.assertEqual(q1.status, OutboundMail.PENDING)
+        self.assertEqual(q1.error, "ValueError('bad person')")
+        q2.refresh_from_db()
+        self.assertEqual(q2.status, OutboundMail.SENT)
+        (sent,) = mail.outbox
+        self.assertEqual(len(sent.attachments), 1)
+        self.assertLoggedWarning("Problems generating the letters for 2 mails")
+
+    def test_missing_info_broken(self):
+        member = self._create_member(1)
+        with patch.object(utils, 'render_missing_info_mail', side_effect=ValueError("broken")):
+            queued = logic.build_queued_missing_info_mail(self.batch, member)
+        self.assertEqual(queued.status, OutboundMail.ERROR)
+        self.assertEqual(queued.error, "ValueError('broken')")
+        self.assertLoggedError("Problems building missing info email", self.batch)
+
+    def test_command(self):
+        self._queue(self._create_member(1))
+        with patch('sys.stdout'):
+            call_command('send_queued_mails')
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_batch_status_page(self):
+        user = User.objects.create_superuser(
+            username='testuser', password='12345', email='1@1.com')
+        self.client.force_login(user)
+        self.addCleanup(self.client.logout)
+
+        self._queue(self._create_member(1))
+        queued = self._queue(self._create_member(2))
+        queued.status = OutboundMail.ERROR
+        queued.error = "SMTPRecipientsRefused()"
+        queued.save()
+        sent = self._queue(self._create_member(3))
+        sent.status = OutboundMail.SENT
+        sent.save()
+
+        # other batches are not counted
+        other = logic.build_queued_mail("other-batch", self._create_member(4), "subject", "")
+        other.save()
+
+        response = self.client.get(reverse('mail_batch_status', kwargs={'batch': self.batch}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total'], 3)
+        self.assertEqual(response.context['pending'], 1)
+        self.assertEqual(response.context['sent'], 1)
+        self.assertEqual(response.context['failed'], 1)
+        self.assertEqual(response.context['errors'], [queued])
+        self.assertContains(response, "SMTPRecipientsRefused()")
+        self.assertContains(response, 'http-equiv="refresh"')
+        self.assertFalse(response.context['idle'])
+
+    def test_batch_status_idle(self):
+        self._queue(self._create_member(1))
+        self._queue(self._create_member(2))
+        OutboundMail.objects.update(modified=now() - datetime.timedelta(minutes=10))
+
+        _, _, idle = logic.get_mail_batch_status(self.batch)
+        self.assertTrue(idle)
+
+        # nothing pending, nothing to wait for
+        OutboundMail.objects.update(status=OutboundMail.SENT)
+        _, _, idle = logic.get_mail_batch_status(self.batch)
+        self.assertFalse(idle)
+
+
+class ReportIncomeQuotasTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_superuser(
+            username='testuser', password='12345', email='1@1.com')
+        self.client.force_login(user)
+        self.addCleanup(self.client.logout)
+
+    def _previous_months(self, quantity):
+        """Return the previous year/months to the current one, most recent first."""
+        today = datetime.date.today()
+        year, month = today.year, today.month
+        result = []
+        for _ in range(quantity):
+            year, month = logic.decrement_year_month(year, month)
+            result.append((year, month))
+        return result
+
+    def test_report(self):
+        (ym1, ym2, ym3) = self._previous_months(3)
+        category = create_category()
+        Category.objects.create(name=Category.TEENAGER, description='', fee=0)
+        ps = create_payment_strategy()
+
+        # one paying since the oldest month, other started in the last one and didn't pay
+        member1 = create_member(
+            first_payment_year=ym3[0], first_payment_month=ym3[1], category=category)
+        logic.create_payment(member1, now(), DEFAULT_FEE * 2, ps)
+        create_member(first_payment_year=ym1[0], first_payment_month=ym1[1], category=category)
+
+        # shutdown members are not considered
+        member3 = create_member(
+            first_payment_year=ym3[0], first_payment_month=ym3[1], category=category)
+        logic.create_payment(member3, now(), DEFAULT_FEE * 3, ps)
+        member3.shutdown_date = datetime.date.today()
+        member3.save()
+
+        response = self.client.get(reverse('report_income_quotas'), {'months': 3})
+        self.assertEqual(response.status_code, 200)
+        categ_idx = response.context['categories'].index(category.name)
+        self.assertNotIn(Category.TEENAGER, response.context['categories'])
+        info = [
+            (i['year'], i['month'], i['members_info'][categ_idx], i['total'], i['real'])
+            for i in response.context['info_per_month']]
+        self.assertEqual(info, [
+            ym1 + ({'total': 2, 'paid': 0}, 200, 0),
+            ym2 + ({'total': 1, 'paid': 1}, 100, 100),
+            ym3 + ({'total': 1, 'paid': 1}, 100, 100),
+        ])
+
+    def test_default_months(self):
+        response = self.client.get(reverse('report_income_quotas'))
+        self.assertEqual(response.status_code, 200)
+        months = [(i['year'], i['month']) for i in response.context['info_per_month']]
+        self.assertEqual(months, self._previous_months(24))
+
+    def test_months_limited(self):
+        response = self.client.get(reverse('report_income_quotas'), {'months': 100000})
+        self.assertEqual(response.status_code, 200)
+        months = [(i['year'], i['month']) for i in response.context['info_per_month']]
+        self.assertEqual(months, self._previous_months(120))
+
+    def test_queries_not_depending_on_months(self):
+        category = create_category()
+        ps = create_payment_strategy()
+        member = create_member(first_payment_year=2015, first_payment_month=1, category=category)
+        logic.create_payment(member, now(), DEFAULT_FEE * 30, ps)
+        Category.objects.get_all_cached()
+
+        with CaptureQueriesContext(connection) as short_period:
+            self.client.get(reverse('report_income_quotas'), {'months': 12})
+        with CaptureQueriesContext(connection) as long_period:
+            self.client.get(reverse('report_income_quotas'), {'months': 120})
+        self.assertEqual(len(short_period), len(long_period))
+
+
+class ReportIncomeMoneyTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_superuser(
+            username='testuser', password='12345', email='1@1.com')
+        self.client.force_login(user)
+        self.addCleanup(self.client.logout)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def _get_income(self):
+        response = self.client.get(reverse('report_income_money'), {'months': 2})
+        self.assertEqual(response.status_code, 200)
+        return [
+            (i['year'], i['month'], i['amount']) for i in response.context['info_per_month']]
+
+    def test_report(self):
+        today = datetime.date.today()
+        ym1 = logic.decrement_year_month(today.year, today.month)
+        ym2 = logic.decrement_year_month(*ym1)
+        member = create_member(first_payment_year=2017, first_payment_month=1)
+        ps = create_payment_strategy()
+        logic.create_payment(member, make_aware(datetime.datetime(*ym1, 3)), DEFAULT_FEE, ps)
+        logic.create_payment(member, make_aware(datetime.datetime(*ym1, 28)), DEFAULT_FEE, ps)
+        logic.create_payment(member, make_aware(datetime.datetime(*ym2, 1)), DEFAULT_FEE * 3, ps)
+
+        self.assertEqual(self._get_income(), [ym1 + (200, ), ym2 + (300, )])
+
+    def test_no_payments(self):
+        today = datetime.date.today()
+        ym1 = logic.decrement_year_month(today.year, today.month)
+        ym2 = logic.decrement_year_month(*ym1)
+        self.assertEqual(self._get_income(), [ym1 + ('-', ), ym2 + ('-', )])
+
+    def test_closed_months_cached(self):
+        today = datetime.date.today()
+        current = (today.year, today.month)
+        previous = logic.decrement_year_month(*current)
+        ps = create_payment_strategy()
+        PaymentFactory.create(
+            strategy=ps, amount=10, timestamp=make_aware(datetime.datetime(*previous, 1)))
+        PaymentFactory.create(strategy=ps, amount=20, timestamp=now())
+        self.assertEqual(logic.get_income_per_month([current, previous]), {
+            current: 20, previous: 10})
+
+        # new payments (not through the logic), only current month is calculated again
+        PaymentFactory.create(
+            strategy=ps, amount=100, timestamp=make_aware(datetime.datetime(*previous, 1)))
+        PaymentFactory.create(strategy=ps, amount=200, timestamp=now())
+        with self.assertNumQueries(2):  # the cache, and the current month
+            income = logic.get_income_per_month([current, previous])
+        self.assertEqual(income, {current: 220, previous: 10})
+
+    def test_cache_invalidated_when_paying(self):
+        today = datetime.date.today()
+        previous = logic.decrement_year_month(today.year, today.month)
+        member = create_member(first_payment_year=2017, first_payment_month=1)
+        ps = create_payment_strategy()
+        tstamp = make_aware(datetime.datetime(*previous, 1))
+        logic.create_payment(member, tstamp, DEFAULT_FEE, ps)
+        self.assertEqual(logic.get_income_per_month([previous]), {previous: 100})
+
+        logic.create_payment(member, tstamp, DEFAULT_FEE, ps)
+        self.assertEqual(logic.get_income_per_month([previous]), {previous: 200})
+
+    def test_cache_shared(self):
+        today = datetime.date.today()
+        previous = logic.decrement_year_month(today.year, today.month)
+        member = create_member(first_payment_year=2017, first_payment_month=1)
+        ps = create_payment_strategy()
+        tstamp = make_aware(datetime.datetime(*previous, 1))
+        logic.create_payment(member, tstamp, DEFAULT_FEE, ps)
+        logic.get_income_per_month([previous])
+
+        # as seen from other process
+        other_cache = caches.create_connection('default')
+        key = logic._income_cache_key(*previous)
+        self.assertEqual(other_cache.get(key), 100)
+        logic.create_payment(member, tstamp, DEFAULT_FEE, ps)
+        self.assertIsNone(other_cache.get(key))
@@ -18,6 +18,7 @@ urlpatterns = [
     path('reportes/deudas', views.report_debts, name='report_debts'),
     path('reportes/completos', views.report_complete, name='report_complete'),
     path('reportes/incompletos', views.report_missing, name='report_missing'),
+    path('reportes/mails/<batch>', views.mail_batch_status, name='mail_batch_status'),
     path('reportes/ingcuotas', views.report_income_quotas, name='report_income_quotas'),
     path('reportes/ingdinero', views.report_income_money, name='report_income_money'),
 
@@ -1,16 +1,27 @@
 """Helping utilities for members."""
 
+import hashlib
+import json
 import logging
 import os
 import re
+import shutil
+import smtplib
+import socket
+import tempfile
+import time
 
 import certg
 from django.conf import settings
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
 from django.template.loader import render_to_string
 
+from members.constants import LETTER_CACHE_MAX_SIZE, MAIL_MAX_PER_SECOND, MAIL_RETRIES
+
 logger = logging.getLogger(__name__)
 
+LETTER_TEMPLATE = os.path.join(os.path.dirname(__file__), 'templates', 'members', 'carta.svg')
+
 
 def clean_double_empty_lines(oldtext):
     while True:
@@ -32,14 +43,11 @@ def build_debt_string(debt):
     return result
 
 
-def generate_member_letter(member):
-    """Generate the letter to be signed by a wanna-be member."""
-    letter_svg_template = os.path.join(
-        os.path.dirname(__file__), 'templates', 'members', 'carta.svg')
-    path_prefix = "/tmp/letter"
+def _get_letter_info(member):
+    """Get the info of the person to fill the letter."""
     person = member.person
-    person_info = {
-        'tiposocie': member.category.name,
+    return {
+        'tiposocie': member.cached_category.name,
         'nombre': person.first_name,
         'apellido': person.last_name,
         'dni': person.document_number,
@@ -55,14 +63,193 @@ def generate_member_letter(member):
         'pais': person.country,
     }
 
-    # this could be optimized to generate all PDFs at once, but we're fine so far
-    (letter_filepath,) = certg.process(
-        letter_svg_template, path_prefix, "dni", [person_info], images=None)
+
+class LetterCache:
+    """Disk cache of the rendered letters.
+
+    The letters are stored by a hash of the info put in them and the template's modification
+    time, so any change in those produces a new letter. When the cache grows over `max_size`
+    bytes the least recently used letters are removed.
+
+    The letters have personal data, so the directory (by default `settings.LETTER_CACHE_DIR`)
+    and the files in it are only accessible by the owner.
+    """
+
+    def __init__(self, directory=None, max_size=LETTER_CACHE_MAX_SIZE, template=LETTER_TEMPLATE):
+        self.directory = settings.LETTER_CACHE_DIR if directory is None else directory
+        self.max_size = max_size
+        self.template = template
+
+    def _get_path(self, person_info):
+        fingerprint = hashlib.sha256()
+        fingerprint.update(json.dumps(person_info, sort_keys=True).encode("utf8"))
+        fingerprint.update(str(os.stat(self.template).st_mtime_ns).encode("ascii"))
+        return os.path.join(self.directory, fingerprint.hexdigest() + ".pdf")
+
+    def get(self, person_info):
+        """Return the path to the cached letter for that info, None if not there."""
+        path = self._get_path(person_info)
+        try:
+            # mark it as used
+            os.utime(path)
+        except FileNotFoundError:
+            return
+        return path
+
+    def put(self, person_info, filepath):
+        """Store a copy of the rendered letter for that info."""
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        # enforce it, the directory may be there from before (and makedirs is affected by umask)
+        os.chmod(self.directory, 0o700)
+        path = self._get_path(person_info)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        shutil.copyfile(filepath, temp_path)
+        os.chmod(temp_path, 0o600)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pdf"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # removed by other process
+                pass
+            total_size -= size
+
+
+def generate_member_letters(members, dest_dir, cache=None):
+    """Generate the letters to be signed by several wanna-be members, all in one pass.
+
+    Letters already in the cache are not rendered again. The letters are left in the given
+    directory; return their paths, in the same order than the members.
+    """
+    if cache is None:
+        cache = LetterCache()
+    person_infos = [_get_letter_info(member) for member in members]
+
+    letter_filepaths = [None] * len(person_infos)
+    to_render = []
+    for idx, person_info in enumerate(person_infos):
+        cached = cache.get(person_info)
+        if cached is None:
+            to_render.append(idx)
+        else:
+            # same name that certg would use
+            distinct = person_info['dni'].lower().replace(" ", "")
+            filepath = os.path.join(dest_dir, "letter-{}.pdf".format(distinct))
+            shutil.copyfile(cached, filepath)
+            letter_filepaths[idx] = filepath
+
+    if to_render:
+        path_prefix = os.path.join(dest_dir, "letter")
+        rendered = certg.process(
+            LETTER_TEMPLATE, path_prefix, "dni", [person_infos[idx] for idx in to_render],
+            images=None)
+        for idx, filepath in zip(to_render, rendered):
+            cache.put(person_infos[idx], filepath)
+            letter_filepaths[idx] = filepath
+    return letter_filepaths
+
+
+def generate_member_letter(member, dest_dir, cache=None):
+    """Generate the letter to be signed by a wanna-be member."""
+    (letter_filepath,) = generate_member_letters([member], dest_dir, cache=cache)
     return letter_filepath
 
 
-def send_email(member, subject, text, attachment=None, cc=None):
-    """Send a mail to a member."""
+class MailDispatcher:
+    """Send several mails reusing the same SMTP connection.
+
+    It's rate limited (at most `max_per_second` mails are sent), transient failures are
+    retried (opening a new connection), and the throughput is informed at the end. Use it
+    as a context manager, so the connection is closed at the end.
+    """
+
+    def __init__(self, max_per_second=MAIL_MAX_PER_SECOND, retries=MAIL_RETRIES, retry_delay=1):
+        self.min_interval = 0 if not max_per_second else 1 / max_per_second
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.connection = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self._last_sent = None
+        self._started = None
+
+    def __enter__(self):
+        self.connection = get_connection()
+        self._started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._close()
+
+    def _close(self):
+        try:
+            self.connection.close()
+        except Exception as err:
+            logger.warning("Problem closing the mail connection: %r", err)
+
+    def _wait_rate_limit(self):
+        if self._last_sent is not None:
+            wait = self._last_sent + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self._last_sent = time.monotonic()
+
+    def send(self, message):
+        """Send the message, raising the error if it couldn't be sent."""
+        self._wait_rate_limit()
+        attempt = 0
+        while True:
+            try:
+                # the connection is open only once (if already open this does nothing)
+                self.connection.open()
+                self.connection.send_messages([message])
+            except Exception as err:
+                if not _is_transient_mail_error(err) or attempt >= self.retries:
+                    self.failed += 1
+                    raise
+                attempt += 1
+                self.retried += 1
+                logger.warning(
+                    "Transient problem sending mail to %s (attempt %d): %r",
+                    message.to, attempt, err)
+                self._close()
+                time.sleep(self.retry_delay * attempt)
+            else:
+                self.sent += 1
+                return
+
+    def report(self):
+        """Return a line with how many were sent and the throughput."""
+        delta = time.monotonic() - self._started
+        throughput = self.sent / delta if delta else 0
+        return "Sent {} mails in {:.2f}s ({:.2f} mails/s), {} failed, {} retries".format(
+            self.sent, delta, throughput, self.failed, self.retried)
+
+
+def _is_transient_mail_error(err):
+    """Tell if the error when sending a mail may not happen again."""
+    if isinstance(err, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(err, smtplib.SMTPResponseException):
+        # 4xx codes are temporary failures
+        return 400 <= err.smtp_code < 500
+    return isinstance(err, (ConnectionError, socket.timeout))
+
+
+def build_email(member, subject, text, attachment=None, cc=None):
+    """Build a mail to a member."""
     text = clean_double_empty_lines(text)
     recipient = f"{member.entity.full_name} <{member.entity.email}>"
     if cc is None:
@@ -71,20 +258,29 @@ def send_email(member, subject, text, attachment=None, cc=None):
     mail = EmailMessage(subject, text, settings.EMAIL_FROM, [recipient], cc=cc)
     if attachment is not None:
         mail.attach_file(attachment)
-    mail.send()
+    return mail
 
 
-def send_missing_info_mail(member):
-    """Send a mail to a member with all missing information.
+def send_email(member, subject, text, attachment=None, cc=None, dispatcher=None):
+    """Send a mail to a member (through the dispatcher, if given)."""
+    mail = build_email(member, subject, text, attachment=attachment, cc=cc)
+    if dispatcher is None:
+        mail.send()
+    else:
+        dispatcher.send(mail)
+
+
+MISSING_INFO_MAIL_SUBJECT = (
+    "Continuación del trámite de inscripción a la Asociación Civil Python Argentina")
 
-    This is used by reports, or when the user initially subscribes, or could be triggered from
-    anywhere, as it only sends what is missing.
-    """
-    mail_subject = "Continuación del trámite de inscripción a la Asociación Civil Python Argentina"
 
-    # create the mail text from the template
+def render_missing_info_mail(member):
+    """Render the text of the mail to a member with all missing information.
+
+    Return the text and if the signed letter is missing (so it needs to be attached).
+    """
     missing_info = member.get_missing_info()
-    missing_info['annual_fee'] = member.category.fee * 12
+    missing_info['annual_fee'] = member.cached_category.fee * 12
     missing_info['member'] = member
     missing_info['on_purpose_missing_var'] = "ERROR"
     text = render_to_string('members/mail_missing.txt', missing_info)
@@ -92,16 +288,24 @@ def send_missing_info_mail(member):
         # badly built template
         msg = "Error when building the report missing mail result, info: {}".format(missing_info)
         raise ValueError(msg)
+    return text, missing_info['missing_signed_letter']
 
-    # if missing the signed letter, produce it
-    if missing_info['missing_signed_letter']:
-        letter_filepath = generate_member_letter(member)
-    else:
-        letter_filepath = None
-
-    # send the mail
-    try:
-        send_email(member, mail_subject, text, attachment=letter_filepath)
-    finally:
-        if letter_filepath is not None:
-            os.unlink(letter_filepath)
+
+def send_missing_info_mail(member, dispatcher=None):
+    """Send a mail to a member with all missing information.
+
+    This is used when the user initially subscribes, or could be triggered from anywhere, as it
+    only sends what is missing.
+    """
+    text, missing_letter = render_missing_info_mail(member)
+
+    with tempfile.TemporaryDirectory() as letters_dir:
+        # if missing the signed letter, produce it
+        if missing_letter:
+            letter_filepath = generate_member_letter(member, letters_dir)
+        else:
+            letter_filepath = None
+
+        send_email(
+            member, MISSING_INFO_MAIL_SUBJECT, text, attachment=letter_filepath,
+            dispatcher=dispatcher)
@@ -1,12 +1,11 @@
 import datetime
 import logging
-import time
 import uuid
 from urllib import parse
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.db.models import Q, Sum, Max
+from django.db.models import Count, F, Q, Max
 from django.http import HttpResponse
 from django.shortcuts import render, redirect
 from django.template.loader import render_to_string
@@ -17,10 +16,11 @@ from django.views import View
 from django.views.generic import TemplateView, CreateView, ListView, DetailView
 
 from members import logic, utils
-from members.constants import DEFAULT_PAGINATION
+from members.constants import DEFAULT_PAGINATION, REPORT_DEFAULT_MONTHS, REPORT_MAX_MONTHS
+from events.helpers.pagination import KeysetPaginationMixin
 from events.helpers.views import search_filtered_queryset
 from members.forms import SignupPersonForm, SignupOrganizationForm
-from members.models import Person, Organization, Category, Member, Quota, Payment
+from members.models import Person, Organization, Category, Member, OutboundMail, Quota
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +45,9 @@ class SignupPersonFormView(CreateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         human_cats = Category.HUMAN_CATEGORIES
-        context["categories"] = Category.objects.order_by('-fee').filter(name__in=human_cats)
+        context["categories"] = sorted(
+            (cat for cat in Category.objects.get_all_cached() if cat.name in human_cats),
+            key=lambda cat: cat.fee, reverse=True)
         return context
 
     def form_invalid(self, form):
@@ -84,7 +86,9 @@ class SignupOrganizationsFormView(CreateView):
                 'name': cat.name,
                 'description': cat.description,
                 'anual_fee': cat.fee * 12,
-            } for cat in Category.objects.order_by('-fee').exclude(name__in=human_cats)]
+            } for cat in sorted(
+                Category.objects.get_all_cached(), key=lambda cat: cat.fee, reverse=True)
+            if cat.name not in human_cats]
         return context
 
 
@@ -106,17 +110,18 @@ class ReportDebts(OnlyAdminsViewMixin, View):
 
     def post(self, request):
         raw_sendmail = parse.parse_qs(request.body)[b'sendmail']
-        to_send_mail_ids = map(int, raw_sendmail)
+        to_send_mail_ids = list(map(int, raw_sendmail))
         limit_year, limit_month = self._get_yearmonth(request)
 
-        sent_error = 0
-        sent_ok = 0
-        tini = time.time()
-        errors_code = str(uuid.uuid4())
-        for member_id in to_send_mail_ids:
-            member = Member.objects.get(id=member_id)
-
-            debt = logic.get_debt_state(member, limit_year, limit_month)
+        batch = str(uuid.uuid4())
+        members = (
+            Member.objects.filter(id__in=to_send_mail_ids)
+            .select_related('category', 'person', 'organization')
+            .order_by('legal_id').all())
+        debts = logic.get_debt_states(members, limit_year, limit_month)
+        queued = []
+        for member in members:
+            debt = debts[member.id]
             debt_info = {
                 'debt': utils.build_debt_string(debt),
                 'member': member,
@@ -129,23 +134,11 @@ class ReportDebts(OnlyAdminsViewMixin, View):
                 logger.error(
                     "Error when building the report missing mail result, info: %s", debt_info)
                 return HttpResponse("Error al armar la página")
-            try:
-                utils.send_email(member, self.MAIL_SUBJECT, text)
-            except Exception as err:
-                sent_error += 1
-                logger.exception(
-                    "Problems sending email [%s] to member %s: %r", errors_code, member, err)
-            else:
-                sent_ok += 1
-        deltat = time.time() - tini
+            queued.append(logic.build_queued_mail(batch, member, self.MAIL_SUBJECT, text))
 
-        context = {
-            'sent_ok': sent_ok,
-            'sent_error': sent_error,
-            'errors_code': errors_code,
-            'deltamsec': int(deltat * 1000),
-        }
-        return render(request, 'members/mail_sent.html', context)
+        # the mails are sent in background by the queue worker
+        OutboundMail.objects.bulk_create(queued)
+        return redirect('mail_batch_status', batch=batch)
 
     def _get_yearmonth(self, request):
         try:
@@ -165,11 +158,13 @@ class ReportDebts(OnlyAdminsViewMixin, View):
         # get those already confirmed members
         members = Member.objects\
             .filter(legal_id__isnull=False, category__fee__gt=0, shutdown_date__isnull=True)\
+            .select_related('category', 'person', 'organization')\
             .order_by('legal_id').all()
 
         debts = []
+        debt_per_member = logic.get_debt_states(members, limit_year, limit_month)
         for member in members:
-            debt = logic.get_debt_state(member, limit_year, limit_month)
+            debt = debt_per_member[member.id]
             if debt:
                 debts.append({
                     'member': member,
@@ -190,34 +185,21 @@ class ReportMissing(OnlyAdminsViewMixin, View):
 
     def post(self, request):
         raw_sendmail = parse.parse_qs(request.body)[b'sendmail']
-        to_send_mail_ids = map(int, raw_sendmail)
-        sent_error = 0
-        sent_ok = 0
-        tini = time.time()
-        errors_code = str(uuid.uuid4())
-        for member_id in to_send_mail_ids:
-            member = Member.objects.get(id=member_id)
-            try:
-                utils.send_missing_info_mail(member)
-            except Exception as err:
-                sent_error += 1
-                logger.exception(
-                    "Problems sending email [%s] to member %s: %r", errors_code, member, err)
-            else:
-                sent_ok += 1
+        to_send_mail_ids = list(map(int, raw_sendmail))
+        batch = str(uuid.uuid4())
+        members = (
+            Member.objects.filter(id__in=to_send_mail_ids)
+            .select_related('category', 'person', 'organization'))
+        queued = [logic.build_queued_missing_info_mail(batch, member) for member in members]
 
-        deltat = time.time() - tini
-        context = {
-            'sent_ok': sent_ok,
-            'sent_error': sent_error,
-            'errors_code': errors_code,
-            'deltamsec': int(deltat * 1000),
-        }
-        return render(request, 'members/mail_sent.html', context)
+        # the mails are sent in background by the queue worker
+        OutboundMail.objects.bulk_create(queued)
+        return redirect('mail_batch_status', batch=batch)
 
     def get(self, request):
-        not_yet_members = Member.objects.filter(
-            legal_id=None, shutdown_date=None).order_by('created').all()
+        not_yet_members = (
+            Member.objects.filter(legal_id=None, shutdown_date=None)
+            .with_missing_info().select_related('person', 'organization').order_by('created'))
 
         incompletes = []
         for member in not_yet_members:
@@ -246,15 +228,13 @@ class ReportComplete(View):
         registration_date = datetime.datetime.strptime(
             request.POST['registration_date'], '%Y-%m-%d')
 
-        sent_error = 0
-        sent_ok = 0
-        tini = time.time()
-        errors_code = str(uuid.uuid4())
+        batch = str(uuid.uuid4())
 
         # get the first free legal id
         _max_legal_id_query = Member.objects.aggregate(Max('legal_id'))
         next_legal_id = _max_legal_id_query['legal_id__max'] + 1
 
+        queued = []
         for member_id in to_approve_ids:
             member = Member.objects.get(id=member_id)
 
@@ -264,32 +244,23 @@ class ReportComplete(View):
             member.save()
             next_legal_id += 1
 
-            # send a mail to the person informing new membership
+            # prepare a mail to the person informing new membership
             info = {
-                'member_type': member.category.name,
+                'member_type': member.cached_category.name,
                 'member_number': member.legal_id,
             }
             text = render_to_string('members/mail_newmember.txt', info)
-            try:
-                utils.send_email(member, self.MAIL_SUBJECT, text, cc=[self.MAIL_MANAGER])
-            except Exception as err:
-                sent_error += 1
-                logger.exception(
-                    "Problems sending email [%s] to member %s: %r", errors_code, member, err)
-            else:
-                sent_ok += 1
+            queued.append(logic.build_queued_mail(
+                batch, member, self.MAIL_SUBJECT, text, cc=[self.MAIL_MANAGER]))
 
-        deltat = time.time() - tini
-        context = {
-            'sent_ok': sent_ok,
-            'sent_error': sent_error,
-            'errors_code': errors_code,
-            'deltamsec': int(deltat * 1000),
-        }
-        return render(request, 'members/mail_sent.html', context)
+        # the mails are sent in background by the queue worker
+        OutboundMail.objects.bulk_create(queued)
+        return redirect('mail_batch_status', batch=batch)
 
     def get(self, request):
-        not_yet_members = Member.objects.filter(legal_id=None).order_by('created').all()
+        not_yet_members = (
+            Member.objects.filter(legal_id=None, person__isnull=False)
+            .with_missing_info().select_related('person').order_by('created'))
 
         completes = []
         for member in not_yet_members:
@@ -311,44 +282,105 @@ class ReportComplete(View):
         return render(request, 'members/report_complete.html', context)
 
 
+class MailBatchStatus(OnlyAdminsViewMixin, View):
+    """Show the progress of a batch of mails being sent in background."""
+
+    def get(self, request, batch):
+        counts, errors, idle = logic.get_mail_batch_status(batch)
+        context = {
+            'idle': idle,
+            'batch': batch,
+            'total': sum(counts.values()),
+            'pending': counts[OutboundMail.PENDING] + counts[OutboundMail.SENDING],
+            'sent': counts[OutboundMail.SENT],
+            'failed': counts[OutboundMail.ERROR],
+            'errors': errors,
+        }
+        return render(request, 'members/mail_batch_status.html', context)
+
+
+def _get_report_yearmonths(request):
+    """Get the year/months to show in a report, most recent first.
+
+    By default are the last 24 months (not including the current one), can be changed
+    using the 'months' parameter in the query string (up to 120).
+    """
+    try:
+        quantity = int(request.GET['months'])
+    except (KeyError, ValueError):
+        quantity = REPORT_DEFAULT_MONTHS
+    quantity = min(max(quantity, 1), REPORT_MAX_MONTHS)
+
+    today = datetime.date.today()
+    year, month = divmod(today.year * 12 + today.month - 1 - quantity, 12)
+    return list(reversed(list(logic.get_year_month_range(year, month + 1, quantity))))
+
+
 class ReportIncomeQuotas(OnlyAdminsViewMixin, View):
     """Handle the report showing income per quotas."""
 
     def get(self, request):
-        # months for last two years
-        today = datetime.date.today()
-        yearmonths = reversed(list(logic.get_year_month_range(today.year - 2, today.month, 24)))
+        yearmonths = _get_report_yearmonths(request)
+        (first_year, first_month) = yearmonths[-1]
+        (last_year, last_month) = yearmonths[0]
 
         # categories with non-zero fees
-        categs = Category.objects.filter(fee__gt=0).all()
+        categs = [c for c in Category.objects.get_all_cached() if c.fee > 0]
         categs_names = [c.name for c in categs]
 
+        # "active" as in members that already started to pay and didn't shutdown (no matter
+        # when they got the legal_id, really); get how many started to pay in each month, to
+        # then accumulate them
+        active_members = Member.objects.filter(
+            first_payment_month__isnull=False,
+            shutdown_date__isnull=True,
+            category__in=categs,
+        )
+        started_per_month = active_members.values(
+            'category', 'first_payment_year', 'first_payment_month').annotate(quant=Count('pk'))
+        started = {}
+        for row in started_per_month:
+            yearmonth = (row['first_payment_year'], row['first_payment_month'])
+            started.setdefault(row['category'], []).append((yearmonth, row['quant']))
+
+        # how many quotas exist for those active members for each year/month in the period
+        quotas = Quota.objects.filter(
+            member__in=active_members,
+        ).filter(
+            Q(year__gt=first_year) | Q(year=first_year, month__gte=first_month)
+        ).filter(
+            Q(year__lt=last_year) | Q(year=last_year, month__lte=last_month)
+        ).filter(
+            Q(member__first_payment_year__lt=F('year'))
+            | Q(member__first_payment_year=F('year'), member__first_payment_month__lte=F('month'))
+        ).values('year', 'month', 'member__category').annotate(quant=Count('pk'))
+        paid = {(q['year'], q['month'], q['member__category']): q['quant'] for q in quotas}
+
+        # accumulate the members that started to pay, month after month
+        active = {}
+        for categ in categs:
+            categ_started = sorted(started.get(categ.pk, []))
+            pos = total_active = 0
+            for yearmonth in reversed(yearmonths):
+                while pos < len(categ_started) and categ_started[pos][0] <= yearmonth:
+                    total_active += categ_started[pos][1]
+                    pos += 1
+                active[yearmonth + (categ.pk,)] = total_active
+
         info_per_month = []
         for year, month in yearmonths:
             info = dict(year=year, month=month, members_info=[], total=0, real=0)
             info_per_month.append(info)
 
             for categ in categs:
-                # "active" as in members that already started to pay and didn't shutdown (no
-                # matter when they got the legal_id, really)
-                active_members = Member.objects.filter(
-                    first_payment_month__isnull=False,
-                    shutdown_date__isnull=True,
-                    category=categ,
-                ).filter(
-                    Q(first_payment_year__lt=year)
-                    | Q(first_payment_year=year, first_payment_month__lte=month)
-                ).all()
-
-                # get how many quotas exist for those members for the given year/month
-                quotas = Quota.objects.filter(
-                    year=year, month=month, member__in=active_members).all()
-
-                member_info = dict(total=len(active_members), paid=len(quotas))
+                total_active = active[(year, month, categ.pk)]
+                total_paid = paid.get((year, month, categ.pk), 0)
+
+                member_info = dict(total=total_active, paid=total_paid)
                 info['members_info'].append(member_info)
 
-                info['total'] += len(active_members) * categ.fee
-                info['real'] += len(quotas) * categ.fee
+                info['total'] += total_active * categ.fee
+                info['real'] += total_paid * categ.fee
 
         context = dict(info_per_month=info_per_month, categories=categs_names)
         return render(request, 'members/report_income_quotas.html', context)
@@ -358,26 +390,25 @@ class ReportIncomeMoney(OnlyAdminsViewMixin, View):
     """Handle the report showing income per quotas."""
 
     def get(self, request):
-        # months for last two years
-        today = datetime.date.today()
-        yearmonths = reversed(list(logic.get_year_month_range(today.year - 2, today.month, 24)))
+        yearmonths = _get_report_yearmonths(request)
+        income = logic.get_income_per_month(yearmonths)
 
         info_per_month = []
         for year, month in yearmonths:
-            payments = Payment.objects.filter(
-                timestamp__year=year, timestamp__month=month).aggregate(Sum('amount'))
-            amount = payments['amount__sum'] or '-'
+            amount = income[(year, month)] or '-'
             info_per_month.append(dict(year=year, month=month, amount=amount))
 
         context = dict(info_per_month=info_per_month)
         return render(request, 'members/report_income_money.html', context)
 
 
-class MembersListView(LoginRequiredMixin, ListView):
+class MembersListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = Member
     context_object_name = 'members_list'
     template_name = 'members/members_list.html'
     paginate_by = DEFAULT_PAGINATION
+    ordering = ('legal_id', 'pk')
+    approximate_count = True
     search_fields = {
         'person__first_name': 'icontains',
         'person__last_name': 'icontains',
@@ -388,7 +419,8 @@ class MembersListView(LoginRequiredMixin, ListView):
     }
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        # the related objects are used to show each member (see Member.entity)
+        queryset = super().get_queryset().select_related('person', 'organization', 'category')
         search_value = self.request.GET.get('search', None)
         if search_value and search_value != '':
             queryset = search_filtered_queryset(queryset, self.search_fields, search_value)
@@ -400,18 +432,33 @@ class MembersListView(LoginRequiredMixin, ListView):
             redirect to member_detail view, else display the filtered
             list of members
         """
-        if self.get_queryset().count() == 1:
-            return redirect('member_detail', self.get_queryset().first().pk)
-        return super().get(request, *args, **kwargs)
+        # the queryset is evaluated only once, to build the page (that is also used to redirect)
+        self.object_list = self.get_queryset()
+        context = self.get_context_data()
+        page = context['page_obj']
+        if len(page) == 1 and not page.has_other_pages():
+            (member,) = page
+            return redirect('member_detail', member.pk)
+        return self.render_to_response(context)
 
 
 class MemberDetailView(LoginRequiredMixin, DetailView):
     model = Member
     template_name = 'members/member_detail.html'
 
-    def _get_last_payments(self, member):
+    def get_queryset(self):
+        return super().get_queryset().select_related(
+            'category', 'person', 'organization', 'patron')
+
+    def _get_quotas(self, member):
+        """Get all the quotas of the member, with their payments and strategies."""
+        return list(
+            Quota.objects.filter(member=member).select_related('payment__strategy'))
+
+    def _get_last_payments(self, member, quotas=None):
         """Get the info for last payments."""
-        quotas = Quota.objects.filter(member=member).all()
+        if quotas is None:
+            quotas = self._get_quotas(member)
         grouped = {}
         for q in quotas:
             grouped.setdefault(q.payment, []).append(q)
@@ -435,13 +482,18 @@ class MemberDetailView(LoginRequiredMixin, DetailView):
     def get_context_data(self, **kwargs):
         # Get the context from base
         context = super().get_context_data(**kwargs)
-        member = self.get_object()
+        member = self.object
+
+        # both the debt and the payments are built from the same quotas
+        quotas = self._get_quotas(member)
         today = datetime.date.today()
-        debt = logic.get_debt_state(member, today.year, today.month)
+        yearmonths_paid = {(q.year, q.month) for q in quotas}
+        debt = logic.get_debt_state(
+            member, today.year, today.month, yearmonths_paid=yearmonths_paid)
         if len(debt) > 1 and member.category.fee > 0:
             context['debtor'] = True
         context['member'] = member
-        context['last_payments_info'] = self._get_last_payments(member)
+        context['last_payments_info'] = self._get_last_payments(member, quotas)
         context['missing_letter'] = not member.has_subscription_letter
         return context
 
@@ -457,6 +509,7 @@ reports_main = ReportsInitialView.as_view()
 report_debts = ReportDebts.as_view()
 report_missing = ReportMissing.as_view()
 report_complete = ReportComplete.as_view()
+mail_batch_status = MailBatchStatus.as_view()
 report_income_quotas = ReportIncomeQuotas.as_view()
 report_income_money = ReportIncomeMoney.as_view()
 members_list = MembersListView.as_view()
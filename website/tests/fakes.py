@@ -0,0 +1,203 @@
+"""Stand-ins for the external services, to be used in the tests."""
+
+import collections
+import datetime
+import hashlib
+import re
+
+from utils import gdrive
+
+# how long the access tickets given by AFIP last
+AFIP_TICKET_TTL = datetime.timedelta(hours=12)
+
+
+class _FakeRequest:
+    """A request to the fake Drive service, executed later."""
+
+    def __init__(self, func, **kwargs):
+        self.func = func
+        self.kwargs = kwargs
+
+    def execute(self):
+        return self.func(**self.kwargs)
+
+
+class FakeDriveService:
+    """Stand-in for the Google Drive service.
+
+    It keeps everything in memory, and counts how many requests were executed.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.requests = collections.Counter()
+
+    def files(self):
+        return self
+
+    def _create(self, body, media_body=None, fields=None):
+        self.requests['create'] += 1
+        item_id = "fake-id-{}".format(len(self.items) + 1)
+        item = {
+            'id': item_id,
+            'name': body['name'],
+            'mimeType': body.get('mimeType', gdrive.DEFAULT_MIMETYPE),
+            'parents': body['parents'],
+        }
+        if media_body is not None:
+            item['content'] = media_body.getbytes(0, media_body.size())
+            item['size'] = str(len(item['content']))
+            item['md5Checksum'] = hashlib.md5(item['content']).hexdigest()
+        self.items[item_id] = item
+        return {'id': item_id}
+
+    def create(self, **kwargs):
+        return _FakeRequest(self._create, **kwargs)
+
+    def _list(self, q, pageSize=None, fields=None):
+        self.requests['list'] += 1
+        # only support the queries we do: "trashed = false and '<id>' in parents", and
+        # optionally "and mimeType = '<type>' and name = '<name>'"
+        (parent,) = re.findall(r"'([^']*)' in parents", q)
+        conditions = dict(re.findall(r"(mimeType|name) = '((?:[^'\\]|\\.)*)'", q))
+        result = []
+        for item in self.items.values():
+            if parent not in item['parents']:
+                continue
+            if 'mimeType' in conditions and item['mimeType'] != conditions['mimeType']:
+                continue
+            if 'name' in conditions and item['name'] != conditions['name'].replace("\\'", "'"):
+                continue
+            result.append({k: v for k, v in item.items() if k != 'content'})
+        return {'files': result}
+
+    def list(self, **kwargs):
+        return _FakeRequest(self._list, **kwargs)
+
+    def list_next(self, request, results):
+        return None
+
+
+class FakeWSAA:
+    """Stand-in for the AFIP authentication service."""
+
+    def __init__(self):
+        self.authentications = 0
+
+    def Autenticar(self, service, certificate, private_key, wsdl=None, cache=None, debug=False):
+        self.authentications += 1
+        expiration = datetime.datetime.now(datetime.timezone.utc) + AFIP_TICKET_TTL
+        self._expiration = expiration.isoformat()
+        return "<fake-ticket {}>".format(self.authentications)
+
+    def ObtenerTagXml(self, tag):
+        if tag == 'expirationTime':
+            return self._expiration
+
+
+class FakeWSFEv1:
+    """Stand-in for the AFIP electronic invoices service.
+
+    It authorizes everything that is correctly numbered.
+    """
+
+    def __init__(self):
+        self.Cuit = None
+        self.ticket = None
+        self.connections = 0
+        self.last_authorized = {}
+        self.authorized = []
+        self._reset()
+
+    def _reset(self):
+        self.factura = None
+        self.ErrMsg = ""
+        self.Observaciones = []
+        self.Resultado = ""
+        self.CAE = ""
+        self.Vencimiento = ""
+        self.FechaCbte = ""
+
+    def SetTicketAcceso(self, ticket):
+        self.ticket = ticket
+
+    def Conectar(self, cache=None, wsdl=None):
+        self.connections += 1
+
+    def CompUltimoAutorizado(self, invoice_type, selling_point):
+        return str(self.last_authorized.get((invoice_type, selling_point), 1))
+
+    def CompTotXRequest(self):
+        return "250"
+
+    def CompConsultar(self, invoice_type, invoice_number, selling_point):
+        self._reset()
+        for factura in self.authorized:
+            if (factura['tipo_cbte'], factura['punto_vta'], int(factura['cbt_desde'])) == (
+                    invoice_type, selling_point, int(invoice_number)):
+                self._set_result(factura)
+                self.FechaCbte = factura['fecha_cbte']
+                return "A"
+        self.ErrMsg = "Invoice not found: {}".format(invoice_number)
+
+    def CrearFactura(self, **header):
+        self._reset()
+        self.factura = dict(header, ivas=[], cmp_asocs=[])
+
+    def AgregarIva(self, **iva):
+        self.factura['ivas'].append(iva)
+
+    def AgregarCmpAsoc(self, **cmp_asoc):
+        self.factura['cmp_asocs'].append(cmp_asoc)
+
+    def _authorize(self, factura):
+        key = (factura['tipo_cbte'], factura['punto_vta'])
+        invoice_number = int(factura['cbt_desde'])
+        if invoice_number != self.last_authorized.get(key, 1) + 1:
+            return "Bad invoice number: {}".format(invoice_number)
+        self.last_authorized[key] = invoice_number
+        factura['cae'] = "{:014d}".format(invoice_number)
+        factura['fch_venc_cae'] = (
+            datetime.date.today() + datetime.timedelta(days=10)).strftime("%Y%m%d")
+        self.authorized.append(factura)
+
+    def _set_result(self, factura):
+        self.Resultado = "A"
+        self.CAE = factura['cae']
+        self.Vencimiento = factura['fch_venc_cae']
+
+    def CAESolicitar(self):
+        factura = self.factura
+        self.ErrMsg = self._authorize(factura) or ""
+        if not self.ErrMsg:
+            self._set_result(factura)
+            return self.CAE
+
+    def IniciarFacturasX(self):
+        self._reset()
+        self.facturas = []
+
+    def AgregarFacturaX(self):
+        self.facturas.append(self.factura)
+
+    def CAESolicitarX(self):
+        self.ErrMsg = ""
+        self.results = []
+        for factura in self.facturas:
+            error = self._authorize(factura)
+            self.results.append(error)
+            if error:
+                # the following ones will fail too
+                break
+        if len(self.results) != len(self.facturas):
+            self.results.extend(["Not processed"] * (len(self.facturas) - len(self.results)))
+        return len(self.facturas)
+
+    def LeerFacturaX(self, idx):
+        self._reset()
+        if self.results[idx]:
+            self.Resultado = "R"
+            self.Observaciones = [self.results[idx]]
+        else:
+            self._set_result(self.facturas[idx])
+        return True
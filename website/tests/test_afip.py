@@ -0,0 +1,354 @@
+"""Tests for the AFIP integration, using the offline stand-ins of its services."""
+
+import datetime
+import os
+import tempfile
+import unittest
+
+from decimal import Decimal
+
+from unittest.mock import patch
+
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase
+
+from tests.fakes import FakeWSAA, FakeWSFEv1
+from utils.pipeline import StageTimings
+
+try:
+    from utils import afip
+    from events.management.commands import generate_massive_invoices
+except ImportError:
+    # pyafipws is not installed
+    afip = None
+
+SELLING_POINT = 9
+
+
+@unittest.skipIf(afip is None, "pyafipws is not installed")
+class AFIPSessionTestCase(SimpleTestCase):
+    """Tests for the reusable AFIP session."""
+
+    def setUp(self):
+        super().setUp()
+        cert = tempfile.NamedTemporaryFile(suffix='.crt')
+        key = tempfile.NamedTemporaryFile(suffix='.key')
+        self.addCleanup(cert.close)
+        self.addCleanup(key.close)
+        override = self.settings(
+            AFIP=dict(settings.AFIP, auth_cert_path=cert.name, auth_key_path=key.name))
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def _build_session(self):
+        return afip.AFIPSession(wsaa_class=FakeWSAA, wsfev1_class=FakeWSFEv1)
+
+    def test_reused(self):
+        session = self._build_session()
+        client = session.get_client()
+        self.assertIs(session.get_client(), client)
+        self.assertIs(session.get_client(), client)
+
+        self.assertEqual((session.hits, session.misses), (2, 1))
+        self.assertEqual(client.connections, 1)
+        self.assertEqual(client.Cuit, settings.AFIP['cuit'])
+        self.assertIsNotNone(client.ticket)
+        self.assertIn("2 hit(s), 1 miss(es)", session.report())
+
+    def test_renewed_when_expiring(self):
+        session = self._build_session()
+        client = session.get_client()
+        client.ticket = None
+
+        # the ticket is about to expire
+        now = datetime.datetime.now(datetime.timezone.utc)
+        session._expiration = now + afip.TICKET_MARGIN / 2
+        self.assertIs(session.get_client(), client)
+
+        # a new ticket, but the same connection
+        self.assertEqual((session.hits, session.misses), (0, 2))
+        self.assertIsNotNone(client.ticket)
+        self.assertEqual(client.connections, 1)
+        self.assertGreater(session._expiration, now + afip.TICKET_MARGIN)
+
+    def test_expiration_unknown(self):
+        session = self._build_session()
+        before = datetime.datetime.now(datetime.timezone.utc)
+        with patch.object(FakeWSAA, 'ObtenerTagXml', return_value=None):
+            session.get_client()
+        self.assertGreaterEqual(session._expiration, before + afip.TICKET_TTL)
+
+        # still reused
+        session.get_client()
+        self.assertEqual((session.hits, session.misses), (1, 1))
+
+    def test_missing_certificate(self):
+        session = self._build_session()
+        with self.settings(AFIP=dict(settings.AFIP, auth_cert_path='/nonexistent.crt')):
+            with self.assertRaises(ValueError):
+                session.get_client()
+        self.assertIsNone(session._wsfev1)
+
+    def test_shared_session_built_on_first_use(self):
+        with patch.object(afip, '_session', None):
+            session = afip.get_session()
+            self.assertIsInstance(session, afip.AFIPSession)
+            self.assertIs(afip.get_session(), session)
+
+
+def _build_invoices(first_number, quantity):
+    """Build consecutive massive invoices."""
+    invoices = []
+    for invoice_number in range(first_number, first_number + quantity):
+        invoice = afip.MassiveProductSellingInvoice(
+            invoice_number=invoice_number, invoice_date=datetime.date(2020, 1, 1),
+            selling_point=SELLING_POINT)
+        invoice.add_item(description="Remera", quantity=1, amount=Decimal(100))
+        invoices.append(invoice)
+    return invoices
+
+
+def _fake_render_pdfs(invoices, selling_point):
+    """Don't really render the PDFs."""
+    return ["pdf-{}".format(invoice.header['cbte_nro']) for invoice in invoices]
+
+
+@unittest.skipIf(afip is None, "pyafipws is not installed")
+class AuthorizeBatchTestCase(SimpleTestCase):
+    """Tests for the authorization of several invoices in one request."""
+
+    def setUp(self):
+        super().setUp()
+        self.wsfev1 = FakeWSFEv1()
+        self.wsfev1.last_authorized[(afip.INVOICE_TYPE, SELLING_POINT)] = 10
+
+    def test_all_authorized(self):
+        invoices = _build_invoices(11, 3)
+        with patch('sys.stdout'):
+            result = afip.authorize_batch(self.wsfev1, invoices)
+
+        self.assertEqual(result, [True, True, True])
+        for invoice in invoices:
+            self.assertEqual(invoice.header['resultado'], "A")
+            self.assertEqual(invoice.header['cae'], "{:014d}".format(invoice.header['cbte_nro']))
+            self.assertTrue(invoice.header['fch_venc_cae'])
+        self.assertEqual(self.wsfev1.last_authorized[(afip.INVOICE_TYPE, SELLING_POINT)], 13)
+
+    def test_partially_rejected(self):
+        # a gap in the numbers: the second and the following ones are rejected
+        invoices = _build_invoices(11, 1) + _build_invoices(13, 2)
+        with patch('sys.stdout'):
+            result = afip.authorize_batch(self.wsfev1, invoices)
+
+        self.assertEqual(result, [True, False, False])
+        self.assertEqual(invoices[0].header['resultado'], "A")
+        for invoice in invoices[1:]:
+            self.assertEqual(invoice.header['resultado'], "R")
+            self.assertEqual(invoice.header['cae'], "")
+        self.assertEqual(self.wsfev1.last_authorized[(afip.INVOICE_TYPE, SELLING_POINT)], 11)
+
+    def test_request_error(self):
+        def _fail():
+            self.wsfev1.ErrMsg = "service down"
+
+        with patch.object(self.wsfev1, 'CAESolicitarX', side_effect=_fail):
+            with self.assertRaisesRegex(RuntimeError, "service down"):
+                afip.authorize_batch(self.wsfev1, _build_invoices(11, 2))
+
+    def test_recover(self):
+        with patch('sys.stdout'):
+            afip.authorize_batch(self.wsfev1, _build_invoices(11, 2))
+
+            # the same invoice, built again later
+            (invoice,) = _build_invoices(12, 1)
+            self.assertTrue(invoice.recover(self.wsfev1))
+        self.assertEqual(invoice.header['cae'], "{:014d}".format(12))
+        self.assertEqual(invoice.header['fecha_cbte'], "20200101")
+
+    def test_recover_not_authorized(self):
+        (invoice,) = _build_invoices(11, 1)
+        with self.assertRaisesRegex(RuntimeError, "not found"):
+            invoice.recover(self.wsfev1)
+
+    def test_in_batches_stops_when_rejected(self):
+        invoices = _build_invoices(11, 2) + _build_invoices(14, 3)
+        with patch.object(afip, '_get_afip', return_value=self.wsfev1):
+            with patch.object(afip, 'render_pdfs', side_effect=_fake_render_pdfs):
+                with patch('sys.stdout'):
+                    results = afip.process_invoices_in_batches(
+                        invoices, SELLING_POINT, batch_size=2)
+
+        # the first batch ok, the second rejected from its first one, the third not sent
+        self.assertEqual(
+            {number: result['invoice_ok'] for number, result in results.items()},
+            {11: True, 12: True, 14: False})
+        self.assertEqual(results[12]['pdf_path'], "pdf-12")
+
+
+@unittest.skipIf(afip is None, "pyafipws is not installed")
+class MassiveInvoicesTestCase(SimpleTestCase):
+    """Tests for resuming the generation of massive invoices."""
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
+
+        self.journal_dir = os.path.join(self.temp_dir, "journals")
+        override = self.settings(MASSIVE_INVOICES_JOURNAL_DIR=self.journal_dir)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.wsfev1 = FakeWSFEv1()
+        self.uploaded = []
+        for patcher in [
+                patch.object(afip, '_get_afip', return_value=self.wsfev1),
+                patch.object(afip, '_render_pdf', side_effect=self._fake_render_pdf),
+                patch.object(afip, 'PDF_PATH', self.temp_dir),
+                patch.object(afip, 'PDF_PROCESSES', 1),
+                patch('utils.gdrive.upload_invoice', side_effect=self._fake_upload),
+                patch('sys.stdout')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.fail_upload = None
+
+    def _fake_render_pdf(self, invoice, pdf_path):
+        with open(pdf_path, 'wt', encoding='ascii') as fh:
+            fh.write(str(invoice.header['cbte_nro']))
+        return pdf_path
+
+    def _fake_upload(self, pdf_path, invoice_date, base_folder):
+        with open(pdf_path, 'rt', encoding='ascii') as fh:
+            invoice_number = int(fh.read())
+        if invoice_number == self.fail_upload:
+            raise ValueError("gdrive is down")
+        self.uploaded.append(invoice_number)
+
+    def _get_journal(self, starting_invoice_number):
+        journal_name = "massive-invoices-{:04d}-{:08d}.json".format(
+            SELLING_POINT, starting_invoice_number)
+        return generate_massive_invoices._Journal(os.path.join(self.journal_dir, journal_name))
+
+    def test_journal(self):
+        journal = self._get_journal(2)
+        self.assertFalse(journal.found)
+        journal.mark_uploaded(3)
+        journal.mark_uploaded(2)
+
+        journal = self._get_journal(2)
+        self.assertTrue(journal.found)
+        self.assertEqual(journal.uploaded, {2, 3})
+
+        journal.start()
+        self.assertEqual(self._get_journal(2).uploaded, set())
+
+    def test_journal_private(self):
+        os.mkdir(self.journal_dir, mode=0o755)
+        call_command('generate_massive_invoices', '2', '2', "Remera", '100', '--workers=1')
+        self.assertEqual(os.stat(self.journal_dir).st_mode & 0o777, 0o700)
+        self.assertEqual(self._get_journal(2).uploaded, {2, 3})
+
+    def test_resume(self):
+        # the upload of the second invoice fails, the third is authorized anyway
+        self.fail_upload = 3
+        with self.assertRaises(ValueError):
+            call_command('generate_massive_invoices', '3', '2', "Remera", '100', '--workers=1')
+        self.assertEqual(self.uploaded, [2])
+        self.assertEqual(self.wsfev1.last_authorized[(afip.INVOICE_TYPE, SELLING_POINT)], 4)
+        self.assertEqual(self._get_journal(2).uploaded, {2})
+
+        # those authorized but not uploaded are recovered, and the rest authorized
+        self.fail_upload = None
+        call_command(
+            'generate_massive_invoices', '4', '2', "Remera", '100', '--resume', '--workers=1')
+        self.assertEqual(self.uploaded, [2, 3, 4, 5])
+        self.assertEqual(self.wsfev1.last_authorized[(afip.INVOICE_TYPE, SELLING_POINT)], 5)
+        self.assertEqual(self._get_journal(2).uploaded, {2, 3, 4, 5})
+
+    def test_resume_without_journal(self):
+        with self.assertRaisesRegex(CommandError, "journal not found"):
+            call_command('generate_massive_invoices', '3', '2', "Remera", '100', '--resume')
+        self.assertEqual(self.uploaded, [])
+
+
+class _FakeFEPDF:
+    """A PDF builder that is not loaded from the invoice format, but knows where it was built."""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.used = False
+
+
+class _PidInvoice:
+    """An invoice that "renders" in its PDF the process that rendered it."""
+
+    def __init__(self, invoice_number):
+        self.header = {'cbte_nro': invoice_number}
+
+    def generate_pdf(self, fepdf, filepath):
+        # a fresh builder for each invoice, built where it's rendered
+        assert not fepdf.used
+        assert fepdf.pid == os.getpid()
+        fepdf.used = True
+        with open(filepath, 'wt', encoding='ascii') as fh:
+            fh.write(str(os.getpid()))
+
+
+@unittest.skipIf(afip is None, "pyafipws is not installed")
+class RenderPDFsTestCase(SimpleTestCase):
+    """Tests for rendering the invoices PDFs in the pool of processes."""
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        for patcher in [
+                patch.object(afip, 'PDF_PATH', temp_dir.name),
+                patch.object(afip, '_build_fepdf', side_effect=_FakeFEPDF),
+                patch.object(afip, '_pdf_pool', None)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self._shutdown_pool)
+
+    def _shutdown_pool(self):
+        if afip._pdf_pool is not None:
+            afip._pdf_pool.shutdown()
+
+    def _get_pids(self, pdf_paths):
+        pids = []
+        for pdf_path in pdf_paths:
+            with open(pdf_path, 'rt', encoding='ascii') as fh:
+                pids.append(int(fh.read()))
+        return pids
+
+    def test_in_pool(self):
+        invoices = [_PidInvoice(invoice_number) for invoice_number in range(11, 15)]
+        with patch.object(afip, 'PDF_PROCESSES', 2):
+            pdf_paths = afip.render_pdfs(invoices, SELLING_POINT)
+
+        # in order, and all rendered in other processes
+        self.assertEqual(
+            [os.path.basename(path) for path in pdf_paths],
+            ["FacturaPyArAC-0009-{:08d}.pdf".format(number) for number in range(11, 15)])
+        self.assertNotIn(os.getpid(), self._get_pids(pdf_paths))
+
+    def test_one_process(self):
+        invoices = [_PidInvoice(invoice_number) for invoice_number in range(11, 13)]
+        with patch.object(afip, 'PDF_PROCESSES', 1):
+            pdf_paths = afip.render_pdfs(invoices, SELLING_POINT)
+
+        self.assertEqual(self._get_pids(pdf_paths), [os.getpid()] * 2)
+        self.assertIsNone(afip._pdf_pool)
+
+    def test_each_invoice_in_pool(self):
+        # as when post-processing invoices authorized one by one
+        timings = StageTimings()
+        with patch.object(afip, 'PDF_PROCESSES', 2):
+            with patch('sys.stdout'):
+                pdf_path = afip._generate_pdf(_PidInvoice(11), SELLING_POINT, timings)
+
+        (pid,) = self._get_pids([pdf_path])
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(timings.counts, {'pdf': 1})
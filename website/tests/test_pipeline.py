@@ -0,0 +1,102 @@
+"""Tests for the pipeline helpers."""
+
+import threading
+import unittest
+
+from utils.pipeline import StageTimings, run_pipeline
+
+
+class RunPipelineTestCase(unittest.TestCase):
+    """Tests for the two stages pipeline."""
+
+    def test_ordered_stage_in_order(self):
+        called = []
+
+        def _ordered(item):
+            called.append((item, threading.current_thread()))
+            return item * 10
+
+        results = run_pipeline(range(5), _ordered, lambda partial: partial + 1, workers=3)
+
+        self.assertEqual([item for item, _ in called], [0, 1, 2, 3, 4])
+        self.assertEqual({thread for _, thread in called}, {threading.current_thread()})
+        self.assertEqual(results, [1, 11, 21, 31, 41])
+
+    def test_post_stage_concurrent(self):
+        # the first post stage waits until the last item went through the ordered stage
+        last_ordered = threading.Event()
+
+        def _ordered(item):
+            if item == 2:
+                last_ordered.set()
+            return item
+
+        def _post(item):
+            if item == 0:
+                self.assertTrue(last_ordered.wait(timeout=5))
+            return threading.current_thread()
+
+        threads = run_pipeline(range(3), _ordered, _post, workers=2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_stop_when_none(self):
+        called = []
+
+        def _ordered(item):
+            called.append(item)
+            if item == 2:
+                return
+            return item
+
+        results = run_pipeline(range(5), _ordered, lambda partial: partial, workers=2)
+        self.assertEqual(called, [0, 1, 2])
+        self.assertEqual(results, [0, 1])
+
+    def test_ordered_stage_error(self):
+        posted = []
+
+        def _ordered(item):
+            if item == 1:
+                raise ValueError("bad item")
+            return item
+
+        with self.assertRaises(ValueError):
+            run_pipeline(range(3), _ordered, posted.append, workers=2)
+        self.assertEqual(posted, [0])
+
+    def test_post_stage_error(self):
+        ordered = []
+
+        def _ordered(item):
+            ordered.append(item)
+            return item
+
+        def _post(item):
+            if item == 0:
+                raise ValueError("bad item")
+            return item
+
+        with self.assertRaises(ValueError):
+            run_pipeline(range(3), _ordered, _post, workers=2)
+
+        # the failure is raised after all the items were processed
+        self.assertEqual(ordered, [0, 1, 2])
+
+
+class StageTimingsTestCase(unittest.TestCase):
+    """Tests for the stages timings."""
+
+    def test_report(self):
+        timings = StageTimings()
+        with timings.measure('first'):
+            pass
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                with timings.measure('second'):
+                    raise ValueError()
+
+        self.assertEqual(timings.counts, {'first': 1, 'second': 2})
+        lines = timings.report()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("first: 1 item(s) in "))
+        self.assertTrue(lines[1].startswith("second: 2 item(s) in "))
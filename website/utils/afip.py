@@ -1,13 +1,25 @@
+import concurrent.futures
+import datetime
 import os
+import threading
+import time
 from decimal import Decimal
 
+import dateutil.parser
 from pyafipws.wsaa import WSAA
 from pyafipws.wsfev1 import WSFEv1
 from pyafipws.pyfepdf import FEPDF
 
 from django.conf import settings
 
+from utils.pipeline import StageTimings, run_pipeline
+
 CACHE = "/tmp/pyafip-cache-real"
+
+# how long the access tickets last (in case AFIP does not tell), and how much before
+# their expiration we get a new one
+TICKET_TTL = datetime.timedelta(hours=12)
+TICKET_MARGIN = datetime.timedelta(minutes=10)
 CONFIG_PDF = {
     'LOGO': "static/images/acpyar.png",
     'EMPRESA': "Asociación Civil Python Argentina",
@@ -20,6 +32,15 @@ CONFIG_PDF = {
 
 PDF_PATH = "/tmp"
 
+# how many processes render PDFs at the same time
+PDF_PROCESSES = os.cpu_count() or 1
+
+# max invoices to authorize in the same request (AFIP may allow less)
+BATCH_SIZE = 100
+
+# how many invoices are post-processed (PDF generation, etc.) at the same time
+POST_PROCESS_WORKERS = 4
+
 INVOICE_TYPE = 6
 
 IVA_CODES = {
@@ -29,26 +50,96 @@ IVA_CODES = {
     Decimal(27): 6,
 }
 
+# the session to AFIP, reused by everybody in this process
+_session = None
+_session_lock = threading.Lock()
+
+# the pool of processes to render PDFs
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
+
+class AFIPSession:
+    """An authenticated and connected client to AFIP, reused while its access ticket is valid.
+
+    It also counts how many times the client was reused (hits) or needed a new access
+    ticket (misses), and how long the authentications took.
+    """
+
+    def __init__(self, wsaa_class=WSAA, wsfev1_class=WSFEv1):
+        self.wsaa_class = wsaa_class
+        self.wsfev1_class = wsfev1_class
+        self._lock = threading.Lock()
+        self._wsfev1 = None
+        self._expiration = None
+        self.hits = 0
+        self.misses = 0
+        self.auth_seconds = 0
+
+    def _authenticate(self):
+        """Get a new access ticket (token and sign)."""
+        certificate = settings.AFIP['auth_cert_path']
+        private_key = settings.AFIP['auth_key_path']
+        if not os.path.exists(certificate):
+            raise ValueError("Auth certificate can not be found (got {!r})".format(certificate))
+        if not os.path.exists(private_key):
+            raise ValueError("Auth key can not be found (got {!r})".format(private_key))
+
+        wsaa = self.wsaa_class()
+        ta = wsaa.Autenticar(
+            "wsfe", certificate, private_key, wsdl=settings.AFIP['url_wsaa'],
+            cache=CACHE, debug=True)
+
+        # when the ticket expires (if can't find out, assume the default TTL)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            expiration = dateutil.parser.parse(wsaa.ObtenerTagXml('expirationTime'))
+        except (TypeError, ValueError):
+            expiration = now + TICKET_TTL
+        return ta, expiration
+
+    def get_client(self):
+        """Return the connected client, authenticating and connecting only if needed."""
+        with self._lock:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if self._wsfev1 is not None and now < self._expiration - TICKET_MARGIN:
+                self.hits += 1
+                return self._wsfev1
+
+            self.misses += 1
+            t0 = time.monotonic()
+            ta, self._expiration = self._authenticate()
+            self.auth_seconds += time.monotonic() - t0
+
+            if self._wsfev1 is None:
+                wsfev1 = self.wsfev1_class()
+                wsfev1.Cuit = settings.AFIP['cuit']
+                wsfev1.SetTicketAcceso(ta)
+                wsfev1.Conectar(CACHE, settings.AFIP['url_wsfev1'])
+                self._wsfev1 = wsfev1
+            else:
+                # already connected, just refresh the ticket
+                self._wsfev1.SetTicketAcceso(ta)
+            return self._wsfev1
+
+    def report(self):
+        """Return a line with the usage counters."""
+        return "AFIP session: {} hit(s), {} miss(es), {:.2f}s authenticating".format(
+            self.hits, self.misses, self.auth_seconds)
+
+
+def get_session():
+    """Get the session to AFIP, the same one for everybody (built on first use)."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = AFIPSession()
+    return _session
+
 
 def _get_afip():
-    """Build and authenticate AFIP structure."""
-    # AFIP init
-    wsaa = WSAA()
-    wsfev1 = WSFEv1()
-
-    # get access ticket (token y sign)
-    certificate = settings.AFIP['auth_cert_path']
-    private_key = settings.AFIP['auth_key_path']
-    if not os.path.exists(certificate):
-        raise ValueError("Auth certificate can not be found (got {!r})".format(certificate))
-    if not os.path.exists(private_key):
-        raise ValueError("Auth key can not be found (got {!r})".format(private_key))
-    ta = wsaa.Autenticar(
-        "wsfe", certificate, private_key, wsdl=settings.AFIP['url_wsaa'], cache=CACHE, debug=True)
-    wsfev1.Cuit = settings.AFIP['cuit']
-    wsfev1.SetTicketAcceso(ta)
-    wsfev1.Conectar(CACHE, settings.AFIP['url_wsfev1'])
-    return wsfev1
+    """Get the authenticated AFIP structure."""
+    return get_session().get_client()
 
 
 def verify_service(selling_point):
@@ -63,11 +154,8 @@ def verify_service(selling_point):
     return int(last_auth_invoice)
 
 
-def process_invoices(invoices, selling_point):
-    """Generate the invoices in PDF using AFIP API resources."""
-    wsfev1 = _get_afip()
-
-    # init PDF builder
+def _build_fepdf():
+    """Build the PDF builder with the invoice template and our data."""
     fepdf = FEPDF()
     fepdf.CargarFormato(os.path.join(settings.BASE_DIR, "templates", "factura.csv"))
     fepdf.FmtCantidad = "0.2"
@@ -82,11 +170,90 @@ def process_invoices(invoices, selling_point):
             "DEMO", 'T', 120, 260, 0, 0, text="DEMOSTRACION",
             size=70, rotate=45, foreground=0x808080, priority=-1)
         fepdf.AgregarDato("motivos_obs", "Ejemplo Sin Validez Fiscal")
+    return fepdf
+
+
+def _get_pdf_path(invoice, selling_point):
+    """Prepare the invoice to be rendered, return where its PDF will be."""
+    # another safeguard
+    if "homo" in settings.AFIP['url_wsfev1']:
+        invoice.header["motivos_obs"] = "Ejemplo Sin validez fiscal"
+
+    invoice_number = invoice.header["cbte_nro"]
+    pdf_name = "FacturaPyArAC-{:04d}-{:08d}.pdf".format(selling_point, invoice_number)
+    return os.path.join(PDF_PATH, pdf_name)
+
 
-    # get CAE for each record and generate corresponding PDF
+def _render_pdf(invoice, pdf_path):
+    """Render the invoice PDF (this is what runs in the pool of processes).
+
+    Each invoice gets its own PDF builder, created in the process that renders it.
+    """
+    invoice.generate_pdf(_build_fepdf(), pdf_path)
+    return pdf_path
+
+
+def _get_pdf_pool():
+    """Get the pool of processes to render PDFs."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            _pdf_pool = concurrent.futures.ProcessPoolExecutor(max_workers=PDF_PROCESSES)
+    return _pdf_pool
+
+
+def _generate_pdf(invoice, selling_point, timings):
+    """Generate the PDF for the authorized invoice, return its path.
+
+    It's rendered in the pool of processes (if more than one is configured), so the workers
+    calling this from different threads really render at the same time.
+    """
+    pdf_path = _get_pdf_path(invoice, selling_point)
+    with timings.measure('pdf'):
+        if PDF_PROCESSES <= 1:
+            _render_pdf(invoice, pdf_path)
+        else:
+            _get_pdf_pool().submit(_render_pdf, invoice, pdf_path).result()
+    print("    PDF generated {!r}".format(pdf_path))
+    return pdf_path
+
+
+def render_pdfs(invoices, selling_point):
+    """Render the PDFs for the authorized invoices using all the cores, return their paths."""
+    pdf_paths = [_get_pdf_path(invoice, selling_point) for invoice in invoices]
+    if PDF_PROCESSES <= 1 or len(invoices) <= 1:
+        # not worth going to other processes
+        return [_render_pdf(invoice, path) for invoice, path in zip(invoices, pdf_paths)]
+    return list(_get_pdf_pool().map(_render_pdf, invoices, pdf_paths))
+
+
+def process_invoices(
+        invoices, selling_point, on_authorized=None, post_process=None,
+        workers=POST_PROCESS_WORKERS, timings=None, recovering=False):
+    """Generate the invoices in PDF using AFIP API resources.
+
+    The invoices are authorized one after the other (in order, as the numbers need to be
+    sequential for AFIP), calling `on_authorized` with the invoice number after each one.
+    Meanwhile, the PDFs for those already authorized are generated by a pool of workers,
+    calling then `post_process` with the invoice number and the PDF path (from the worker),
+    which result is also returned.
+
+    If `recovering`, the invoices were already authorized, the authorization info is just
+    retrieved from AFIP.
+
+    The time spent in each stage is accumulated in `timings`, if given.
+    """
+    if timings is None:
+        timings = StageTimings()
+    wsfev1 = _get_afip()
     results = {}
-    for invoice in invoices:
-        authorized_ok = invoice.autorizar(wsfev1)
+
+    def _authorize(invoice):
+        with timings.measure('afip'):
+            if recovering:
+                authorized_ok = invoice.recover(wsfev1)
+            else:
+                authorized_ok = invoice.autorizar(wsfev1)
         invoice_number = invoice.header["cbte_nro"]
         print("    invoice generated: number={} CAE={} authorized={}".format(
             invoice_number, invoice.header["cae"], authorized_ok))
@@ -95,17 +262,99 @@ def process_invoices(invoices, selling_point):
             print("WARNING not auth")
             return
 
-        # another safeguard
-        if "homo" in settings.AFIP['url_wsfev1']:
-            invoice.header["motivos_obs"] = "Ejemplo Sin validez fiscal"
+        if on_authorized is not None:
+            on_authorized(invoice_number)
+        return invoice
 
-        # generate the PDF
-        pdf_name = "FacturaPyArAC-{:04d}-{:08d}.pdf".format(selling_point, invoice_number)
-        pdf_path = os.path.join(PDF_PATH, pdf_name)
-        invoice.generate_pdf(fepdf, pdf_path)
-        print("    PDF generated {!r}".format(pdf_path))
+    def _post_process(invoice):
+        invoice_number = invoice.header["cbte_nro"]
+        pdf_path = _generate_pdf(invoice, selling_point, timings)
         results[invoice_number]['pdf_path'] = pdf_path
 
+        if post_process is not None:
+            results[invoice_number]['post_process'] = post_process(invoice_number, pdf_path)
+
+    run_pipeline(invoices, _authorize, _post_process, workers)
+    return results
+
+
+def authorize_batch(wsfev1, invoices):
+    """Authorize several consecutive invoices in only one request to AFIP.
+
+    Return if each invoice was authorized ok.
+    """
+    wsfev1.IniciarFacturasX()
+    for invoice in invoices:
+        invoice._load(wsfev1)
+        wsfev1.AgregarFacturaX()
+
+    wsfev1.CAESolicitarX()
+    if wsfev1.ErrMsg:
+        raise RuntimeError(wsfev1.ErrMsg)
+
+    results = []
+    for idx, invoice in enumerate(invoices):
+        wsfev1.LeerFacturaX(idx)
+        results.append(invoice._store_result(wsfev1))
+    return results
+
+
+def process_invoices_in_batches(
+        invoices, selling_point, batch_size=BATCH_SIZE, on_authorized=None, post_process=None,
+        workers=POST_PROCESS_WORKERS, timings=None):
+    """Generate the invoices in PDF authorizing them in batches.
+
+    It's the same as `process_invoices` but authorizing several invoices in each request
+    to AFIP (as many as it allows, up to `batch_size`); the invoices need to be consecutive.
+    """
+    if timings is None:
+        timings = StageTimings()
+    wsfev1 = _get_afip()
+    batch_size = min(batch_size, int(wsfev1.CompTotXRequest()))
+    results = {}
+    stopped = False
+
+    def _batches():
+        for idx in range(0, len(invoices), batch_size):
+            if stopped:
+                # an invoice was not authorized, the following ones can't be
+                break
+            yield invoices[idx:idx + batch_size]
+
+    def _authorize(batch):
+        nonlocal stopped
+        with timings.measure('afip'):
+            authorized = authorize_batch(wsfev1, batch)
+
+        authorized_invoices = []
+        for invoice, authorized_ok in zip(batch, authorized):
+            invoice_number = invoice.header["cbte_nro"]
+            print("    invoice generated: number={} CAE={} authorized={}".format(
+                invoice_number, invoice.header["cae"], authorized_ok))
+            results[invoice_number] = {'invoice_ok': authorized_ok}
+            if not authorized_ok:
+                print("WARNING not auth")
+                stopped = True
+                break
+
+            if on_authorized is not None:
+                on_authorized(invoice_number)
+            authorized_invoices.append(invoice)
+
+        # still post-process what was authorized, even if stopping
+        return authorized_invoices or None
+
+    def _post_process(batch):
+        with timings.measure('pdf (batch)'):
+            pdf_paths = render_pdfs(batch, selling_point)
+        for invoice, pdf_path in zip(batch, pdf_paths):
+            invoice_number = invoice.header["cbte_nro"]
+            print("    PDF generated {!r}".format(pdf_path))
+            results[invoice_number]['pdf_path'] = pdf_path
+            if post_process is not None:
+                results[invoice_number]['post_process'] = post_process(invoice_number, pdf_path)
+
+    run_pipeline(_batches(), _authorize, _post_process, workers)
     return results
 
 
@@ -176,8 +425,8 @@ class _BaseInvoice:
         iva["base_imp"] += base_imp
         iva["importe"] += importe
 
-    def autorizar(self, wsfev1):
-        "Prueba de autorización de un comprobante (obtención de CAE)"
+    def _load(self, wsfev1):
+        """Load the invoice in the web service client, to be authorized."""
         self.header["cbt_desde"] = self.header["cbte_nro"]
         self.header["cbt_hasta"] = self.header["cbte_nro"]
         wsfev1.CrearFactura(**self.header)
@@ -190,12 +439,8 @@ class _BaseInvoice:
         for iva in self.ivas.values():
             wsfev1.AgregarIva(**iva)
 
-        # llamo al websevice para obtener el CAE:
-        wsfev1.CAESolicitar()
-
-        if wsfev1.ErrMsg:
-            raise RuntimeError(wsfev1.ErrMsg)
-
+    def _store_result(self, wsfev1):
+        """Get the authorization result from the web service client."""
         for obs in wsfev1.Observaciones:
             print("WARNING", obs)
 
@@ -206,6 +451,27 @@ class _BaseInvoice:
         self.header["fch_venc_cae"] = wsfev1.Vencimiento
         return authorized_ok
 
+    def autorizar(self, wsfev1):
+        "Prueba de autorización de un comprobante (obtención de CAE)"
+        self._load(wsfev1)
+
+        # llamo al websevice para obtener el CAE:
+        wsfev1.CAESolicitar()
+
+        if wsfev1.ErrMsg:
+            raise RuntimeError(wsfev1.ErrMsg)
+        return self._store_result(wsfev1)
+
+    def recover(self, wsfev1):
+        """Get the authorization info of an invoice that was already authorized."""
+        wsfev1.CompConsultar(
+            self.header["tipo_cbte"], self.header["cbte_nro"], self.header["punto_vta"])
+        if wsfev1.ErrMsg:
+            raise RuntimeError(wsfev1.ErrMsg)
+        if getattr(wsfev1, 'FechaCbte', None):
+            self.header["fecha_cbte"] = wsfev1.FechaCbte
+        return self._store_result(wsfev1)
+
     def generate_pdf(self, fepdf, filepath):
         """Generate the invoice image."""
         fepdf.CrearFactura(**self.header)
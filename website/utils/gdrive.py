@@ -1,7 +1,10 @@
+import json
 import logging
 import mimetypes
 import os
 import shutil
+import threading
+import time
 
 import httplib2
 from apiclient import discovery, http
@@ -14,6 +17,19 @@ APPLICATION_NAME = 'AutoFacturador'
 SETTINGS_FILE = "/tmp/gdrive_settings.json"
 
 DEFAULT_MIMETYPE = 'application/octet-stream'
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+
+# size of each chunk when uploading from open files (must be multiple of 256 KB)
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# where and how long the folders ids are cached
+FOLDER_CACHE_FILE = "/tmp/gdrive_folders.json"
+FOLDER_CACHE_TTL = 7 * 24 * 60 * 60
+
+# an explorer per thread (they can not be shared), and the cache shared by all of them
+_thread_data = threading.local()
+_folder_cache = None
+_folder_cache_lock = threading.Lock()
 
 # turn off overdetailed debugging
 httplib2.debuglevel = 0
@@ -47,36 +63,125 @@ def get_credentials():
     return credentials
 
 
+class FolderCache:
+    """Persistent cache of the folders ids, by parent and name, that expire after some time."""
+
+    def __init__(self, filepath=FOLDER_CACHE_FILE, ttl=FOLDER_CACHE_TTL):
+        self.filepath = filepath
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._folder_locks = {}
+        try:
+            with open(filepath, 'rt', encoding='utf8') as fh:
+                self._data = json.load(fh)
+        except (OSError, ValueError):
+            self._data = {}
+
+    def _key(self, parent, name):
+        return "{}/{}".format(parent, name)
+
+    def folder_lock(self, parent, name):
+        """Return the lock to hold while finding or creating the folder (once per folder)."""
+        with self._lock:
+            return self._folder_locks.setdefault(self._key(parent, name), threading.Lock())
+
+    def get(self, parent, name):
+        """Return the cached id for the folder, None if not there or expired."""
+        with self._lock:
+            info = self._data.get(self._key(parent, name))
+        if info is None or time.time() - info['stored'] > self.ttl:
+            return
+        return info['id']
+
+    def set(self, parent, name, folder_id):
+        """Store the folder id."""
+        with self._lock:
+            self._data[self._key(parent, name)] = {'id': folder_id, 'stored': time.time()}
+            self._save()
+
+    def forget(self, parent, name):
+        """Remove the folder id from the cache (e.g. the folder is not there anymore)."""
+        with self._lock:
+            if self._data.pop(self._key(parent, name), None) is not None:
+                self._save()
+
+    def _save(self):
+        temp_path = self.filepath + '.tmp'
+        with open(temp_path, 'wt', encoding='utf8') as fh:
+            json.dump(self._data, fh)
+        os.replace(temp_path, self.filepath)
+
+
+def _guess_mimetype(filename):
+    mime_type, _ = mimetypes.guess_type(filename)
+    if mime_type is None:
+        mime_type = DEFAULT_MIMETYPE
+    return mime_type
+
+
 class Explorer:
-    def __init__(self):
-        credentials = get_credentials()
-        authorized_http = credentials.authorize(httplib2.Http())
-        self.service = discovery.build('drive', 'v3', http=authorized_http, cache_discovery=False)
+    def __init__(self, service=None, folder_cache=None):
+        if service is None:
+            credentials = get_credentials()
+            authorized_http = credentials.authorize(httplib2.Http())
+            service = discovery.build('drive', 'v3', http=authorized_http, cache_discovery=False)
+        self.service = service
+        self.folder_cache = FolderCache() if folder_cache is None else folder_cache
 
     def create_folder(self, folder, parent):
         """Create a folder."""
         metadata = {
             'name': folder,
-            'mimeType': 'application/vnd.google-apps.folder',
+            'mimeType': FOLDER_MIMETYPE,
             'parents': [parent],
         }
         resp = self.service.files().create(body=metadata, fields='id').execute()
         return resp['id']
 
+    def find_folder(self, folder, parent):
+        """Find a folder by name in the parent, return its id (None if not there)."""
+        query = "trashed = false and '{}' in parents and mimeType = '{}' and name = '{}'".format(
+            parent, FOLDER_MIMETYPE, folder.replace("'", "\\'"))
+        resp = self.service.files().list(q=query, fields="files(id, name)").execute()
+        if resp['files']:
+            return resp['files'][0]['id']
+
+    def get_folder_id(self, folder, parent):
+        """Get the id of the folder in the parent, creating it if needed (cached).
+
+        The explorers sharing the cache (from different threads) don't find or create the
+        same folder at the same time, so it's not created twice.
+        """
+        folder_id = self.folder_cache.get(parent, folder)
+        if folder_id is None:
+            with self.folder_cache.folder_lock(parent, folder):
+                # other thread may have just done it
+                folder_id = self.folder_cache.get(parent, folder)
+                if folder_id is None:
+                    folder_id = self.find_folder(folder, parent)
+                    if folder_id is None:
+                        folder_id = self.create_folder(folder, parent)
+                    self.folder_cache.set(parent, folder, folder_id)
+        return folder_id
+
     def upload(self, filepath, folder, filename=None):
         """Upload a file to a specific folder."""
         if filename is None:
             filename = os.path.basename(filepath)
+        media = http.MediaFileUpload(filepath, mimetype=_guess_mimetype(filename), resumable=True)
+        self._create_file(media, folder, filename)
+
+    def upload_stream(self, fh, folder, filename):
+        """Upload the content of an open file to a specific folder, by chunks."""
+        media = http.MediaIoBaseUpload(
+            fh, mimetype=_guess_mimetype(filename), chunksize=UPLOAD_CHUNK_SIZE, resumable=True)
+        self._create_file(media, folder, filename)
 
-        mime_type, _ = mimetypes.guess_type(filename)
-        if mime_type is None:
-            mime_type = DEFAULT_MIMETYPE
-        media = http.MediaFileUpload(filepath, mimetype=mime_type, resumable=True)
+    def _create_file(self, media, folder, filename):
         metadata = {
             'name': filename,
             'parents': [folder],
         }
-
         self.service.files().create(body=metadata, media_body=media).execute()
 
     def list_folder(self, folder_id):
@@ -84,7 +189,7 @@ class Explorer:
         files = self.service.files()
         request = files.list(
             pageSize=50, q="trashed = false and '{}' in parents".format(folder_id),
-            fields="nextPageToken, files(id, name, mimeType, size)")
+            fields="nextPageToken, files(id, name, mimeType, size, md5Checksum)")
 
         all_items = []
         while request is not None:
@@ -95,21 +200,40 @@ class Explorer:
         return all_items
 
 
+def get_explorer():
+    """Get the explorer to use in this thread, created only once for all the run."""
+    explorer = getattr(_thread_data, 'explorer', None)
+    if explorer is None:
+        explorer = _thread_data.explorer = Explorer(folder_cache=_get_folder_cache())
+    return explorer
+
+
+def _get_folder_cache():
+    """Get the folders cache, shared by all the explorers."""
+    global _folder_cache
+    with _folder_cache_lock:
+        if _folder_cache is None:
+            _folder_cache = FolderCache()
+    return _folder_cache
+
+
+def upload_to_folder(explorer, filepath, folder, parent, filename=None):
+    """Upload a file to the folder (by name) in the parent (by id)."""
+    folder_id = explorer.get_folder_id(folder, parent)
+    try:
+        explorer.upload(filepath, folder_id, filename)
+    except http.HttpError as err:
+        if err.resp.status != 404:
+            raise
+        # the cached folder is not there anymore, find it again
+        explorer.folder_cache.forget(parent, folder)
+        folder_id = explorer.get_folder_id(folder, parent)
+        explorer.upload(filepath, folder_id, filename)
+
+
 def upload_invoice(filepath, invoice_date, base_folder=None, filename=None):
     """Upload an invoice to the the month folder in Google Drive."""
-    explorer = Explorer()
-
     month_folder = invoice_date.strftime('%Y%m')
     if base_folder is None:
         base_folder = settings.INVOICES_GDRIVE['folder_id']
-
-    # get the id of the month folder (or create it)
-    for folder in explorer.list_folder(base_folder):
-        if month_folder == folder['name']:
-            folder_id = folder['id']
-            break
-    else:
-        folder_id = explorer.create_folder(month_folder, base_folder)
-
-    # upload!
-    explorer.upload(filepath, folder_id, filename)
+    upload_to_folder(get_explorer(), filepath, month_folder, base_folder, filename)
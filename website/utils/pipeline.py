@@ -0,0 +1,61 @@
+"""Helpers to process items through several stages, measuring them."""
+
+import concurrent.futures
+import contextlib
+import threading
+import time
+
+
+class StageTimings:
+    """Accumulate how many items went through each stage and how much time it took.
+
+    It can be used from different threads at the same time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def measure(self, stage):
+        """Measure the time spent in the stage (while inside the context)."""
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            delta = time.monotonic() - t0
+            with self._lock:
+                self.totals[stage] = self.totals.get(stage, 0) + delta
+                self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def report(self):
+        """Return a line per stage, in the order they were first measured."""
+        lines = []
+        for stage, total in self.totals.items():
+            count = self.counts[stage]
+            lines.append("{}: {} item(s) in {:.2f}s (avg {:.2f}s)".format(
+                stage, count, total, total / count))
+        return lines
+
+
+def run_pipeline(items, ordered_stage, post_stage, workers):
+    """Process the items through an ordered stage and then through a post stage.
+
+    The ordered stage runs in the calling thread, one item after the other and in order;
+    what it returns is passed to the post stage, which runs in a pool of workers (so the
+    ordered stage continues with the next item meanwhile). If the ordered stage returns
+    None the pipeline stops, no more items are processed.
+
+    Return the results of the post stage, in order, after all of them finished (if any
+    post stage failed, its exception is raised at that point).
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for item in items:
+            partial_result = ordered_stage(item)
+            if partial_result is None:
+                break
+            futures.append(executor.submit(post_stage, partial_result))
+        concurrent.futures.wait(futures)
+    return [future.result() for future in futures]
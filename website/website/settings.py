@@ -105,6 +105,21 @@ class Base(Configuration):
         }
     }
 
+    # Cache, by default in the database so it's shared by all the web workers and the commands
+    # (and what one invalidates is seen by the others); the table is created by a migration.
+    # The 'local' one is only for this process, for what is read too often to hit the database
+    # each time, so what is invalidated there is not seen by the other processes.
+    # https://docs.djangoproject.com/en/3.2/topics/cache/
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'django_cache',
+        },
+        'local': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
     # Password validation
     # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -149,6 +164,16 @@ class Base(Configuration):
     MEDIA_URL = '/media/'
     MEDIA_ROOT = BASE_DIR
 
+    # the rendered letters have members' personal data: keep them private (not in MEDIA_ROOT)
+    LETTER_CACHE_DIR = os.environ.get(
+        'LETTER_CACHE_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'asoc_members', 'letters'))
+
+    # the journals to resume the massive invoices generation, also private
+    MASSIVE_INVOICES_JOURNAL_DIR = os.environ.get(
+        'MASSIVE_INVOICES_JOURNAL_DIR',
+        os.path.join(os.path.expanduser('~'), '.cache', 'asoc_members', 'massive_invoices'))
+
     LOGIN_URL = '/cuentas/login/'
 
     AFIP = {